@@ -1,5 +1,9 @@
 import base64
+import hashlib
 import json
+import os
+import random
+import time
 from typing import Any, Dict, List, Optional
 
 from botocore.exceptions import ClientError
@@ -8,14 +12,42 @@ from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import jwk
 from jose.utils import base64url_decode
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from starlette.status import HTTP_403_FORBIDDEN
 
 from auth.user_auth import user_info_with_token
+from services.cache import TTLCache
+from services.metrics import time_dependency
+from services.tracing import traced
 
 # Define the type for JWK
 JWK = Dict[str, str]
 
+# How often Cognito is asked whether a token was revoked:
+#   always  - on every request
+#   cached  - once per token every TOKEN_REVOCATION_CACHE_TTL seconds
+#   sampled - like cached, plus a re-check of TOKEN_REVOCATION_SAMPLE_RATE of the cache hits
+REVOCATION_CHECK_POLICIES = ("always", "cached", "sampled")
+TOKEN_REVOCATION_CHECK = os.getenv("TOKEN_REVOCATION_CHECK", "cached")
+TOKEN_REVOCATION_CACHE_TTL = float(os.getenv("TOKEN_REVOCATION_CACHE_TTL", "60"))  # in seconds
+TOKEN_REVOCATION_CACHE_SIZE = int(os.getenv("TOKEN_REVOCATION_CACHE_SIZE", "10000"))
+TOKEN_REVOCATION_SAMPLE_RATE = float(os.getenv("TOKEN_REVOCATION_SAMPLE_RATE", "0.1"))
+
+TOKEN_REVOKED = "Access token has been revoked"
+JWK_NOT_FOUND = "JWK public key not found"
+
+# Tokens whose signature was already verified, so repeated requests skip decoding and RSA verification
+VERIFIED_TOKEN_CACHE_TTL = float(os.getenv("VERIFIED_TOKEN_CACHE_TTL", "300"))  # in seconds
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", "10000"))
+
+
+def token_hash(jwt_token: str) -> str:
+    """
+    Cache key of a token, so the caches don't hold usable tokens.
+    """
+    return hashlib.sha256(jwt_token.encode()).hexdigest()
+
 
 # Model for the JSON Web Key Set (JWKS)
 class JWKS(BaseModel):
@@ -33,10 +65,42 @@ class JWTAuthorizationCredentials(BaseModel):
 
 # Class to handle JWT authentication
 class JWTBearer(HTTPBearer):
-    def __init__(self, jwks: JWKS, auto_error: bool = True):
+    def __init__(self, jwks: JWKS, auto_error: bool = True,
+                 revocation_check: str = TOKEN_REVOCATION_CHECK,
+                 revocation_cache_ttl: float = TOKEN_REVOCATION_CACHE_TTL,
+                 revocation_sample_rate: float = TOKEN_REVOCATION_SAMPLE_RATE,
+                 jwks_loader=None):
         super().__init__(auto_error=auto_error)
+        self.verified_tokens = TTLCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE, ttl=VERIFIED_TOKEN_CACHE_TTL)
+        self.kid_to_jwk = {}
+        self.kid_to_key = {}
+        self.set_jwks(jwks)
+        # Refetches the keys when a token is signed with an unknown kid
+        self.jwks_loader = jwks_loader
+        if jwks_loader is not None:
+            jwks_loader.subscribe(self.set_jwks)
+        if revocation_check not in REVOCATION_CHECK_POLICIES:
+            raise ValueError(f"Unknown token revocation check policy: {revocation_check}")
+        self.revocation_check = revocation_check
+        self.revocation_sample_rate = revocation_sample_rate
+        # sha256 of the token -> whether Cognito still accepted it
+        self.revocation_cache = TTLCache(maxsize=TOKEN_REVOCATION_CACHE_SIZE, ttl=revocation_cache_ttl)
+
+    def set_jwks(self, jwks: JWKS):
+        """
+        Replace the keys tokens are verified with.
+
+        :param jwks: JSON Web Key Set.
+        """
         # Map KIDs to their corresponding JWKs
-        self.kid_to_jwk = {jwk["kid"]: jwk for jwk in jwks.keys}
+        kid_to_jwk = {jwk["kid"]: jwk for jwk in jwks.keys}
+        if kid_to_jwk == self.kid_to_jwk:
+            return
+        # Public keys are only built once, building an RSA key is expensive
+        self.kid_to_key = {kid: jwk.construct(public_key) for kid, public_key in kid_to_jwk.items()}
+        self.kid_to_jwk = kid_to_jwk
+        # Tokens signed with a key that was removed must be verified again
+        self.verified_tokens.clear()
 
     def decode_jwt(self, token: str):
         """
@@ -66,14 +130,12 @@ class JWTBearer(HTTPBearer):
         :return: True if the token is valid, otherwise False.
         """
         try:
-            public_key = self.kid_to_jwk[jwt_credentials.header["kid"]]
+            key = self.kid_to_key[jwt_credentials.header["kid"]]
         except KeyError:
             raise HTTPException(
-                status_code=HTTP_403_FORBIDDEN, detail="JWK public key not found"
+                status_code=HTTP_403_FORBIDDEN, detail=JWK_NOT_FOUND
             )
 
-        # Construct the public key
-        key = jwk.construct(public_key)
         # Decode the signature
         decoded_signature = base64url_decode(jwt_credentials.signature.encode())
 
@@ -89,13 +151,14 @@ class JWTBearer(HTTPBearer):
         :raises HTTPException: If the token is revoked.
         """
         try:
-            user_info_with_token(jwt_token)
+            with time_dependency("cognito", "get_user"):
+                user_info_with_token(jwt_token)
         except ClientError as e:
             # Verifica se a exceção é 'NotAuthorizedException', ou seja, o token foi revogado
             if e.response["Error"]["Code"] == "NotAuthorizedException":
                 raise HTTPException(
                     status_code=HTTP_403_FORBIDDEN,
-                    detail="Access token has been revoked",
+                    detail=TOKEN_REVOKED,
                 )
             else:
                 raise  # Levanta outras exceções de boto3
@@ -106,6 +169,43 @@ class JWTBearer(HTTPBearer):
                 detail="An error occurred while validating the token",
             )
 
+    async def check_token_revoked(self, jwt_credentials: JWTAuthorizationCredentials):
+        """
+        Verify if the token is revoked, asking Cognito only as often as the revocation check policy requires.
+
+        :param jwt_credentials: JWTAuthorizationCredentials object of a token with a valid signature.
+
+        :raises HTTPException: If the token is revoked.
+        """
+        key = token_hash(jwt_credentials.jwt_token)
+        if self.revocation_check != "always":
+            accepted = self.revocation_cache.get(key)
+            if accepted is False:
+                raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail=TOKEN_REVOKED)
+            if accepted and (self.revocation_check == "cached" or random.random() >= self.revocation_sample_rate):
+                return
+
+        try:
+            # boto3 is blocking, keep it off the event loop
+            await run_in_threadpool(self.verify_token_revoed, jwt_credentials.jwt_token)
+        except HTTPException as e:
+            if e.detail == TOKEN_REVOKED:
+                self.cache_until_expiry(self.revocation_cache, key, False, jwt_credentials)
+            raise
+        self.cache_until_expiry(self.revocation_cache, key, True, jwt_credentials)
+
+    def cache_until_expiry(self, cache: TTLCache, key: str, value: Any, jwt_credentials: JWTAuthorizationCredentials):
+        """
+        Cache a check on a token, never past the token's expiry so expired tokens keep being rejected by Cognito.
+        """
+        try:
+            ttl = min(cache.ttl, float(jwt_credentials.claims["exp"]) - time.time())
+        except (KeyError, TypeError, ValueError):
+            return
+        if ttl > 0:
+            cache.set(key, value, ttl=ttl)
+
+    @traced("auth.verify_token")
     async def __call__(self, request: Request) -> Optional[JWTAuthorizationCredentials]:
         """
         Call method to authenticate the request.
@@ -125,9 +225,44 @@ class JWTBearer(HTTPBearer):
 
         jwt_token = credentials.credentials
 
-        # Validate if token is revoked
-        self.verify_token_revoed(jwt_token)
+        key = token_hash(jwt_token)
+        jwt_credentials = self.verified_tokens.get(key)
+        if jwt_credentials is None:
+            try:
+                jwt_credentials = self.verify_jwt(jwt_token)
+            except HTTPException as e:
+                if e.detail != JWK_NOT_FOUND or not await self.refresh_for_unknown_kid(jwt_token):
+                    raise
+                jwt_credentials = self.verify_jwt(jwt_token)
+            self.cache_until_expiry(self.verified_tokens, key, jwt_credentials, jwt_credentials)
+
+        # Validate if token is revoked, last as it's the only check that may call Cognito
+        await self.check_token_revoked(jwt_credentials)
+
+        return jwt_credentials  # Return the JWT credentials if valid
+
+    async def refresh_for_unknown_kid(self, jwt_token: str) -> bool:
+        """
+        Refetch the keys when a token is signed with a kid we don't know, e.g. after a key rotation.
+
+        :return: True if the token's kid is known after the refresh.
+        """
+        if self.jwks_loader is None:
+            return False
+        decoded_header, _ = self.decode_jwt(jwt_token)
+        if not decoded_header or "kid" not in decoded_header:
+            return False
+        return await self.jwks_loader.refresh_for_unknown_kid(decoded_header["kid"])
+
+    def verify_jwt(self, jwt_token: str) -> JWTAuthorizationCredentials:
+        """
+        Decode a JWT token and verify its signature.
+
+        :param jwt_token: JWT token to verify.
+        :return: JWTAuthorizationCredentials object.
 
+        :raises HTTPException: If the JWT is invalid.
+        """
         self.validate_jwt_structure(jwt_token)
 
         try:
@@ -144,7 +279,7 @@ class JWTBearer(HTTPBearer):
         if not self.verify_jwk_token(jwt_credentials):
             raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="JWK invalid")
 
-        return jwt_credentials  # Return the JWT credentials if valid
+        return jwt_credentials
 
     def verify_authentication_scheme(self, credentials: HTTPAuthorizationCredentials):
         """
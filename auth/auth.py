@@ -1,6 +1,4 @@
-import os
-
-import requests
+from auth.jwks import JWKSLoader
 from auth.JWTBearer import JWKS, JWTAuthorizationCredentials, JWTBearer
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException
@@ -8,17 +6,11 @@ from starlette.status import HTTP_403_FORBIDDEN
 
 load_dotenv()
 
-AWS_REGION = os.environ.get("AWS_REGION")
-USER_POOL_ID = os.environ.get("USER_POOL_ID")
-
-# Get the JWKS from the Cognito User Pool
-response = requests.get(
-    f"https://cognito-idp.{AWS_REGION}.amazonaws.com/{USER_POOL_ID}/.well-known/jwks.json"
-)
-
-jwks = JWKS.model_validate(response.json())
+# Keys from disk only; they are fetched from the Cognito User Pool in the app lifespan
+jwks_loader = JWKSLoader()
+jwks = jwks_loader.load_local()
 
-auth = JWTBearer(jwks)
+auth = JWTBearer(jwks, jwks_loader=jwks_loader)
 
 async def get_current_user(
     credentials: JWTAuthorizationCredentials = Depends(auth),
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+from dotenv import load_dotenv
+
+from auth.JWTBearer import JWKS
+from services.metrics import time_dependency
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+AWS_REGION = os.environ.get("AWS_REGION")
+USER_POOL_ID = os.environ.get("USER_POOL_ID")
+JWKS_URL = os.getenv(
+    "JWKS_URL", f"https://cognito-idp.{AWS_REGION}.amazonaws.com/{USER_POOL_ID}/.well-known/jwks.json"
+)
+# A local JWKS file used instead of Cognito, e.g. in tests
+JWKS_FILE = os.getenv("JWKS_FILE")
+# Last keys fetched from Cognito, read at startup so a cold start doesn't wait on the network
+JWKS_CACHE_FILE = os.getenv("JWKS_CACHE_FILE", os.path.join(tempfile.gettempdir(), "cognito_jwks.json"))
+JWKS_REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_INTERVAL", "3600"))  # in seconds
+# Minimum time between two refetches triggered by an unknown kid, so forged kids can't flood Cognito
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "60"))  # in seconds
+JWKS_TIMEOUT = float(os.getenv("JWKS_TIMEOUT", "5"))  # in seconds
+
+
+class JWKSLoader:
+    """
+    Loads the Cognito JWKS and keeps every subscribed JWTBearer up to date with it.
+
+    Keys are read synchronously from disk at import time, then fetched from
+    Cognito in the background. Concurrent refreshes share a single request.
+    """
+
+    def __init__(self, url: str = JWKS_URL, file: Optional[str] = JWKS_FILE, cache_file: Optional[str] = JWKS_CACHE_FILE,
+                 min_refresh_interval: float = JWKS_MIN_REFRESH_INTERVAL, timeout: float = JWKS_TIMEOUT):
+        self.url = url
+        self.file = file
+        self.cache_file = cache_file
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.jwks = JWKS(keys=[])
+        self._subscribers: List[Callable[[JWKS], None]] = []
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refreshed_at: Optional[float] = None
+        self._start_task: Optional[asyncio.Task] = None
+
+    def subscribe(self, callback: Callable[[JWKS], None]):
+        """
+        Call ``callback`` with the new JWKS every time the keys change.
+        """
+        self._subscribers.append(callback)
+
+    def load_local(self) -> JWKS:
+        """
+        Read the keys from the local JWKS file, or from the cache file of the last fetch.
+        Never touches the network.
+        """
+        for path in (self.file, self.cache_file):
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                with open(path) as f:
+                    self._set(JWKS.model_validate(json.load(f)))
+                break
+            except (OSError, ValueError) as e:
+                logger.error("Failed to read JWKS from %s: %s", path, e)
+        return self.jwks
+
+    async def fetch(self) -> JWKS:
+        """
+        Fetch the keys from Cognito and write them to the cache file.
+        """
+        import httpx
+
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            with time_dependency("cognito", "get_jwks"):
+                response = await client.get(self.url)
+            response.raise_for_status()
+        jwks = JWKS.model_validate(response.json())
+        self._refreshed_at = time.monotonic()
+        self._set(jwks)
+        self._write_cache(jwks)
+        return jwks
+
+    async def refresh(self) -> JWKS:
+        """
+        Fetch the keys, joining the fetch already in flight if there is one.
+        Keys from a local JWKS file are never refreshed.
+        """
+        if self.file:
+            return self.jwks
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self.fetch())
+        return await asyncio.shield(self._refresh_task)
+
+    async def refresh_for_unknown_kid(self, kid: str) -> bool:
+        """
+        Refetch the keys after a token signed with an unknown kid, e.g. after a key rotation.
+
+        :return: True if the kid is known after the refresh.
+        """
+        if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.min_refresh_interval:
+            return False
+        # Counted whether the fetch succeeds or not, so forged kids can't retry it while Cognito is down
+        self._refreshed_at = time.monotonic()
+        try:
+            jwks = await self.refresh()
+        except Exception as e:
+            logger.error("Failed to refresh JWKS: %s", e)
+            return False
+        return any(key.get("kid") == kid for key in jwks.keys)
+
+    async def start(self):
+        """
+        Fetch the keys once, only waiting for Cognito when nothing could be loaded from disk.
+        """
+        if self.file:
+            return
+        if self.jwks.keys:
+            self._start_task = asyncio.ensure_future(self._refresh_logged())
+        else:
+            await self._refresh_logged()
+
+    async def run(self, interval: float = JWKS_REFRESH_INTERVAL):
+        """
+        Refresh the keys every ``interval`` seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self._refresh_logged()
+
+    async def _refresh_logged(self):
+        try:
+            jwks = await self.refresh()
+            logger.info("Loaded %s JWKS keys", len(jwks.keys))
+        except Exception as e:
+            logger.error("Failed to refresh JWKS: %s", e)
+
+    def _set(self, jwks: JWKS):
+        self.jwks = jwks
+        for callback in self._subscribers:
+            callback(jwks)
+
+    def _write_cache(self, jwks: JWKS):
+        if not self.cache_file:
+            return
+        try:
+            # Write then rename, so other workers never read a partial file
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(jwks.model_dump(), f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logger.error("Failed to write JWKS cache file %s: %s", self.cache_file, e)
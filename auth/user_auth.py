@@ -1,15 +1,25 @@
 import base64
+import logging
 import os
+from functools import lru_cache
 
-import boto3
-import requests
 from dotenv import load_dotenv
 
 load_dotenv()
 
-cognito_client = boto3.client(
-    "cognito-idp", region_name=os.getenv("AWS_REGION", "us-east-1")
-)
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_cognito_client():
+    """
+    Create the Cognito client on first use; importing boto3 and creating a client is slow.
+    """
+    import boto3
+
+    return boto3.client(
+        "cognito-idp", region_name=os.getenv("AWS_REGION", "us-east-1")
+    )
 
 
 def auth_with_code(code: str, redirect_uri: str):
@@ -20,6 +30,8 @@ def auth_with_code(code: str, redirect_uri: str):
     :param redirect_uri: Redirect URI used during the login process.
     :return: Access token and expiration time if authentication is successful, otherwise None.
     """
+    import requests
+
     client_id = os.getenv("COGNITO_USER_CLIENT_ID")
     client_credentials = f"{client_id}:{os.getenv('COGNITO_USER_CLIENT_SECRET')}"
     auth_header = base64.b64encode(client_credentials.encode()).decode()
@@ -51,7 +63,7 @@ def auth_with_code(code: str, redirect_uri: str):
             "expires_in": token_data.get("expires_in"),
         }  # Returns the access token from the response and the expiration time
     else:
-        print(f"Error: {response.status_code}, {response.text}")
+        logger.error("Failed to exchange the authorization code: HTTP %s", response.status_code)
         return None
 
 
@@ -63,12 +75,13 @@ def user_info_with_token(access_token: str):
     :return: User information if successful, otherwise None.
     """
 
-    response = cognito_client.get_user(AccessToken=access_token)
+    response = get_cognito_client().get_user(AccessToken=access_token)
 
     if response.get("ResponseMetadata").get("HTTPStatusCode") == 200:
         return response
     else:
-        print(f"Error: Error getting user info: {response}")
+        # Not the response itself, it holds the user's attributes
+        logger.error("Error getting user info: HTTP %s", response["ResponseMetadata"]["HTTPStatusCode"])
         return None
 
 
@@ -80,10 +93,10 @@ def logout_with_token(access_token: str):
     :return: True if successful, otherwise False.
     """
 
-    response = cognito_client.global_sign_out(AccessToken=access_token)
+    response = get_cognito_client().global_sign_out(AccessToken=access_token)
 
     if response.get("ResponseMetadata").get("HTTPStatusCode") == 200:
         return True
     else:
-        print(f"Error: Error logging out: {response}")
+        logger.error("Error logging out: HTTP %s", response["ResponseMetadata"]["HTTPStatusCode"])
         return False
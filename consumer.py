@@ -0,0 +1,90 @@
+"""
+Worker consuming the TICKETS queue, apart from the API: ``python -m consumer``.
+
+Start as many workers as needed, RabbitMQ spreads the messages between them.
+On SIGTERM or SIGINT a worker stops receiving messages, applies and acks the
+ones it already received, then closes its connection.
+"""
+import asyncio
+import logging
+import os
+import signal
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+
+from db.database import AsyncSessionLocal, async_engine
+from db.schema import SCHEMA_CHECK, check_schema_version
+from services.lazy import lazy_import
+from services.logs import setup_logging
+from services.reservations import reservation_engine
+from services.ticket_consumer import TicketEventConsumer, declare_tickets_queue
+from services.tracing import setup_tracing, shutdown_tracing
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+RABBITMQ_URL = os.environ.get("RABBITMQ_URL")
+# Serves the Prometheus metrics of the worker, 0 disables it
+CONSUMER_METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", "9100"))
+aio_pika = lazy_import("aio_pika")
+
+
+async def consume_until(consumer: TicketEventConsumer, stop: asyncio.Event):
+    """
+    Run ``consumer`` until ``stop`` is set, then let it finish the messages it already received.
+    """
+    run_task = asyncio.create_task(consumer.run())
+    stop_task = asyncio.create_task(stop.wait())
+    done, _ = await asyncio.wait({run_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+    if run_task in done:
+        stop_task.cancel()
+        run_task.result()
+        return
+    logger.info("Stopping the tickets consumer")
+    await consumer.stop()
+    await run_task
+
+
+async def main():
+    setup_logging()
+    if reservation_engine is not None and not reservation_engine.store.shared:
+        # Its counters would be a copy only this worker sees, the API's would never be reconciled
+        raise RuntimeError(
+            "STOCK_RESERVATION_ENGINE=memory needs the API to consume the TICKETS queue: "
+            "set TICKETS_CONSUMER_IN_API=true and don't start this worker"
+        )
+    setup_tracing("payments-consumer")
+    if SCHEMA_CHECK:
+        await check_schema_version()
+    if CONSUMER_METRICS_PORT:
+        # Served from a background thread
+        start_http_server(CONSUMER_METRICS_PORT)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    connection = await aio_pika.connect_robust(RABBITMQ_URL)
+    try:
+        channel = await connection.channel()
+        exchange = await channel.declare_exchange("exchange", type=aio_pika.ExchangeType.TOPIC, durable=True)
+        # Counters of a shared engine are reconciled here; the API process owns the flushing
+        consumer = TicketEventConsumer(AsyncSessionLocal, reservation_engine)
+        await consumer.start(channel, await declare_tickets_queue(channel, exchange))
+        logger.info("Consuming the TICKETS queue")
+        lag_task = asyncio.create_task(consumer.report_lag())
+        try:
+            await consume_until(consumer, stop)
+        finally:
+            lag_task.cancel()
+    finally:
+        await connection.close()
+        await async_engine.dispose()
+        shutdown_tracing()
+    logger.info("Tickets consumer stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,399 @@
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud.crud import ticket_stock_upsert
+from models.models import (CheckoutSession, OutboxMessage, ProcessedEvent,
+                           TicketStock, UserMapping, user_mapping_uuid)
+from services.metrics import (RESERVATION_SUCCESS, record_reservation,
+                              record_reservation_failure)
+from services.logs import SAMPLED
+from services.stock_cache import stock_cache
+from services.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+@traced("crud.get_or_create_user_mapping")
+async def get_or_create_user_mapping(db: AsyncSession, user_id: str):
+    """
+    Return the user's mapping, inserting it the first time the user checks out.
+    The uuid is derived from the user id, so every user has exactly one row.
+    """
+    mapping_uuid = user_mapping_uuid(user_id)
+    db_user_mapping = await db.get(UserMapping, mapping_uuid)
+    if db_user_mapping is not None:
+        return db_user_mapping
+
+    db_user_mapping = UserMapping(uuid=mapping_uuid, user_id=user_id)
+    db.add(db_user_mapping)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Inserted concurrently by another request for the same user
+        await db.rollback()
+    return db_user_mapping
+
+@traced("crud.get_user_mapping_by_uuid")
+async def get_user_mapping_by_uuid(db: AsyncSession, uuid):
+    db_user_mapping = await db.get(UserMapping, uuid)
+    if db_user_mapping is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user_mapping
+
+async def _raise_stock_error(db: AsyncSession, price_id: str, quantity: int):
+    # Only reached when the conditional UPDATE matched no row, so the extra
+    # SELECT stays off the happy path and just tells the two failures apart.
+    result = await db.execute(
+        select(TicketStock.ticket_id).where(TicketStock.stripe_price_id == price_id)
+    )
+    if result.first() is None:
+        logger.info("Ticket with stripe_price_id %s not found.", price_id)
+        raise HTTPException(status_code=404, detail="Ticket not found")
+
+    logger.info("Couldn't decrement stock by %s. Not enough stock.", quantity)
+    raise HTTPException(status_code=400, detail="Not enough stock")
+
+@traced("crud.decrement_stocks")
+async def decrement_stocks(db: AsyncSession, quantities: Dict[str, int]):
+    """
+    Reserve stock for several price ids in one transaction, all or nothing.
+
+    Rows are updated in price id order so concurrent batches always lock them in
+    the same order and can't deadlock.
+
+    :param quantities: Mapping of stripe_price_id to the quantity to reserve.
+    :raises HTTPException: 404 if a price is unknown, 400 if one doesn't have enough stock.
+    """
+    for price_id in sorted(quantities):
+        quantity = quantities[price_id]
+        result = await db.execute(
+            update(TicketStock)
+            .where(TicketStock.stripe_price_id == price_id, TicketStock.stock >= quantity)
+            .values(stock=TicketStock.stock - quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            await db.rollback()
+            try:
+                await _raise_stock_error(db, price_id, quantity)
+            except HTTPException as e:
+                record_reservation_failure(price_id, e.status_code)
+                raise
+
+    await db.commit()
+    stock_cache.invalidate_prices(quantities)
+    for price_id in quantities:
+        record_reservation(price_id, RESERVATION_SUCCESS)
+    logger.info("Stock decremented for %s price ids: %s", len(quantities), quantities, extra=SAMPLED)
+
+@traced("crud.increment_stocks")
+async def increment_stocks(db: AsyncSession, quantities: Dict[str, int], commit: bool = True):
+    """
+    Release stock for several price ids in one transaction, in price id order.
+
+    :param commit: Commit the transaction, otherwise the caller commits it and invalidates ``stock_cache``.
+    """
+    for price_id in sorted(quantities):
+        await db.execute(
+            update(TicketStock)
+            .where(TicketStock.stripe_price_id == price_id)
+            .values(stock=TicketStock.stock + quantities[price_id])
+            .execution_options(synchronize_session=False)
+        )
+    if not commit:
+        return
+    await db.commit()
+    stock_cache.invalidate_prices(quantities)
+    logger.info("Stock incremented for %s price ids: %s", len(quantities), quantities, extra=SAMPLED)
+
+async def get_stock_by_ticket_id(db: AsyncSession, ticket_id: int):
+    result = await db.execute(
+        select(TicketStock.stock).where(TicketStock.ticket_id == ticket_id)
+    )
+    stock = result.scalar_one_or_none()
+    if stock is None:
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    return {"stock": stock}
+
+async def get_stock_by_price_id(db: AsyncSession, price_id: str):
+    result = await db.execute(
+        select(TicketStock.stock).where(TicketStock.stripe_price_id == price_id)
+    )
+    stock = result.scalar_one_or_none()
+    if stock is None:
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    return {"stock": stock}
+
+async def get_stock_ticket_id_by_price_id(db: AsyncSession, price_id: str):
+    result = await db.execute(
+        select(TicketStock.ticket_id).where(TicketStock.stripe_price_id == price_id)
+    )
+    ticket_id = result.scalar_one_or_none()
+    if ticket_id is None:
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    return ticket_id
+
+async def get_ticket_prices(db: AsyncSession):
+    """
+    :return: (ticket_id, stripe_price_id) for every ticket in stock.
+    """
+    result = await db.execute(select(TicketStock.ticket_id, TicketStock.stripe_price_id))
+    return result.all()
+
+async def create_checkout_session_items(db: AsyncSession, session_id: str, user_id: str,
+                                        line_items: list[dict], expires_at: datetime):
+    """
+    Record the line items of a newly created Stripe checkout session in the ledger.
+
+    :param line_items: Dicts with price_id, quantity and unit_amount (in cents, may be None).
+    """
+    db_items = [
+        CheckoutSession(
+            session_id=session_id,
+            user_id=user_id,
+            price_id=line_item["price_id"],
+            quantity=line_item["quantity"],
+            unit_amount=line_item.get("unit_amount"),
+            expires_at=expires_at,
+        )
+        for line_item in line_items
+    ]
+    db.add_all(db_items)
+    await db.commit()
+    return db_items
+
+@traced("crud.get_checkout_session_items")
+async def get_checkout_session_items(db: AsyncSession, session_id: str):
+    result = await db.execute(select(CheckoutSession).where(CheckoutSession.session_id == session_id))
+    return list(result.scalars())
+
+async def get_open_checkout_sessions(db: AsyncSession):
+    """
+    :return: (session_id, expires_at) of every session still open in the ledger.
+    """
+    result = await db.execute(
+        select(CheckoutSession.session_id, CheckoutSession.expires_at)
+        .where(CheckoutSession.status == CheckoutSession.OPEN)
+        .distinct()
+    )
+    return result.all()
+
+async def expire_checkout_sessions(db: AsyncSession, session_ids: list[str], apply_stock: bool = True,
+                                   commit: bool = True) -> Dict[str, int]:
+    """
+    Move the given sessions from open to expired in a single transaction.
+
+    Sessions already closed, e.g. by a webhook, are skipped: their rows are locked
+    first, so a concurrent status update either wins or sees them expired.
+
+    :param apply_stock: Also give the stock back to ``ticket_stock`` in the same transaction.
+    :param commit: Commit the transaction, otherwise the caller commits it and invalidates ``stock_cache``.
+    :return: Quantity released per price id.
+    """
+    result = await db.execute(
+        select(CheckoutSession.id, CheckoutSession.price_id, CheckoutSession.quantity)
+        .where(CheckoutSession.session_id.in_(session_ids), CheckoutSession.status == CheckoutSession.OPEN)
+        .with_for_update()
+    )
+    rows = result.all()
+    if not rows:
+        if commit:
+            await db.rollback()
+        return {}
+
+    await db.execute(
+        update(CheckoutSession)
+        .where(CheckoutSession.id.in_([row.id for row in rows]))
+        .values(status=CheckoutSession.EXPIRED)
+        .execution_options(synchronize_session=False)
+    )
+    deltas: Dict[str, int] = {}
+    for row in rows:
+        deltas[row.price_id] = deltas.get(row.price_id, 0) + row.quantity
+    if apply_stock:
+        # Same lock order as crud.apply_stock_deltas
+        for price_id in sorted(deltas):
+            await db.execute(
+                update(TicketStock)
+                .where(TicketStock.stripe_price_id == price_id)
+                .values(stock=TicketStock.stock + deltas[price_id])
+                .execution_options(synchronize_session=False)
+            )
+    if commit:
+        await db.commit()
+        if apply_stock:
+            stock_cache.invalidate_prices(deltas)
+    return deltas
+
+@traced("crud.complete_checkout_session")
+async def complete_checkout_session(db: AsyncSession, session_id: str, apply_stock: bool = True,
+                                    commit: bool = True) -> Dict[str, int]:
+    """
+    Move a session from open, or expired, to complete in a single transaction.
+
+    An expired session had its stock given back, e.g. by the sweeper before a late
+    payment landed: it is taken back in the same transaction as the status change.
+    Its rows are locked first, like in :func:`expire_checkout_sessions`.
+
+    :param apply_stock: Also take the stock of an expired session back from ``ticket_stock``.
+    :param commit: Commit the transaction, otherwise the caller commits it and invalidates ``stock_cache``.
+    :return: Quantity taken back per price id, empty unless the session was expired.
+    """
+    result = await db.execute(
+        select(CheckoutSession.id, CheckoutSession.price_id, CheckoutSession.quantity, CheckoutSession.status)
+        .where(CheckoutSession.session_id == session_id,
+               CheckoutSession.status.in_([CheckoutSession.OPEN, CheckoutSession.EXPIRED]))
+        .with_for_update()
+    )
+    rows = result.all()
+    if not rows:
+        if commit:
+            await db.rollback()
+        return {}
+
+    await db.execute(
+        update(CheckoutSession)
+        .where(CheckoutSession.id.in_([row.id for row in rows]))
+        .values(status=CheckoutSession.COMPLETE)
+        .execution_options(synchronize_session=False)
+    )
+    deltas: Dict[str, int] = {}
+    for row in rows:
+        if row.status == CheckoutSession.EXPIRED:
+            deltas[row.price_id] = deltas.get(row.price_id, 0) + row.quantity
+    if apply_stock:
+        # The tickets are already paid for, so this may leave the stock negative
+        for price_id in sorted(deltas):
+            await db.execute(
+                update(TicketStock)
+                .where(TicketStock.stripe_price_id == price_id)
+                .values(stock=TicketStock.stock - deltas[price_id])
+                .execution_options(synchronize_session=False)
+            )
+    if commit:
+        await db.commit()
+        if apply_stock:
+            stock_cache.invalidate_prices(deltas)
+    return deltas
+
+async def _upsert_ticket_stocks(db: AsyncSession, rows: list[dict]):
+    stmt = ticket_stock_upsert(db.bind.dialect.name, rows)
+    if stmt is not None:
+        await db.execute(stmt)
+        return
+    for row in rows:
+        db_ticket_stock = await db.get(TicketStock, row["ticket_id"])
+        if db_ticket_stock is None or db_ticket_stock.version <= row["version"]:
+            await db.merge(TicketStock(**row))
+
+async def apply_ticket_stock_changes(db: AsyncSession, upserts: list[dict], updates: Dict[int, dict]) -> Dict[int, str]:
+    """
+    Apply a batch of ticket stock events in a single transaction. Events older
+    than the version stored for their ticket are skipped.
+
+    :param upserts: Dicts with ticket_id, stripe_price_id, stock and version, inserted or overwritten.
+    :param updates: Mapping of ticket_id to its new stock and version, for tickets that must already exist.
+    :return: stripe_price_id of every ticket written; missing tickets and stale events are left out.
+    """
+    result = await db.execute(
+        select(TicketStock.ticket_id, TicketStock.stripe_price_id, TicketStock.version)
+        .where(TicketStock.ticket_id.in_([row["ticket_id"] for row in upserts] + list(updates)))
+    )
+    stored = {ticket_id: (price_id, version) for ticket_id, price_id, version in result.all()}
+
+    def is_stale(ticket_id: int, version: int) -> bool:
+        if ticket_id in stored and stored[ticket_id][1] > version:
+            logger.info("Ignored event of ticket %s: version %s is older than the stored one.", ticket_id, version)
+            return True
+        return False
+
+    written: Dict[int, str] = {}
+    upserts = [row for row in upserts if not is_stale(row["ticket_id"], row["version"])]
+    if upserts:
+        # The statement re-checks the version, in case another consumer wrote the row since
+        await _upsert_ticket_stocks(db, upserts)
+        written.update((row["ticket_id"], row["stripe_price_id"]) for row in upserts)
+
+    for ticket_id in updates.keys() - stored.keys():
+        logger.info("Ticket %s not found, stock update skipped.", ticket_id)
+    fresh = sorted(
+        ticket_id for ticket_id in updates.keys() & stored.keys()
+        if not is_stale(ticket_id, updates[ticket_id]["version"])
+    )
+    if fresh:
+        ticket_stock = TicketStock.__table__
+        # Conditional UPDATE by primary key, sent as a single executemany
+        await db.execute(
+            update(ticket_stock)
+            .where(ticket_stock.c.ticket_id == bindparam("b_ticket_id"),
+                   ticket_stock.c.version <= bindparam("b_version"))
+            .values(stock=bindparam("b_stock"), version=bindparam("b_version")),
+            [
+                {"b_ticket_id": ticket_id, "b_stock": updates[ticket_id]["stock"], "b_version": updates[ticket_id]["version"]}
+                for ticket_id in fresh
+            ],
+        )
+        written.update((ticket_id, stored[ticket_id][0]) for ticket_id in fresh)
+
+    await db.commit()
+    for ticket_id in written:
+        stock_cache.invalidate(ticket_id)
+    return written
+
+@traced("crud.claim_event")
+async def claim_event(db: AsyncSession, event_id: str, event_type: str) -> bool:
+    """
+    Record a Stripe event as processed, in the transaction of the changes it makes.
+    The caller commits, and takes an IntegrityError on commit for a concurrent replay.
+
+    :return: False if the event was already processed, by this or another worker.
+    """
+    db.add(ProcessedEvent(event_id=event_id, type=event_type))
+    try:
+        # Waits on the row of a concurrent claim until that transaction ends
+        await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    return True
+
+@traced("crud.add_outbox_messages")
+async def add_outbox_messages(db: AsyncSession, routing_key: str, bodies: list[str],
+                              headers: Optional[dict] = None) -> list[tuple[int, str, str, Optional[dict]]]:
+    """
+    Add messages to the outbox, in the transaction of the change they announce.
+    The caller commits, then hands them to the OutboxPublisher.
+
+    :param headers: Trace context headers of the change, sent with the messages.
+    :return: The (id, routing_key, body, headers) of every message.
+    """
+    stored_headers = json.dumps(headers) if headers else None
+    messages = [OutboxMessage(routing_key=routing_key, body=body, headers=stored_headers) for body in bodies]
+    db.add_all(messages)
+    await db.flush()
+    return [(message.id, message.routing_key, message.body, headers) for message in messages]
+
+async def get_outbox_messages(db: AsyncSession, created_before: datetime, limit: int) -> list[OutboxMessage]:
+    """
+    Oldest messages still in the outbox, written before ``created_before``.
+    """
+    result = await db.execute(
+        select(OutboxMessage)
+        .where(OutboxMessage.created_at <= created_before)
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+    )
+    return list(result.scalars())
+
+async def delete_outbox_messages(db: AsyncSession, message_ids: list[int]):
+    """
+    Remove published messages from the outbox.
+    """
+    await db.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(message_ids)))
+    await db.commit()
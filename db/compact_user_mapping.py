@@ -0,0 +1,69 @@
+"""
+One-shot migration for the deterministic user_mapping uuids.
+
+Earlier versions inserted a new user_mapping row (with a random uuid) on every
+checkout. This script gives every user its deterministic row and deletes the
+duplicates. It only touches data: the user_id index comes with the migrations,
+so run ``python -m db.migrate`` first.
+
+Stripe sessions created before the change point at the random uuids through
+client_reference_id, so only run it once EXPIRE_TIME has passed since deploying:
+
+    python -m db.compact_user_mapping
+"""
+import asyncio
+import logging
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from db.database import SessionLocal
+from db.schema import check_schema_version
+from models.models import UserMapping, user_mapping_uuid
+from services.logs import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def compact_user_mappings(db: Session, batch_size: int = 1000) -> int:
+    """
+    Keep exactly one user_mapping row per user_id, keyed by its deterministic uuid.
+
+    :return: Number of duplicate rows deleted.
+    """
+    user_ids = db.scalars(select(UserMapping.user_id).distinct()).all()
+    deleted = 0
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        canonical = {user_mapping_uuid(user_id): user_id for user_id in batch}
+
+        existing = set(db.scalars(select(UserMapping.uuid).where(UserMapping.uuid.in_(canonical))))
+        db.add_all(
+            UserMapping(uuid=mapping_uuid, user_id=user_id)
+            for mapping_uuid, user_id in canonical.items()
+            if mapping_uuid not in existing
+        )
+        db.flush()
+
+        result = db.execute(
+            delete(UserMapping)
+            .where(UserMapping.user_id.in_(batch), UserMapping.uuid.not_in(canonical))
+            .execution_options(synchronize_session=False)
+        )
+        deleted += result.rowcount
+        db.commit()
+
+    return deleted
+
+
+if __name__ == "__main__":
+    setup_logging()
+    # Raises if the database wasn't migrated yet
+    asyncio.run(check_schema_version(cache_file=None))
+    db = SessionLocal()
+    try:
+        deleted = compact_user_mappings(db)
+    finally:
+        db.close()
+    logger.info("Deleted %s duplicate user_mapping rows", deleted)
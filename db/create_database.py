@@ -1,7 +0,0 @@
-from db.database import Base, engine
-from models.models import TicketStock
-
-
-def create_tables():
-    Base.metadata.create_all(bind=engine)
-    TicketStock.metadata.create_all(bind=engine)
\ No newline at end of file
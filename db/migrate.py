@@ -0,0 +1,27 @@
+"""
+One-shot schema migration, run once per deploy before the API and consumer workers start:
+
+    python -m db.migrate
+
+Same as ``alembic upgrade head`` from the project root.
+"""
+from typing import Optional
+
+from alembic import command
+from alembic.config import Config
+
+from db.schema import ALEMBIC_INI
+
+
+def migrate(revision: str = "head", url: Optional[str] = None):
+    """
+    Upgrade the database to ``revision``, the one of MYSQL_URL unless ``url`` is given.
+    """
+    config = Config(ALEMBIC_INI)
+    if url is not None:
+        config.set_main_option("sqlalchemy.url", url.replace("%", "%%"))
+    command.upgrade(config, revision)
+
+
+if __name__ == "__main__":
+    migrate()
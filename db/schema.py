@@ -0,0 +1,120 @@
+"""
+Schema revision check run by the API and consumer workers at startup.
+
+Workers never change the schema: it is migrated once per deploy, before they
+start, by ``python -m db.migrate``. A worker refuses to start on a database
+that is behind its migrations.
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from db.database import async_engine
+
+logger = logging.getLogger(__name__)
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "true").lower() == "true"
+# Last revision checked, shared by the workers of a host so they don't all query the database
+SCHEMA_VERSION_CACHE_FILE = os.getenv(
+    "SCHEMA_VERSION_CACHE_FILE", os.path.join(tempfile.gettempdir(), "payments_schema_version.json")
+)
+SCHEMA_VERSION_CACHE_TTL = float(os.getenv("SCHEMA_VERSION_CACHE_TTL", "300"))  # in seconds
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def head_revision() -> str:
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    return ScriptDirectory.from_config(Config(ALEMBIC_INI)).get_current_head()
+
+
+def is_known_revision(revision: str) -> bool:
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+    from alembic.util import CommandError
+
+    try:
+        return ScriptDirectory.from_config(Config(ALEMBIC_INI)).get_revision(revision) is not None
+    except CommandError:
+        return False
+
+
+async def read_revision(engine: AsyncEngine) -> Optional[str]:
+    """
+    :return: Revision stamped in the database, None if it was never migrated.
+    """
+    async with engine.connect() as conn:
+        try:
+            result = await conn.execute(text("SELECT version_num FROM alembic_version"))
+        except DBAPIError:
+            # No alembic_version table
+            return None
+        return result.scalar_one_or_none()
+
+
+async def check_schema_version(engine: Optional[AsyncEngine] = None, cache_file: Optional[str] = SCHEMA_VERSION_CACHE_FILE,
+                               ttl: float = SCHEMA_VERSION_CACHE_TTL) -> str:
+    """
+    Make sure the database is migrated to the head revision of this build.
+
+    A successful check is cached in ``cache_file`` for ``ttl`` seconds. A database
+    ahead of this build, migrated for a newer deploy, is accepted with a warning.
+
+    :return: Revision of the database.
+    :raises SchemaVersionError: If the database is behind this build's migrations.
+    """
+    engine = engine or async_engine
+    database = engine.url.render_as_string(hide_password=True)
+    head = head_revision()
+    if _read_cache(cache_file, ttl, database) == head:
+        return head
+
+    revision = await read_revision(engine)
+    if revision == head:
+        _write_cache(cache_file, database, revision)
+        return revision
+    if revision is not None and not is_known_revision(revision):
+        logger.warning("Database schema is at revision %s, newer than this build's %s", revision, head)
+        return revision
+    raise SchemaVersionError(
+        f"Database schema is at revision {revision}, this build needs {head}: run python -m db.migrate"
+    )
+
+
+def _read_cache(cache_file: Optional[str], ttl: float, database: str) -> Optional[str]:
+    if not cache_file:
+        return None
+    try:
+        if time.time() - os.path.getmtime(cache_file) > ttl:
+            return None
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cached.get("revision") if cached.get("database") == database else None
+
+
+def _write_cache(cache_file: Optional[str], database: str, revision: str):
+    if not cache_file:
+        return
+    try:
+        # Write then rename, so other workers never read a partial file
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"database": database, "revision": revision}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.error("Failed to write schema version cache file %s: %s", cache_file, e)
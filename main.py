@@ -1,16 +1,15 @@
-from contextlib import asynccontextmanager
-import aio_pika
-import asyncio
-import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette import status
+from starlette.responses import Response
 
-import models
-from db.create_database import create_tables
-from db.database import engine
 from routers import checkout
 from routers.checkout import lifespan
+from services.logs import setup_logging
+from services.metrics import MetricsMiddleware, metrics_payload
+from services.tracing import TracingMiddleware
+
+setup_logging()
 
 app = FastAPI(
     lifespan=lifespan,
@@ -33,6 +32,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 @app.get(
@@ -46,4 +47,10 @@ def get_health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    payload, content_type = metrics_payload()
+    return Response(content=payload, media_type=content_type)
+
+
 app.include_router(checkout.router, tags=["Client"])
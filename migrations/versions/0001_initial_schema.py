@@ -0,0 +1,89 @@
+"""Initial schema, adopting databases created by create_tables
+
+Databases created by Base.metadata.create_all before migrations existed may
+miss later additions (ticket_stock.version, user_mapping.user_id's index), so
+every table, column and index is only created when missing. Stamping isn't
+needed: ``alembic upgrade head`` works on both fresh and existing databases.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def create_index_if_missing(table: str, name: str, columns: list[str]):
+    indexes = {index["name"] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+    if name not in indexes:
+        op.create_index(name, table, columns)
+
+
+def upgrade():
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "user_mapping" not in tables:
+        op.create_table(
+            "user_mapping",
+            sa.Column("uuid", sa.String(36), primary_key=True),
+            sa.Column("user_id", sa.String(50), nullable=False),
+        )
+    create_index_if_missing("user_mapping", "ix_user_mapping_user_id", ["user_id"])
+
+    if "ticket_stock" not in tables:
+        op.create_table(
+            "ticket_stock",
+            sa.Column("ticket_id", sa.Integer, primary_key=True),
+            sa.Column("stripe_price_id", sa.String(32), nullable=False, unique=True),
+            sa.Column("stock", sa.Integer, nullable=False),
+            sa.Column("version", sa.BigInteger, nullable=False, server_default="0"),
+        )
+    elif "version" not in {column["name"] for column in sa.inspect(op.get_bind()).get_columns("ticket_stock")}:
+        op.add_column("ticket_stock", sa.Column("version", sa.BigInteger, nullable=False, server_default="0"))
+
+    if "checkout_session" not in tables:
+        op.create_table(
+            "checkout_session",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("session_id", sa.String(255), nullable=False),
+            sa.Column("user_id", sa.String(50), nullable=False),
+            sa.Column("price_id", sa.String(32), nullable=False),
+            sa.Column("quantity", sa.Integer, nullable=False),
+            sa.Column("unit_amount", sa.Integer, nullable=True),
+            sa.Column("status", sa.String(16), nullable=False),
+            sa.Column("expires_at", sa.DateTime, nullable=False),
+            sa.Column("created_at", sa.DateTime, nullable=False),
+            sa.UniqueConstraint("session_id", "price_id", name="uq_checkout_session_session_id_price_id"),
+        )
+    create_index_if_missing("checkout_session", "ix_checkout_session_user_id", ["user_id"])
+    create_index_if_missing("checkout_session", "ix_checkout_session_price_id", ["price_id"])
+    create_index_if_missing("checkout_session", "ix_checkout_session_status", ["status"])
+
+    if "processed_event" not in tables:
+        op.create_table(
+            "processed_event",
+            sa.Column("event_id", sa.String(255), primary_key=True),
+            sa.Column("type", sa.String(64), nullable=False),
+            sa.Column("created_at", sa.DateTime, nullable=False),
+        )
+    create_index_if_missing("processed_event", "ix_processed_event_created_at", ["created_at"])
+
+    if "outbox_message" not in tables:
+        op.create_table(
+            "outbox_message",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("routing_key", sa.String(255), nullable=False),
+            sa.Column("body", sa.Text, nullable=False),
+            sa.Column("created_at", sa.DateTime, nullable=False),
+        )
+    create_index_if_missing("outbox_message", "ix_outbox_message_created_at", ["created_at"])
+
+
+def downgrade():
+    for table in ("outbox_message", "processed_event", "checkout_session", "ticket_stock", "user_mapping"):
+        op.drop_table(table)
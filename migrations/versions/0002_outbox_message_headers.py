@@ -0,0 +1,22 @@
+"""Trace context headers of outbox messages
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("outbox_message", sa.Column("headers", sa.Text, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("outbox_message") as batch_op:
+        batch_op.drop_column("headers")
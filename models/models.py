@@ -1,18 +1,95 @@
 import uuid
+from datetime import datetime, timezone
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import (BigInteger, Column, DateTime, Integer, String, Text,
+                        UniqueConstraint)
 
 from db.database import Base
 
+# Namespace for the deterministic UserMapping uuids, never change it:
+# it would orphan every existing mapping.
+USER_MAPPING_NAMESPACE = uuid.UUID("5b0c4a64-2f43-4a54-9d3e-6f8e1c6b7a21")
+
+
+def utcnow() -> datetime:
+    """
+    Naive UTC timestamp, as stored in DateTime columns.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def user_mapping_uuid(user_id: str) -> str:
+    """
+    Deterministic mapping uuid for a Cognito user (sub).
+    """
+    return str(uuid.uuid5(USER_MAPPING_NAMESPACE, user_id))
+
 
 class UserMapping(Base):
     __tablename__ = "user_mapping"
 
-    uuid: str = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: str = Column(String(50), nullable=False)
+    uuid: str = Column(
+        String(36),
+        primary_key=True,
+        default=lambda context: user_mapping_uuid(context.get_current_parameters()["user_id"]),
+    )
+    user_id: str = Column(String(50), nullable=False, index=True)
 
 class TicketStock(Base):
     __tablename__ = "ticket_stock"
     ticket_id = Column(Integer, primary_key=True)
+    # Its unique index also holds ticket_id, the clustered key, so price_id -> ticket_id never reads the row
     stripe_price_id = Column(String(32), nullable=False, unique=True)
     stock = Column(Integer, nullable=False)
+    # Version of the last tickets service event applied, older redeliveries are ignored
+    version = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+class CheckoutSession(Base):
+    """
+    One row per line item of every Stripe checkout session created by this service.
+    """
+    __tablename__ = "checkout_session"
+    __table_args__ = (
+        # Also serves lookups by session_id alone
+        UniqueConstraint("session_id", "price_id", name="uq_checkout_session_session_id_price_id"),
+    )
+
+    OPEN = "open"
+    COMPLETE = "complete"
+    EXPIRED = "expired"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String(255), nullable=False)
+    user_id = Column(String(50), nullable=False, index=True)
+    price_id = Column(String(32), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    unit_amount = Column(Integer, nullable=True)  # in cents
+    status = Column(String(16), nullable=False, default=OPEN, index=True)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=utcnow)
+
+
+class ProcessedEvent(Base):
+    """
+    Stripe webhook events already handled, so retried deliveries are ignored.
+    """
+    __tablename__ = "processed_event"
+
+    event_id = Column(String(255), primary_key=True)
+    type = Column(String(64), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=utcnow, index=True)
+
+
+class OutboxMessage(Base):
+    """
+    Messages to publish to RabbitMQ. They are committed with the change they announce,
+    so a crash before the publish can't lose them, and deleted once the broker confirmed them.
+    """
+    __tablename__ = "outbox_message"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    routing_key = Column(String(255), nullable=False)
+    body = Column(Text, nullable=False)
+    # JSON trace context of the request that wrote the message, only set while tracing
+    headers = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=utcnow, index=True)
@@ -2,123 +2,320 @@ import asyncio
 import json
 import logging
 import os
-import sys
 import time
 from contextlib import asynccontextmanager
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Callable
 
-import aio_pika
-import stripe
-from aio_pika import Message
-from fastapi import APIRouter, Depends, FastAPI, Request, status
-from starlette.responses import Response
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, status
+from pydantic import BaseModel, Field
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
 
-from auth.auth import get_current_user, get_current_user_id, jwks
+from auth.auth import auth, get_current_user, get_current_user_id, jwks_loader
 from auth.JWTBearer import JWTAuthorizationCredentials, JWTBearer
-from crud import crud
-from crud.crud import (create_ticket_stock, decrement_stock,
-                       get_stock_by_price_id, get_stock_by_ticket_id,
-                       get_stock_ticket_id_by_price_id, increment_stock,
-                       update_ticket_stock)
-from db.create_database import create_tables
-from db.database import get_db
+from crud import async_crud
+from db.database import AsyncSessionLocal, SessionLocal, get_db
+from db.schema import SCHEMA_CHECK, check_schema_version
+from services.cache import TTLCache
+from services.price_cache import PRICE_CACHE_REFRESH_INTERVAL, price_cache
+from services.publisher import OutboxPublisher
+from services.reservations import STOCK_FLUSH_INTERVAL, reservation_engine
+from services.stock_cache import STOCK_CACHE_TTL, stock_cache
+from services.lazy import lazy_import
+from services.logs import SAMPLED, payload_summary
+from services.metrics import time_dependency
+from services.stripe_client import (close_stripe_client, ensure_stripe_client,
+                                    stripe)
+from services.sweeper import reservation_sweeper
+from services.tracing import setup_tracing, shutdown_tracing, trace_headers
+from services.ticket_consumer import TicketEventConsumer, declare_tickets_queue
 
 router = APIRouter(
     tags=["Create checkout sessions"],
 
 )
 DOMAIN = os.getenv("DOMAIN")
-stripe.api_key = os.getenv("STRIPE_API_KEY")
 webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
 expire_time = int(os.getenv("EXPIRE_TIME"))  # in seconds
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-logger.addHandler(logging.StreamHandler(sys.stdout))
 
 
+# Users whose user_mapping row is known to exist; rows are never deleted, so entries never go stale
+USER_MAPPING_CACHE_SIZE = int(os.getenv("USER_MAPPING_CACHE_SIZE", "100000"))
+known_user_mappings = TTLCache(maxsize=USER_MAPPING_CACHE_SIZE, ttl=24 * 60 * 60)
+
+# Webhook events already handled by this worker. Stripe retries a delivery for up to
+# three days; older replays still hit the processed_event table.
+PROCESSED_EVENT_CACHE_SIZE = int(os.getenv("PROCESSED_EVENT_CACHE_SIZE", "100000"))
+processed_events = TTLCache(maxsize=PROCESSED_EVENT_CACHE_SIZE, ttl=3 * 24 * 60 * 60)
+
+STRIPE_METADATA_VALUE_MAX_LENGTH = 500
+
+# How long browsers and CDNs may reuse a GET /stock response without revalidating it
+STOCK_CACHE_MAX_AGE = int(os.getenv("STOCK_CACHE_MAX_AGE", str(int(STOCK_CACHE_TTL))))  # in seconds
+
 RABBITMQ_URL = os.environ.get("RABBITMQ_URL")
 exchange = None
+# Only needed once the lifespan connects, keeps it out of the import time
+aio_pika = lazy_import("aio_pika")
+# The TICKETS queue is consumed by `python -m consumer`. Single process deployments
+# using the memory reservation engine must consume it here so its counters get reconciled,
+# the worker refuses to start with that engine.
+TICKETS_CONSUMER_IN_API = os.getenv("TICKETS_CONSUMER_IN_API", "false").lower() == "true"
+ticket_consumer = TicketEventConsumer(AsyncSessionLocal, reservation_engine)
+payments_publisher = OutboxPublisher(AsyncSessionLocal)
 
 
-auth = JWTBearer(jwks)
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global connection, channel, exchange, queue
-    create_tables()
+    if reservation_engine is not None and not reservation_engine.store.shared and not TICKETS_CONSUMER_IN_API:
+        raise RuntimeError(
+            "STOCK_RESERVATION_ENGINE=memory keeps the stock counters in the API process, "
+            "set TICKETS_CONSUMER_IN_API=true so ticket events reconcile them"
+        )
+    setup_tracing("payments-api")
+    if SCHEMA_CHECK:
+        await check_schema_version()
+    await jwks_loader.start()
+    jwks_task = asyncio.create_task(jwks_loader.run())
+    await warm_price_cache()
+    price_cache_task = asyncio.create_task(refresh_price_cache())
     # Connect to RabbitMQ
     connection = await aio_pika.connect_robust(RABBITMQ_URL)
-    channel = await connection.channel()
+    channel = await connection.channel(publisher_confirms=True)
     exchange = await channel.declare_exchange("exchange", type=aio_pika.ExchangeType.TOPIC, durable=True)
 
-    # queues
-    tickets_queue = await channel.declare_queue("TICKETS", durable=True)
+    # queues, TICKETS is declared so no event is lost before a consumer starts
+    tickets_queue = await declare_tickets_queue(channel, exchange)
     payments_queue = await channel.declare_queue("PAYMENTS", durable=True)
-
-    # bind queues
-    await tickets_queue.bind(exchange, routing_key="tickets.messages")
     await payments_queue.bind(exchange, routing_key="payments.messages")
+    payments_publisher.attach(exchange)
+    # Messages committed before a crash or a restart
+    await payments_publisher.poll(min_age=0)
+    publisher_task = asyncio.create_task(payments_publisher.run())
 
-    async def rabbitmq_listener():
-        async with tickets_queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    logger.info(f"Received message: {message.body}")
-                    # Process the message here
-                    await process_message(message.body)
-    
-    # Run RabbitMQ listener in the background
-    task = asyncio.create_task(rabbitmq_listener())
+    consumer_task = None
+    lag_task = None
+    if TICKETS_CONSUMER_IN_API:
+        await ticket_consumer.start(channel, tickets_queue)
+        consumer_task = asyncio.create_task(ticket_consumer.run())
+        lag_task = asyncio.create_task(ticket_consumer.report_lag())
+    flush_task = None
+    if reservation_engine is not None:
+        flush_task = asyncio.create_task(reservation_flusher())
+    await load_reservation_sweeper()
+    sweeper_task = asyncio.create_task(reservation_sweeper.run(AsyncSessionLocal))
     yield
     # Cleanup
+    if consumer_task is not None:
+        lag_task.cancel()
+        await ticket_consumer.stop()
+        await consumer_task
+    sweeper_task.cancel()
+    jwks_task.cancel()
+    price_cache_task.cancel()
+    if flush_task is not None:
+        flush_task.cancel()
+        await run_in_threadpool(flush_reservations)
+    await close_stripe_client()
+    publisher_task.cancel()
+    try:
+        await payments_publisher.drain()
+    except Exception as e:
+        # Still in the outbox, published by the next start
+        logger.error("Failed to publish buffered messages: %s", e)
     await channel.close()
     await connection.close()
-    # task.cancel()
-
-async def send_message(ticket_body):
-    logger.info(f"Sending message: {ticket_body} to payments.messages")
-    await exchange.publish(
-        routing_key="payments.messages",
-        message=Message(
-            body=json.dumps(ticket_body).encode()
-        ),
+    shutdown_tracing()
+
+async def warm_price_cache():
+    try:
+        async with AsyncSessionLocal() as db:
+            count = price_cache.warm(await async_crud.get_ticket_prices(db))
+        logger.info("Price cache warmed with %s prices", count)
+    except Exception as e:
+        # Checkout falls back to stripe.Price.retrieve for prices that aren't cached
+        logger.error("Failed to warm price cache: %s", e)
+
+async def refresh_price_cache(interval: float = PRICE_CACHE_REFRESH_INTERVAL):
+    """
+    Reload the prices of ``ticket_stock`` every ``interval`` seconds. Ticket events are
+    applied by the consumer worker, so this is how the API learns about new tickets.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await warm_price_cache()
+
+async def load_reservation_sweeper():
+    try:
+        async with AsyncSessionLocal() as db:
+            count = await reservation_sweeper.load(db)
+        logger.info("Reservation sweeper loaded %s open checkout sessions", count)
+    except Exception as e:
+        # Those sessions are still released by their checkout.session.expired webhook
+        logger.error("Failed to load open checkout sessions: %s", e)
+
+async def validate_price(price_id: str):
+    """
+    Make sure a price exists in Stripe, asking Stripe only for prices we don't know yet.
+
+    :raises stripe.error.InvalidRequestError: If Stripe doesn't know the price id.
+    """
+    if price_cache.get(price_id) is not None:
+        return
+    # stripe.Price.retrieve_async(price_id) throws exception if price id not found
+    with time_dependency("stripe", "retrieve_price"):
+        price = await stripe.Price.retrieve_async(price_id)
+    price_cache.put(price.id, unit_amount=price.unit_amount, currency=price.currency)
+
+async def get_client_reference_id(db, user_id: str) -> str:
+    """
+    Return the user's mapping uuid, only hitting the database for users not seen yet.
+    """
+    client_reference_id = known_user_mappings.get(user_id)
+    if client_reference_id is None:
+        user_mapping = await async_crud.get_or_create_user_mapping(db, user_id)
+        client_reference_id = user_mapping.uuid
+        known_user_mappings.set(user_id, client_reference_id)
+    return client_reference_id
+
+def flush_reservations():
+    # Runs in a thread, so the reservation engine keeps its sync session
+    db = SessionLocal()
+    try:
+        reservation_engine.flush(db)
+    finally:
+        db.close()
+
+async def reservation_flusher():
+    while True:
+        await asyncio.sleep(STOCK_FLUSH_INTERVAL)
+        try:
+            await run_in_threadpool(flush_reservations)
+        except Exception as e:
+            logger.error("Failed to flush stock reservations: %s", e)
+
+async def reserve_stock(db, quantities: dict[str, int]):
+    """
+    Reserve stock for every price id of a checkout, all or nothing.
+    """
+    if reservation_engine is not None:
+        await reservation_engine.reserve_many(db, quantities)
+    else:
+        await async_crud.decrement_stocks(db, quantities)
+
+async def release_stock(db, quantities: dict[str, int]):
+    if reservation_engine is not None:
+        for price_id, quantity in quantities.items():
+            reservation_engine.release(price_id, quantity)
+    else:
+        await async_crud.increment_stocks(db, quantities)
+
+async def send_messages(db, ticket_bodies: list[dict]) -> Callable[[], None]:
+    """
+    Add messages for payments.messages to the outbox, in the caller's transaction.
+
+    :return: What to run once they are committed, hands them to the publisher.
+    """
+    logger.info("Sending %s messages to payments.messages", len(ticket_bodies), extra=SAMPLED)
+    entries = await async_crud.add_outbox_messages(
+        db, "payments.messages", [json.dumps(body) for body in ticket_bodies], trace_headers()
     )
+    return lambda: payments_publisher.enqueue(entries)
+
+class CheckoutItem(BaseModel):
+    price_id: str
+    quantity: int = Field(gt=0)
+
+
+class BatchCheckoutRequest(BaseModel):
+    # Stripe accepts at most 100 line items per session
+    items: list[CheckoutItem] = Field(min_length=1, max_length=100)
+
 
 @router.post('/create-checkout-session', status_code=status.HTTP_200_OK, dependencies=[Depends(auth)])
-def create_checkout_session(price_id: str, quantity: int, user_id=Depends(get_current_user_id), db=Depends(get_db)):
+async def create_checkout_session(price_id: str, quantity: int, user_id=Depends(get_current_user_id), db=Depends(get_db)):
+    return await start_checkout(db, user_id, {price_id: quantity})
+
+
+@router.post('/create-checkout-session/batch', status_code=status.HTTP_200_OK, dependencies=[Depends(auth)])
+async def create_batch_checkout_session(body: BatchCheckoutRequest, user_id=Depends(get_current_user_id),
+                                        db=Depends(get_db)):
+    """
+    Create a single checkout session for tickets of several matches.
+    """
+    quantities = {}
+    for item in body.items:
+        quantities[item.price_id] = quantities.get(item.price_id, 0) + item.quantity
+    return await start_checkout(db, user_id, quantities)
+
+
+async def start_checkout(db, user_id: str, quantities: dict[str, int]):
+    """
+    Reserve the stock of every price id and create one Stripe session for all of them.
+
+    :param quantities: Mapping of stripe_price_id to the quantity bought.
+    """
+    if any(price_cache.is_missing(price_id) for price_id in quantities):
+        return Response(status_code=status.HTTP_404_NOT_FOUND, content="Price id not found")
 
-    logger.info("user mapping")
-    user_mapping = crud.create_user_mapping(db, user_id)
-    logger.info(user_mapping)
+    ensure_stripe_client()
 
-    # Decrement stock function needs to be implemented here
-    decrement_stock(db, price_id, quantity)
+    client_reference_id = await get_client_reference_id(db, user_id)
 
     try:
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[
-                {
-                    # stripe.Price.retrieve(price_id) throws exception if price id not found
-                    # stripe will retrieve the product associated with this price in checkout page sent in redirect
-                    'price': stripe.Price.retrieve(price_id).id,
-                    'quantity': quantity,
-                },
-            ],
-            mode='payment',
-            success_url=DOMAIN + '/checkout-success',
-            cancel_url=DOMAIN + '/checkout-canceled',
-            expires_at=int(time.time() + expire_time),
-            client_reference_id=user_mapping.uuid,
-        )
+        await reserve_stock(db, quantities)
+    except HTTPException as e:
+        # The error doesn't say which price is unknown when there are several
+        if e.status_code == status.HTTP_404_NOT_FOUND and len(quantities) == 1:
+            price_cache.mark_missing(next(iter(quantities)))
+        raise
+
+    line_items = list(quantities.items())
+    expires_at = int(time.time() + expire_time)
+    try:
+        for price_id in quantities:
+            await validate_price(price_id)
+        with time_dependency("stripe", "create_checkout_session"):
+            checkout_session = await stripe.checkout.Session.create_async(
+                line_items=[
+                    {
+                        # stripe will retrieve the product associated with this price in checkout page sent in redirect
+                        'price': price_id,
+                        'quantity': quantity,
+                    }
+                    for price_id, quantity in line_items
+                ],
+                mode='payment',
+                success_url=DOMAIN + '/checkout-success',
+                cancel_url=DOMAIN + '/checkout-canceled',
+                expires_at=expires_at,
+                client_reference_id=client_reference_id,
+                # Lets the webhook resolve the user and line items without extra lookups
+                metadata=session_metadata(user_id, line_items),
+                expand=['line_items'],
+            )
     except stripe.error.InvalidRequestError as e:
         logger.error("Invalid price ID: %s", e)
-        increment_stock(db, price_id, quantity)
+        if e.code == "resource_missing":
+            # validate_price caches every price it accepts, so the first one left uncached is missing
+            uncached = [price_id for price_id in quantities if price_cache.get(price_id) is None]
+            if uncached:
+                price_cache.mark_missing(uncached[0])
+            elif len(quantities) == 1:
+                price_cache.mark_missing(line_items[0][0])
+        await release_stock(db, quantities)
         return Response(status_code=status.HTTP_404_NOT_FOUND, content="Price id not found")
     except Exception as e:
-        logger.error(f"Exception: {e}")
-        increment_stock(db, price_id, quantity)
+        logger.error("Exception: %s", e)
+        await release_stock(db, quantities)
         return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    await record_checkout_session(db, checkout_session, user_id, line_items, expires_at)
+
     return {"checkout_url": checkout_session.url}
 
 
@@ -132,7 +329,6 @@ async def webhooks(request: Request, db=Depends(get_db)):
     payload = await request.body()
     sig_header = request.headers.get("Stripe-Signature")
     event = None
-    logger.info(payload)
 
     try:
         event = stripe.Webhook.construct_event(
@@ -140,76 +336,233 @@ async def webhooks(request: Request, db=Depends(get_db)):
         )
     except ValueError as e:
         # Invalid payload
+        logger.warning("Invalid webhook payload: %s", payload_summary(payload))
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
     except stripe.error.SignatureVerificationError as e:
         # Invalid signature
-        logger.error('Error verifying webhook signature: {}'.format(str(e)))
+        logger.error("Error verifying webhook signature: %s", e)
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
-    # Handle the event
-    if event.type == "checkout.session.completed":
-        logger.info('Checkout session completed')
-        session = stripe.checkout.Session.retrieve(event.data.object.id, expand=['line_items'])
-        logger.info(session)
-        ticket_message_payload = {
+    # Only the type and id: the payload holds the customer's details
+    logger.info("Webhook event %s %s", event.type, event.id, extra=SAMPLED)
+    handler = EVENT_HANDLERS.get(event.type)
+    if handler is None:
+        logger.info("Unhandled event type %s", event.type)
+        return Response(status_code=status.HTTP_200_OK)
+
+    # Retried deliveries stop here, before any stock update or message
+    if event.id in processed_events or not await async_crud.claim_event(db, event.id, event.type):
+        return event_already_processed(event)
+
+    # The claim and the handler's changes are committed together: a failure or a
+    # crash before the commit leaves the event unclaimed for Stripe's retry
+    try:
+        on_commit = await handler(db, event)
+    except Exception:
+        await db.rollback()
+        raise
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Claimed and committed by another worker meanwhile
+        await db.rollback()
+        return event_already_processed(event)
+    processed_events.set(event.id, True)
+    for callback in on_commit:
+        callback()
+
+    return Response(status_code=status.HTTP_200_OK)
+
+def event_already_processed(event) -> Response:
+    logger.info("Event %s was already processed", event.id)
+    processed_events.set(event.id, True)
+    return Response(status_code=status.HTTP_200_OK)
+
+def stock_change_committed(deltas: dict[str, int]) -> Callable[[], None]:
+    """
+    What to run once a webhook committed a stock change. The reservation engine's
+    counters are only updated then, so a failed delivery can't change them twice.
+
+    :param deltas: Mapping of stripe_price_id to the amount given back (negative when taken).
+    """
+    def on_commit():
+        if reservation_engine is not None:
+            # A negative release is recorded as a pending decrement, like a reservation
+            for price_id, delta in deltas.items():
+                reservation_engine.release(price_id, delta)
+        else:
+            stock_cache.invalidate_prices(deltas)
+    return on_commit
+
+async def handle_checkout_session_completed(db, event):
+    """
+    Complete a session and send its tickets, without committing.
+
+    :return: What to run once the webhook committed.
+    """
+    session = event.data.object
+    logger.info("Checkout session %s completed", session.id, extra=SAMPLED)
+    on_commit = []
+    ledger_items = await async_crud.get_checkout_session_items(db, session.id)
+    if ledger_items:
+        retaken = await async_crud.complete_checkout_session(
+            db, session.id, apply_stock=reservation_engine is None, commit=False
+        )
+        if retaken:
+            logger.warning("Checkout session %s completed after being swept, its stock was taken back", session.id)
+            on_commit.append(stock_change_committed({price_id: -quantity for price_id, quantity in retaken.items()}))
+        user_id = ledger_items[0].user_id
+    else:
+        user_id = await get_session_user_id(db, session)
+    ticket_message_payloads = []
+    for line_item in await get_session_line_items(session, ledger_items):
+        ticket_message_payloads.append({
             "event": event.type,
-            "user_id": crud.get_user_mapping_by_uuid(db, session.client_reference_id).user_id,
-            "ticket_id": get_stock_ticket_id_by_price_id(db, session.line_items.data[0].price.id),
-            "quantity": session.line_items.data[0].quantity,
-            "unit_amount": session.line_items.data[0].price.unit_amount / 100,
+            "user_id": user_id,
+            "ticket_id": await async_crud.get_stock_ticket_id_by_price_id(db, line_item["price_id"]),
+            "quantity": line_item["quantity"],
+            "unit_amount": line_item["unit_amount"] / 100,
             "created_at": str(datetime.now()),
-        }
-        
-        await send_message(ticket_message_payload)
+        })
+    on_commit.append(await send_messages(db, ticket_message_payloads))
+    return on_commit
 
-    elif event.type == "checkout.session.expired":
-        logger.info('Checkout session expired')
-        session = stripe.checkout.Session.retrieve(event.data.object.id, expand=['line_items'])
-        price_id = session.line_items.data[0].price.id
-        quantity = session.line_items.data[0].quantity
-        increment_stock(db, price_id, quantity)
+async def handle_checkout_session_expired(db, event):
+    """
+    Expire a session and give its stock back, without committing.
 
+    :return: What to run once the webhook committed.
+    """
+    session = event.data.object
+    logger.info("Checkout session %s expired", session.id, extra=SAMPLED)
+    ledger_items = await async_crud.get_checkout_session_items(db, session.id)
+    if ledger_items:
+        released = await async_crud.expire_checkout_sessions(
+            db, [session.id], apply_stock=reservation_engine is None, commit=False
+        )
+        if not released:
+            logger.info("Checkout session %s was already closed", session.id)
+            return []
     else:
-        logger.info('Unhandled event type {}'.format(event.type))
+        released = {}
+        for line_item in await get_session_line_items(session):
+            released[line_item["price_id"]] = released.get(line_item["price_id"], 0) + line_item["quantity"]
+        if reservation_engine is None:
+            await async_crud.increment_stocks(db, released, commit=False)
+    return [stock_change_committed(released)]
 
-    return Response(status_code=status.HTTP_200_OK)
+EVENT_HANDLERS = {
+    "checkout.session.completed": handle_checkout_session_completed,
+    "checkout.session.expired": handle_checkout_session_expired,
+}
+
+def session_metadata(user_id: str, line_items: list[tuple[str, int]]) -> dict:
+    """
+    Metadata written on every checkout session so its webhooks can be handled
+    without calling Stripe back.
+    """
+    items = []
+    for price_id, quantity in line_items:
+        item = {"price_id": price_id, "quantity": quantity}
+        price = price_cache.get(price_id)
+        if price is not None and price.unit_amount is not None:
+            item["unit_amount"] = price.unit_amount
+        items.append(item)
+    metadata = {"user_id": user_id}
+    items_json = json.dumps(items)
+    # Longer values are rejected by Stripe; the webhook then reads the ledger instead
+    if len(items_json) <= STRIPE_METADATA_VALUE_MAX_LENGTH:
+        metadata["items"] = items_json
+    return metadata
+
+async def record_checkout_session(db, checkout_session, user_id: str,
+                                  line_items: list[tuple[str, int]], expires_at: int):
+    """
+    Write a newly created session to the checkout_session ledger.
+    """
+    # Sessions are created with expand=['line_items'], so Stripe already told us the unit amounts
+    unit_amounts = {
+        line_item.price.id: line_item.price.unit_amount
+        for line_item in checkout_session.line_items.data
+    } if checkout_session.get("line_items") else {}
+    items = []
+    for price_id, quantity in line_items:
+        unit_amount = unit_amounts.get(price_id)
+        if unit_amount is not None:
+            price_cache.put(price_id, unit_amount=unit_amount)
+        else:
+            price = price_cache.get(price_id)
+            unit_amount = price.unit_amount if price is not None else None
+        items.append({"price_id": price_id, "quantity": quantity, "unit_amount": unit_amount})
+
+    try:
+        await async_crud.create_checkout_session_items(
+            db, checkout_session.id, user_id, items,
+            datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None),
+        )
+        reservation_sweeper.schedule(checkout_session.id, expires_at)
+    except Exception as e:
+        # The webhook falls back to the session metadata for sessions missing from the ledger
+        logger.error("Failed to record checkout session %s: %s", checkout_session.id, e)
+        await db.rollback()
+
+async def get_session_line_items(session, ledger_items=()) -> list[dict]:
+    """
+    Return the price_id, quantity and unit_amount (in cents) of every line item of a session.
+
+    Read from the checkout_session ledger or the session metadata; Stripe is only asked
+    for sessions created without either.
+    """
+    if ledger_items:
+        line_items = [
+            {"price_id": item.price_id, "quantity": item.quantity, "unit_amount": item.unit_amount}
+            for item in ledger_items
+        ]
+    else:
+        items = (session.metadata or {}).get("items")
+        line_items = json.loads(items) if items is not None else None
+
+    if line_items is not None:
+        if len(line_items) == 1 and line_items[0].get("unit_amount") is None:
+            line_items[0]["unit_amount"] = session.amount_subtotal // line_items[0]["quantity"]
+        if all(line_item.get("unit_amount") is not None for line_item in line_items):
+            return line_items
+
+    ensure_stripe_client()
+    with time_dependency("stripe", "retrieve_checkout_session"):
+        session = await stripe.checkout.Session.retrieve_async(session.id, expand=['line_items'])
+    return [
+        {
+            "price_id": line_item.price.id,
+            "quantity": line_item.quantity,
+            "unit_amount": line_item.price.unit_amount,
+        }
+        for line_item in session.line_items.data
+    ]
+
+async def get_session_user_id(db, session) -> str:
+    # Sessions created before user_id was written to the metadata need the lookup
+    user_id = (session.metadata or {}).get("user_id")
+    if user_id is None:
+        user_id = (await async_crud.get_user_mapping_by_uuid(db, session.client_reference_id)).user_id
+    return user_id
+
+async def load_stock(ticket_id: int) -> int:
+    # Its own session: a coalesced load outlives the request that started it
+    async with AsyncSessionLocal() as db:
+        return (await async_crud.get_stock_by_ticket_id(db, ticket_id))["stock"]
 
 @router.get("/stock/{ticket_id}")
-def get_stock(ticket_id: int, db=Depends(get_db)):
+async def get_stock(ticket_id: int, request: Request):
     try:
-        stock = get_stock_by_ticket_id(db, ticket_id)
+        stock = await stock_cache.get(ticket_id, load_stock)
     except Exception as e:
-        logger.error(e)
+        logger.error("Failed to load the stock of ticket %s: %s", ticket_id, e)
         return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    return stock
-
-
-async def process_message(body):
-    message = json.loads(body)
-    event = message.get("event")
-    if event == "ticket_created":
-        ticket_id = message.get("ticket_id")
-        stripe_price_id = message.get("stripe_price_id")
-        stock = message.get("stock")
-        if ticket_id and stripe_price_id and stock is not None:
-            db = next(get_db())
-            try:
-                create_ticket_stock(db, ticket_id, stripe_price_id, stock)
-                logger.info(f"TicketStock created: ticket_id={ticket_id}, stripe_price_id={stripe_price_id}, stock={stock}")
-            finally:
-                db.close()
-    elif event == "ticket_stock_updated":
-        ticket_id = message.get("ticket_id")
-        stock = message.get("stock")
-        if ticket_id and stock is not None:
-            db = next(get_db())
-            try:
-                update_ticket_stock(db, ticket_id, stock)
-                logger.info(f"TicketStock updated: ticket_id={ticket_id}, stock={stock}")
-            finally:
-                db.close()
-    else:
-        logger.info(f"Unhandled event: {event}")
+    headers = {"ETag": f'"{ticket_id}-{stock}"', "Cache-Control": f"public, max-age={STOCK_CACHE_MAX_AGE}"}
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return JSONResponse({"stock": stock}, headers=headers)
 
 
 # # get tickets stocks for testing purposes
@@ -0,0 +1,136 @@
+"""
+Logging setup shared by the API and the tickets consumer.
+
+Modules only create their logger, ``logging.getLogger(__name__)``, and log with
+%-style arguments. :func:`setup_logging` gives the root logger a handler that
+puts records on an in-memory queue; a background thread formats them, as JSON
+lines by default, and writes them to stdout. Requests never wait on stdout, and
+arguments are only formatted for lines that are written.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json, or text for a human readable line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Records waiting to be written; past it new records are dropped instead of blocking the caller
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Share of the high-volume lines, e.g. one per checkout, that are written
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+
+# extra= of high-volume lines, only LOG_SAMPLE_RATE of them are written
+SAMPLED = {"sample_rate": LOG_SAMPLE_RATE}
+
+# Attributes of every LogRecord, anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName", "sample_rate"}
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the fields passed with ``extra=``.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        line.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep records logged with a ``sample_rate`` extra with that probability, every other record always.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_rate = getattr(record, "sample_rate", None)
+        return sample_rate is None or random.random() < sample_rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queues records as they are, so their message is only formatted by the listener thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The traceback can't wait, the frames it refers to move on
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT, stream=None) -> QueueListener:
+    """
+    Route every log record through a queue to a background thread writing to ``stream``, stdout by default.
+    Calling it again returns the running listener.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s %(message)s"
+    ))
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """
+    Write the records still queued and stop the listener thread.
+    """
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if isinstance(handler, NonBlockingQueueHandler)]:
+        root.removeHandler(handler)
+
+
+def payload_summary(payload: bytes) -> str:
+    """
+    Size and digest of a payload, to tell payloads apart in logs without writing their content.
+    """
+    return f"{len(payload)} bytes, sha256 {hashlib.sha256(payload).hexdigest()[:16]}"
@@ -0,0 +1,138 @@
+"""
+Prometheus metrics of the API and the tickets consumer.
+
+The API serves them on ``/metrics``; with several worker processes, point
+PROMETHEUS_MULTIPROC_DIR to a directory shared by them so every scrape
+aggregates all workers. The consumer serves them on CONSUMER_METRICS_PORT.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from services.tracing import span
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+HANDLER_LATENCY = Histogram(
+    "payments_handler_duration_seconds",
+    "Time spent handling a request or a batch of ticket events, by handler.",
+    ["handler"],
+)
+DEPENDENCY_LATENCY = Histogram(
+    "payments_dependency_duration_seconds",
+    "Time spent waiting on Stripe, Cognito, the database or RabbitMQ, by operation.",
+    ["dependency", "operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+STOCK_RESERVATIONS = Counter(
+    "payments_stock_reservations_total",
+    "Stock reservations by price id and result: success, out_of_stock or not_found.",
+    ["price_id", "result"],
+)
+TICKETS_CONSUMER_LAG = Gauge(
+    "payments_tickets_consumer_lag",
+    "Ticket events waiting in the TICKETS queue or in the consumer's buffer.",
+    multiprocess_mode="max",
+)
+STOCK_CACHE_LOOKUPS = Counter(
+    "payments_stock_cache_lookups_total",
+    "Stock cache lookups by result: hit, miss or coalesced into a load already running. "
+    "The hit rate is (hit + coalesced) / all lookups.",
+    ["result"],
+)
+
+RESERVATION_SUCCESS = "success"
+RESERVATION_OUT_OF_STOCK = "out_of_stock"
+RESERVATION_NOT_FOUND = "not_found"
+
+STOCK_CACHE_HIT = "hit"
+STOCK_CACHE_MISS = "miss"
+STOCK_CACHE_COALESCED = "coalesced"
+
+
+@contextmanager
+def time_dependency(dependency: str, operation: str, parent: Optional[dict] = None, kind: str = "client"):
+    """
+    Time a call to ``dependency``, traced as a ``dependency.operation`` span.
+
+    :param parent: Trace context headers the span continues, see :func:`services.tracing.span`.
+    """
+    with span(f"{dependency}.{operation}", parent=parent, kind=kind), \
+            DEPENDENCY_LATENCY.labels(dependency, operation).time():
+        yield
+
+
+def record_reservation(price_id: str, result: str):
+    # Unknown price ids come from the client, they would add a series each
+    if result == RESERVATION_NOT_FOUND:
+        price_id = "unknown"
+    STOCK_RESERVATIONS.labels(price_id, result).inc()
+
+
+def record_reservation_failure(price_id: str, status_code: int):
+    """
+    Count a reservation rejected with ``status_code``, 404 for an unknown price and 400 for missing stock.
+    """
+    record_reservation(price_id, RESERVATION_NOT_FOUND if status_code == 404 else RESERVATION_OUT_OF_STOCK)
+
+
+def instrument_engine(engine: Engine):
+    """
+    Time every statement run by ``engine``, by SQL verb. Pass ``sync_engine`` for an async engine.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start_time"].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "unknown"
+        DEPENDENCY_LATENCY.labels("db", operation).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start_time"):
+            context.connection.info["query_start_time"].pop()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request by the name of the endpoint it matched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # Set by the router once a route matched
+            route = scope.get("route")
+            if route is not None:
+                HANDLER_LATENCY.labels(route.name).observe(time.perf_counter() - started)
+
+
+def metrics_payload() -> tuple[bytes, str]:
+    """
+    :return: The metrics in the Prometheus text format, and their content type.
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
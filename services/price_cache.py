@@ -0,0 +1,73 @@
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from services.cache import TTLCache
+
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", "10000"))
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "3600"))  # in seconds
+# Kept short so a price rejected just before its ticket_created event reaches
+# this worker becomes valid again quickly.
+PRICE_CACHE_NEGATIVE_TTL = float(os.getenv("PRICE_CACHE_NEGATIVE_TTL", "30"))  # in seconds
+# How often the API reloads the prices of ticket_stock, picking up tickets created through the consumer worker
+PRICE_CACHE_REFRESH_INTERVAL = float(os.getenv("PRICE_CACHE_REFRESH_INTERVAL", "60"))  # in seconds
+
+
+@dataclass(frozen=True)
+class PriceInfo:
+    price_id: str
+    ticket_id: Optional[int] = None
+    unit_amount: Optional[int] = None
+    currency: Optional[str] = None
+
+
+class PriceCache:
+    """
+    Stripe price ids known to be valid, plus a short-lived negative cache of
+    ids known to be invalid.
+    """
+
+    def __init__(self, maxsize: int = PRICE_CACHE_SIZE, ttl: float = PRICE_CACHE_TTL,
+                 negative_ttl: float = PRICE_CACHE_NEGATIVE_TTL):
+        self._known = TTLCache(maxsize, ttl)
+        self._missing = TTLCache(maxsize, negative_ttl)
+
+    def get(self, price_id: str) -> Optional[PriceInfo]:
+        return self._known.get(price_id)
+
+    def put(self, price_id: str, ticket_id: Optional[int] = None,
+            unit_amount: Optional[int] = None, currency: Optional[str] = None) -> PriceInfo:
+        """
+        Record a valid price. Fields left as None keep the value already cached.
+        """
+        cached = self._known.get(price_id)
+        if cached is not None:
+            ticket_id = cached.ticket_id if ticket_id is None else ticket_id
+            unit_amount = cached.unit_amount if unit_amount is None else unit_amount
+            currency = cached.currency if currency is None else currency
+        price = PriceInfo(price_id, ticket_id, unit_amount, currency)
+        self._known.set(price_id, price)
+        self._missing.pop(price_id)
+        return price
+
+    def warm(self, ticket_prices: Iterable[tuple[int, str]]) -> int:
+        """
+        Pre-load (ticket_id, stripe_price_id) pairs read from ``ticket_stock``.
+
+        :return: Number of prices loaded.
+        """
+        count = 0
+        for ticket_id, price_id in ticket_prices:
+            self.put(price_id, ticket_id=ticket_id)
+            count += 1
+        return count
+
+    def mark_missing(self, price_id: str):
+        self._known.pop(price_id)
+        self._missing.set(price_id, True)
+
+    def is_missing(self, price_id: str) -> bool:
+        return price_id in self._missing
+
+
+price_cache = PriceCache()
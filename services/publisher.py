@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import timedelta
+from typing import Optional
+
+from crud import async_crud
+from models.models import utcnow
+from services.lazy import lazy_import
+from services.metrics import time_dependency
+from services.tracing import trace_headers
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "100"))
+# How long to wait for a batch to fill up once its first message was handed over
+PUBLISH_BATCH_LINGER = float(os.getenv("PUBLISH_BATCH_LINGER", "0.01"))  # in seconds
+# Messages waiting in memory; past it new messages are left to the outbox poll
+PUBLISH_BUFFER_SIZE = int(os.getenv("PUBLISH_BUFFER_SIZE", "10000"))
+# Outbox rows older than this are assumed lost by their worker, e.g. nacked or crashed, and published again
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "30"))  # in seconds
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))  # in seconds
+
+aio_pika = lazy_import("aio_pika")
+
+# (outbox id, routing key, body, trace context headers)
+OutboxEntry = tuple[int, str, str, Optional[dict]]
+
+
+class OutboxPublisher:
+    """
+    Publishes the outbox_message table to RabbitMQ with publisher confirms.
+
+    Messages committed by a request are handed over in memory and published
+    within ``linger`` seconds, up to ``batch_size`` at a time: the publishes of
+    a batch are awaited together and the confirmed rows deleted in one
+    statement. A batch only starts once the previous one is confirmed, and past
+    ``buffer_size`` waiting messages new ones are left in the table, so a slow
+    broker slows the publisher down rather than the webhooks. Rows left behind
+    by a nack or a crash are polled back after ``retry_delay`` seconds.
+
+    Delivery is at least once; every message carries its outbox id as message_id.
+    """
+
+    def __init__(self, session_factory, batch_size: int = PUBLISH_BATCH_SIZE, linger: float = PUBLISH_BATCH_LINGER,
+                 buffer_size: int = PUBLISH_BUFFER_SIZE, retry_delay: float = OUTBOX_RETRY_DELAY,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.linger = linger
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.exchange = None
+        self._messages: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        # Ids waiting in memory or being published, so a poll doesn't queue them twice
+        self._queued: set[int] = set()
+        self._polled_at = float("-inf")
+
+    def attach(self, exchange):
+        self.exchange = exchange
+
+    def enqueue(self, entries: list[OutboxEntry]) -> int:
+        """
+        Hand committed outbox messages over for publishing, without waiting.
+
+        :return: Number of messages queued, the others stay in the table for the next poll.
+        """
+        queued = 0
+        for index, entry in enumerate(entries):
+            if entry[0] in self._queued:
+                continue
+            try:
+                self._messages.put_nowait(entry)
+            except asyncio.QueueFull:
+                logger.warning("Publish buffer full, %s messages left in the outbox", len(entries) - index)
+                break
+            self._queued.add(entry[0])
+            queued += 1
+        return queued
+
+    async def next_batch(self, timeout: Optional[float] = None) -> list[OutboxEntry]:
+        """
+        Wait up to ``timeout`` seconds for a message, then for up to ``batch_size`` messages or ``linger`` seconds.
+        """
+        try:
+            batch = [await asyncio.wait_for(self._messages.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        deadline = asyncio.get_running_loop().time() + self.linger
+        while len(batch) < self.batch_size:
+            if self._messages.empty():
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._messages.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._messages.get_nowait())
+        return batch
+
+    async def publish(self, entry: OutboxEntry):
+        """
+        Publish one message and wait for its confirm.
+        """
+        message_id, routing_key, body, headers = entry
+        # A child of the request that wrote the message, whose context goes on to the consumers
+        with time_dependency("rabbitmq", "publish", parent=headers, kind="producer"):
+            await self.exchange.publish(
+                aio_pika.Message(
+                    body=body.encode(),
+                    message_id=str(message_id),
+                    content_type="application/json",
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    headers=trace_headers(),
+                ),
+                routing_key=routing_key,
+            )
+
+    async def publish_batch(self, batch: list[OutboxEntry]) -> list[int]:
+        """
+        Publish a batch, waiting for all of its confirms, and delete the confirmed rows.
+
+        :return: Ids of the messages the broker confirmed.
+        """
+        try:
+            results = await asyncio.gather(*map(self.publish, batch), return_exceptions=True)
+            published = [entry[0] for entry, result in zip(batch, results) if not isinstance(result, BaseException)]
+            if len(published) < len(batch):
+                errors = {repr(result) for result in results if isinstance(result, BaseException)}
+                logger.error("%s messages were not confirmed, retrying later: %s", len(batch) - len(published), errors)
+            if published:
+                try:
+                    async with self.session_factory() as db:
+                        await async_crud.delete_outbox_messages(db, published)
+                except Exception as e:
+                    # They will be published again, consumers dedupe on message_id
+                    logger.error("Failed to delete %s published outbox messages: %s", len(published), e)
+            return published
+        finally:
+            self._queued.difference_update(entry[0] for entry in batch)
+
+    async def poll(self, min_age: Optional[float] = None) -> int:
+        """
+        Queue outbox messages older than ``min_age`` seconds, ``retry_delay`` by default.
+
+        :return: Number of messages queued.
+        """
+        min_age = self.retry_delay if min_age is None else min_age
+        self._polled_at = asyncio.get_running_loop().time()
+        async with self.session_factory() as db:
+            messages = await async_crud.get_outbox_messages(
+                db, utcnow() - timedelta(seconds=min_age), self.batch_size
+            )
+        return self.enqueue([
+            (message.id, message.routing_key, message.body, json.loads(message.headers) if message.headers else None)
+            for message in messages
+        ])
+
+    async def run(self):
+        """
+        Publish queued messages, polling the outbox when idle and at least every ``poll_interval`` seconds.
+        """
+        while True:
+            batch = await self.next_batch(self.poll_interval)
+            if batch:
+                await self.publish_batch(batch)
+            if not batch or asyncio.get_running_loop().time() - self._polled_at >= self.poll_interval:
+                try:
+                    await self.poll()
+                except Exception as e:
+                    logger.error("Failed to poll the outbox: %s", e)
+
+    async def drain(self):
+        """
+        Publish the messages still in memory, e.g. before closing the channel.
+        """
+        while not self._messages.empty():
+            batch = [self._messages.get_nowait() for _ in range(min(self.batch_size, self._messages.qsize()))]
+            await self.publish_batch(batch)
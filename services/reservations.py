@@ -0,0 +1,292 @@
+import asyncio
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from crud import async_crud, crud
+from services.metrics import (RESERVATION_SUCCESS, record_reservation,
+                              record_reservation_failure)
+from services.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+STOCK_RESERVATION_ENGINE = os.getenv("STOCK_RESERVATION_ENGINE", "")
+STOCK_FLUSH_INTERVAL = float(os.getenv("STOCK_FLUSH_INTERVAL", "0.5"))  # in seconds
+
+
+class MemoryStockStore:
+    """
+    Process-local counters. Only safe when a single process serves checkouts,
+    and consumes the TICKETS queue so they get reconciled.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._available: Dict[str, int] = {}
+        self._pending: Dict[str, int] = {}
+
+    def get(self, price_id: str) -> Optional[int]:
+        with self._lock:
+            return self._available.get(price_id)
+
+    def seed(self, price_id: str, stock: int):
+        with self._lock:
+            self._available.setdefault(price_id, stock + self._pending.get(price_id, 0))
+
+    def reconcile(self, price_id: str, stock: int):
+        with self._lock:
+            self._available[price_id] = stock + self._pending.get(price_id, 0)
+
+    def try_reserve(self, price_id: str, quantity: int) -> Optional[bool]:
+        with self._lock:
+            available = self._available.get(price_id)
+            if available is None:
+                return None
+            if available < quantity:
+                return False
+            self._available[price_id] = available - quantity
+            self._pending[price_id] = self._pending.get(price_id, 0) - quantity
+            return True
+
+    def release(self, price_id: str, quantity: int):
+        with self._lock:
+            if price_id in self._available:
+                self._available[price_id] += quantity
+            self._pending[price_id] = self._pending.get(price_id, 0) + quantity
+
+    def take_pending(self) -> Dict[str, int]:
+        with self._lock:
+            pending = {price_id: delta for price_id, delta in self._pending.items() if delta}
+            self._pending.clear()
+            return pending
+
+    def restore_pending(self, deltas: Dict[str, int]):
+        with self._lock:
+            for price_id, delta in deltas.items():
+                self._pending[price_id] = self._pending.get(price_id, 0) + delta
+
+
+class SQLiteStockStore:
+    """
+    Counters kept in a SQLite file so every worker on the host shares them.
+    Each operation is a single statement, so SQLite's write lock makes it atomic.
+    A NULL ``available`` means the counter hasn't been loaded from MySQL yet.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stock_counters ("
+                "price_id TEXT PRIMARY KEY, "
+                "available INTEGER, "
+                "pending INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, price_id: str) -> Optional[int]:
+        row = self._connection().execute(
+            "SELECT available FROM stock_counters WHERE price_id = ?", (price_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def seed(self, price_id: str, stock: int):
+        self._connection().execute(
+            "INSERT INTO stock_counters (price_id, available) VALUES (?, ?) "
+            "ON CONFLICT(price_id) DO UPDATE SET available = excluded.available + pending "
+            "WHERE available IS NULL",
+            (price_id, stock),
+        )
+
+    def reconcile(self, price_id: str, stock: int):
+        self._connection().execute(
+            "INSERT INTO stock_counters (price_id, available) VALUES (?, ?) "
+            "ON CONFLICT(price_id) DO UPDATE SET available = excluded.available + pending",
+            (price_id, stock),
+        )
+
+    def try_reserve(self, price_id: str, quantity: int) -> Optional[bool]:
+        conn = self._connection()
+        cursor = conn.execute(
+            "UPDATE stock_counters SET available = available - ?, pending = pending - ? "
+            "WHERE price_id = ? AND available >= ?",
+            (quantity, quantity, price_id, quantity),
+        )
+        if cursor.rowcount:
+            return True
+        return None if self.get(price_id) is None else False
+
+    def release(self, price_id: str, quantity: int):
+        self._connection().execute(
+            "INSERT INTO stock_counters (price_id, available, pending) VALUES (?, NULL, ?) "
+            "ON CONFLICT(price_id) DO UPDATE SET "
+            "available = available + excluded.pending, pending = pending + excluded.pending",
+            (price_id, quantity),
+        )
+
+    def take_pending(self) -> Dict[str, int]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT price_id, pending FROM stock_counters WHERE pending != 0"
+            ).fetchall()
+            conn.execute("UPDATE stock_counters SET pending = 0 WHERE pending != 0")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return dict(rows)
+
+    def restore_pending(self, deltas: Dict[str, int]):
+        self._connection().executemany(
+            "UPDATE stock_counters SET pending = pending + ? WHERE price_id = ?",
+            [(delta, price_id) for price_id, delta in deltas.items()],
+        )
+
+
+class StockReservationEngine:
+    """
+    Decides reservations against in-memory counters and writes the resulting
+    deltas back to ``ticket_stock`` in batches (write-behind).
+
+    Counters are loaded lazily from MySQL on the first reservation for a price and
+    are kept in line with the tickets service through :meth:`reconcile`. Releases
+    never touch the database: they are recorded as pending deltas even for prices
+    whose counter isn't loaded yet.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._flush_lock = threading.Lock()
+
+    async def reserve(self, db: AsyncSession, price_id: str, quantity: int):
+        """
+        Reserve stock for a price id.
+
+        :raises HTTPException: 404 if the price is unknown, 400 if there isn't enough stock.
+        """
+        reserved = self.store.try_reserve(price_id, quantity)
+        if reserved is None:
+            await self._load(db, price_id)
+            reserved = self.store.try_reserve(price_id, quantity)
+
+        if not reserved:
+            logger.info("Couldn't decrement stock by %s. Not enough stock.", quantity)
+            raise HTTPException(status_code=400, detail="Not enough stock")
+
+    async def _load(self, db: AsyncSession, price_id: str):
+        """
+        Seed the counter of a price from ``ticket_stock``.
+
+        The read and the seed run under the flush lock: a delta flushed in between
+        would be in neither the stock read nor the pending deltas added to it.
+
+        :raises HTTPException: 404 if the price is unknown.
+        """
+        async with self.reconciling():
+            stock = (await async_crud.get_stock_by_price_id(db, price_id))["stock"]
+            self.store.seed(price_id, stock)
+
+    @contextlib.asynccontextmanager
+    async def reconciling(self):
+        """
+        Hold off flushes while ``ticket_stock`` is read or written and counters are set from it.
+        """
+        # Polled rather than awaited in a thread, so a cancelled request can't leave it held
+        while not self._flush_lock.acquire(blocking=False):
+            await asyncio.sleep(0.001)
+        try:
+            yield
+        finally:
+            self._flush_lock.release()
+
+    @traced("reservations.reserve_many")
+    async def reserve_many(self, db: AsyncSession, quantities: Dict[str, int]):
+        """
+        Reserve stock for several price ids, all or nothing.
+
+        :raises HTTPException: As :meth:`reserve`, after giving back what was already reserved.
+        """
+        reserved = []
+        try:
+            for price_id in sorted(quantities):
+                await self.reserve(db, price_id, quantities[price_id])
+                reserved.append(price_id)
+        except HTTPException as e:
+            record_reservation_failure(price_id, e.status_code)
+            for price_id in reserved:
+                self.release(price_id, quantities[price_id])
+            raise
+        for price_id in reserved:
+            record_reservation(price_id, RESERVATION_SUCCESS)
+
+    def release(self, price_id: str, quantity: int):
+        """
+        Give reserved stock back.
+        """
+        self.store.release(price_id, quantity)
+
+    def reconcile(self, price_id: str, stock: int):
+        """
+        Align the counter with an absolute stock value written to ``ticket_stock``
+        by the tickets service. Deltas not yet flushed are applied on top of it.
+
+        Write the stock and reconcile inside :meth:`reconciling`, or a flush in
+        between would apply its deltas to the stock but no longer to the counter.
+        """
+        self.store.reconcile(price_id, stock)
+
+    def flush(self, db: Session) -> Dict[str, int]:
+        """
+        Write pending deltas to ``ticket_stock`` in a single transaction.
+
+        :return: The deltas that were written.
+        """
+        with self._flush_lock:
+            deltas = self.store.take_pending()
+            if not deltas:
+                return deltas
+            try:
+                crud.apply_stock_deltas(db, deltas)
+            except Exception:
+                self.store.restore_pending(deltas)
+                raise
+            logger.info("Flushed stock deltas for %s price ids", len(deltas))
+            return deltas
+
+
+def create_engine_from_env(setting: str = STOCK_RESERVATION_ENGINE) -> Optional[StockReservationEngine]:
+    """
+    Build the reservation engine configured by ``STOCK_RESERVATION_ENGINE``.
+
+    ``memory`` keeps counters in process, ``sqlite:///path`` shares them through a
+    SQLite file. Anything else disables the engine.
+    """
+    if setting == "memory":
+        return StockReservationEngine(MemoryStockStore())
+    if setting.startswith("sqlite:///"):
+        return StockReservationEngine(SQLiteStockStore(setting[len("sqlite:///"):]))
+    return None
+
+
+reservation_engine = create_engine_from_env()
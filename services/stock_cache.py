@@ -0,0 +1,77 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Iterable
+
+from services.cache import TTLCache
+from services.metrics import (STOCK_CACHE_COALESCED, STOCK_CACHE_HIT,
+                              STOCK_CACHE_LOOKUPS, STOCK_CACHE_MISS)
+from services.price_cache import price_cache
+
+STOCK_CACHE_SIZE = int(os.getenv("STOCK_CACHE_SIZE", "10000"))
+# Short, since writes from other processes (the tickets consumer, other workers) only expire with it
+STOCK_CACHE_TTL = float(os.getenv("STOCK_CACHE_TTL", "1"))  # in seconds
+
+
+class StockCache:
+    """
+    Read-through cache of ``ticket_stock.stock`` by ticket_id.
+
+    Concurrent misses for a ticket share a single load. Local stock writes
+    invalidate the ticket, or the whole cache when its ticket_id is unknown, and
+    a load started before an invalidation is returned but not cached.
+    """
+
+    def __init__(self, maxsize: int = STOCK_CACHE_SIZE, ttl: float = STOCK_CACHE_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._generation = 0
+
+    async def get(self, ticket_id: int, loader: Callable[[int], Awaitable[int]]) -> int:
+        """
+        Cached stock of a ticket, calling ``loader(ticket_id)`` on a miss.
+        """
+        stock = self._cache.get(ticket_id)
+        if stock is not None:
+            STOCK_CACHE_LOOKUPS.labels(STOCK_CACHE_HIT).inc()
+            return stock
+        loading = self._loading.get(ticket_id)
+        if loading is not None:
+            STOCK_CACHE_LOOKUPS.labels(STOCK_CACHE_COALESCED).inc()
+            return await asyncio.shield(loading)
+
+        STOCK_CACHE_LOOKUPS.labels(STOCK_CACHE_MISS).inc()
+        generation = self._generation
+        loading = asyncio.ensure_future(loader(ticket_id))
+        self._loading[ticket_id] = loading
+        try:
+            # Shielded, so a cancelled request doesn't fail the requests waiting on it
+            stock = await asyncio.shield(loading)
+        finally:
+            if self._loading.get(ticket_id) is loading:
+                del self._loading[ticket_id]
+        if generation == self._generation:
+            self._cache.set(ticket_id, stock)
+        return stock
+
+    def invalidate(self, ticket_id: int):
+        self._generation += 1
+        self._cache.pop(ticket_id)
+
+    def invalidate_prices(self, price_ids: Iterable[str]):
+        """
+        Invalidate the tickets of stripe price ids written to.
+        """
+        self._generation += 1
+        for price_id in price_ids:
+            price = price_cache.get(price_id)
+            if price is None or price.ticket_id is None:
+                self._cache.clear()
+                return
+            self._cache.pop(price.ticket_id)
+
+    def clear(self):
+        self._generation += 1
+        self._cache.clear()
+
+
+stock_cache = StockCache()
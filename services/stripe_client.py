@@ -0,0 +1,53 @@
+import os
+from typing import Optional
+
+from services.lazy import lazy_import
+
+# Importing stripe takes longer than the rest of the app together, so it is
+# only loaded by the first request that talks to Stripe.
+stripe = lazy_import("stripe")
+
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")  # e.g. a local stripe-mock for tests
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "30"))  # in seconds
+
+stripe.api_key = os.getenv("STRIPE_API_KEY")
+if STRIPE_API_BASE:
+    stripe.api_base = STRIPE_API_BASE
+
+_http_client: Optional["stripe.HTTPXClient"] = None
+
+
+def open_stripe_client() -> "stripe.HTTPXClient":
+    """
+    Install a shared httpx-backed client for every Stripe call made by this process.
+
+    The async connection pool is bound to the running event loop, so this must be
+    called from inside it (see :func:`ensure_stripe_client`). Sync calls keep
+    working through the same client.
+    """
+    global _http_client
+    _http_client = stripe.HTTPXClient(timeout=STRIPE_TIMEOUT, allow_sync_methods=True)
+    stripe.default_http_client = _http_client
+    return _http_client
+
+
+def ensure_stripe_client():
+    """
+    Install the shared client unless it already is, loading stripe on first use.
+    """
+    if _http_client is None:
+        open_stripe_client()
+
+
+async def close_stripe_client():
+    """
+    Close the shared client's connection pools.
+    """
+    global _http_client
+    if _http_client is None:
+        return
+    await _http_client.close_async()
+    _http_client.close()
+    if stripe.default_http_client is _http_client:
+        stripe.default_http_client = None
+    _http_client = None
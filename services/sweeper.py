@@ -0,0 +1,128 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import timezone
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud import async_crud
+from services.reservations import StockReservationEngine, reservation_engine
+
+logger = logging.getLogger(__name__)
+
+# Stripe refuses payment once a session's expires_at has passed; the grace period
+# leaves time for a last-second checkout.session.completed webhook to land first.
+RESERVATION_SWEEP_GRACE = float(os.getenv("RESERVATION_SWEEP_GRACE", "60"))  # in seconds
+RESERVATION_SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", "30"))  # in seconds
+RESERVATION_SWEEP_BATCH_SIZE = int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", "500"))
+
+
+class ReservationSweeper:
+    """
+    Gives back the stock held by checkout sessions once they expire, without
+    waiting for Stripe's ``checkout.session.expired`` webhook.
+
+    Deadlines are kept in a min-heap of (deadline, session_id). Sessions are
+    expired in batches through the checkout_session ledger, whose conditional
+    status update makes the sweeper and a late webhook release a session's
+    stock exactly once between them.
+    """
+
+    def __init__(self, reservation_engine: Optional[StockReservationEngine] = None,
+                 grace: float = RESERVATION_SWEEP_GRACE, batch_size: int = RESERVATION_SWEEP_BATCH_SIZE,
+                 retry_delay: float = RESERVATION_SWEEP_INTERVAL, timer: Callable[[], float] = time.time):
+        self.reservation_engine = reservation_engine
+        self.grace = grace
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._timer = timer
+        self._heap: List[tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, session_id: str, expires_at: float):
+        """
+        Track a session until it expires.
+
+        :param expires_at: Unix timestamp at which Stripe expires the session.
+        """
+        heapq.heappush(self._heap, (expires_at + self.grace, session_id))
+
+    def next_deadline(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def has_due(self) -> bool:
+        return bool(self._heap) and self._heap[0][0] <= self._timer()
+
+    def pop_due(self) -> List[str]:
+        """
+        Remove and return up to ``batch_size`` sessions whose deadline has passed.
+        """
+        now = self._timer()
+        session_ids = []
+        while self._heap and self._heap[0][0] <= now and len(session_ids) < self.batch_size:
+            session_ids.append(heapq.heappop(self._heap)[1])
+        return session_ids
+
+    async def load(self, db: AsyncSession) -> int:
+        """
+        Schedule every session still open in the ledger, e.g. after a restart.
+
+        :return: Number of sessions scheduled.
+        """
+        open_sessions = await async_crud.get_open_checkout_sessions(db)
+        for session_id, expires_at in open_sessions:
+            # Stored as naive UTC
+            self.schedule(session_id, expires_at.replace(tzinfo=timezone.utc).timestamp())
+        return len(open_sessions)
+
+    async def sweep(self, db: AsyncSession) -> Dict[str, int]:
+        """
+        Expire one batch of due sessions and give their stock back.
+
+        :return: Stock released per price id.
+        """
+        session_ids = self.pop_due()
+        if not session_ids:
+            return {}
+        try:
+            deltas = await async_crud.expire_checkout_sessions(
+                db, session_ids, apply_stock=self.reservation_engine is None
+            )
+        except Exception:
+            await db.rollback()
+            retry_at = self._timer() + self.retry_delay
+            for session_id in session_ids:
+                heapq.heappush(self._heap, (retry_at, session_id))
+            raise
+
+        if self.reservation_engine is not None:
+            for price_id, quantity in deltas.items():
+                self.reservation_engine.release(price_id, quantity)
+        if deltas:
+            logger.info("Expired %s checkout sessions, released stock for %s price ids", len(session_ids), len(deltas))
+        return deltas
+
+    async def run(self, session_factory, interval: float = RESERVATION_SWEEP_INTERVAL):
+        """
+        Sweep forever, sleeping until the next deadline (at most ``interval`` seconds).
+        """
+        while True:
+            deadline = self.next_deadline()
+            delay = interval if deadline is None else min(interval, max(deadline - self._timer(), 0))
+            await asyncio.sleep(delay)
+            try:
+                async with session_factory() as db:
+                    while self.has_due():
+                        await self.sweep(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Failed to sweep expired checkout sessions: %s", e)
+
+
+reservation_sweeper = ReservationSweeper(reservation_engine)
@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from crud import async_crud
+from services.logs import SAMPLED
+from services.metrics import HANDLER_LATENCY, TICKETS_CONSUMER_LAG
+from services.price_cache import price_cache
+from services.reservations import StockReservationEngine
+from services.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+TICKETS_BATCH_SIZE = int(os.getenv("TICKETS_BATCH_SIZE", "100"))
+# How long to wait for a batch to fill up once its first message arrived
+TICKETS_BATCH_LINGER = float(os.getenv("TICKETS_BATCH_LINGER", "0.05"))  # in seconds
+TICKETS_PREFETCH = int(os.getenv("TICKETS_PREFETCH", str(2 * TICKETS_BATCH_SIZE)))
+# How often the backlog of the TICKETS queue is measured for the lag metric
+TICKETS_LAG_INTERVAL = float(os.getenv("TICKETS_LAG_INTERVAL", "15"))  # in seconds
+
+# Queued after the last delivery once the consumer is stopped
+_STOP = object()
+
+
+async def declare_tickets_queue(channel, exchange):
+    """
+    Declare the durable TICKETS queue and bind it to the tickets routing key.
+    """
+    queue = await channel.declare_queue("TICKETS", durable=True)
+    await queue.bind(exchange, routing_key="tickets.messages")
+    return queue
+
+
+def parse_ticket_event(body: bytes) -> Optional[dict]:
+    """
+    Decode a message from the TICKETS queue.
+
+    :return: The event, or None if it isn't a complete ticket_created or ticket_stock_updated event.
+    """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        logger.error("Invalid message: %r", body)
+        return None
+    event = message.get("event")
+    if event == "ticket_created":
+        if message.get("ticket_id") and message.get("stripe_price_id") and message.get("stock") is not None:
+            return message
+    elif event == "ticket_stock_updated":
+        if message.get("ticket_id") and message.get("stock") is not None:
+            return message
+    else:
+        logger.info("Unhandled event: %s", event)
+    return None
+
+
+def coalesce_ticket_events(events: List[dict]) -> tuple[Dict[int, dict], Dict[int, dict]]:
+    """
+    Reduce a batch of events, in delivery order, to the newest state of every ticket.
+    Events without a version are version 0, so they keep applying in delivery order.
+
+    :return: Tickets to insert or overwrite, and stock and version of tickets that must already exist, by ticket_id.
+    """
+    upserts: Dict[int, dict] = {}
+    updates: Dict[int, dict] = {}
+    for event in events:
+        ticket_id = event["ticket_id"]
+        version = int(event.get("version") or 0)
+        latest = upserts.get(ticket_id) or updates.get(ticket_id)
+        if latest is not None and latest["version"] > version:
+            continue
+        if event["event"] == "ticket_created":
+            upserts[ticket_id] = {
+                "ticket_id": ticket_id,
+                "stripe_price_id": event["stripe_price_id"],
+                "stock": event["stock"],
+                "version": version,
+                "unit_amount": event.get("unit_amount"),
+                "currency": event.get("currency"),
+            }
+            updates.pop(ticket_id, None)
+        elif ticket_id in upserts:
+            upserts[ticket_id].update(stock=event["stock"], version=version)
+        else:
+            updates[ticket_id] = {"stock": event["stock"], "version": version}
+    return upserts, updates
+
+
+class TicketEventConsumer:
+    """
+    Consumes the TICKETS queue in batches.
+
+    Messages are buffered up to ``batch_size`` or ``linger`` seconds, applied to
+    ``ticket_stock`` in one transaction and acked together. When a batch fails,
+    its messages are retried one by one so a bad message is rejected alone.
+    """
+
+    def __init__(self, session_factory, reservation_engine: Optional[StockReservationEngine] = None,
+                 batch_size: int = TICKETS_BATCH_SIZE, linger: float = TICKETS_BATCH_LINGER,
+                 prefetch: int = TICKETS_PREFETCH):
+        self.session_factory = session_factory
+        self.reservation_engine = reservation_engine
+        self.batch_size = batch_size
+        self.linger = linger
+        self.prefetch = prefetch
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._queue = None
+        self._consumer_tag: Optional[str] = None
+        self._stopped = False
+
+    async def start(self, channel, queue):
+        """
+        Start receiving messages from ``queue``, at most ``prefetch`` unacked at a time.
+        """
+        await channel.set_qos(prefetch_count=self.prefetch)
+        self._queue = queue
+        self._consumer_tag = await queue.consume(self._messages.put)
+
+    async def stop(self):
+        """
+        Stop receiving messages. ``run`` returns once the messages already received are processed.
+        """
+        if self._queue is not None and self._consumer_tag is not None:
+            await self._queue.cancel(self._consumer_tag)
+            self._consumer_tag = None
+        await self._messages.put(_STOP)
+
+    async def next_batch(self) -> list:
+        """
+        Wait for a message, then for up to ``batch_size`` messages or ``linger`` seconds.
+        Returns early, possibly empty, once the consumer is stopped.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if not batch:
+                message = await self._messages.get()
+                deadline = asyncio.get_running_loop().time() + self.linger
+            elif self._messages.empty():
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(self._messages.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                message = self._messages.get_nowait()
+            if message is _STOP:
+                self._stopped = True
+                break
+            batch.append(message)
+        return batch
+
+    @traced("tickets.process_batch")
+    async def process_batch(self, messages: list):
+        with HANDLER_LATENCY.labels("process_message").time():
+            try:
+                await self.apply([message.body for message in messages])
+            except Exception as e:
+                logger.error("Failed to apply a batch of %s ticket events, retrying one by one: %s", len(messages), e)
+                await self.process_one_by_one(messages)
+                return
+            # Messages are processed in delivery order, so this acks the whole batch
+            await messages[-1].ack(multiple=True)
+
+    async def process_one_by_one(self, messages: list):
+        for message in messages:
+            try:
+                await self.apply([message.body])
+            except Exception as e:
+                logger.error("Failed to apply ticket event %r: %s", message.body, e)
+                await message.reject(requeue=False)
+            else:
+                await message.ack()
+
+    async def apply(self, bodies: List[bytes]):
+        """
+        Apply ticket events to ``ticket_stock`` in a single transaction.
+        """
+        events = [event for event in map(parse_ticket_event, bodies) if event is not None]
+        upserts, updates = coalesce_ticket_events(events)
+        if not upserts and not updates:
+            return
+
+        # Flushed reservation deltas must land either before the write, or after the counters are reconciled
+        engine = self.reservation_engine
+        async with engine.reconciling() if engine is not None else contextlib.nullcontext():
+            async with self.session_factory() as db:
+                written = await async_crud.apply_ticket_stock_changes(
+                    db,
+                    [
+                        {key: ticket[key] for key in ("ticket_id", "stripe_price_id", "stock", "version")}
+                        for ticket in upserts.values()
+                    ],
+                    updates,
+                )
+
+            for ticket_id, price_id in written.items():
+                if ticket_id in upserts:
+                    ticket = upserts[ticket_id]
+                    price_cache.put(
+                        price_id,
+                        ticket_id=ticket_id,
+                        unit_amount=ticket["unit_amount"],
+                        currency=ticket["currency"],
+                    )
+                    stock = ticket["stock"]
+                else:
+                    stock = updates[ticket_id]["stock"]
+                if engine is not None:
+                    engine.reconcile(price_id, stock)
+        created = len(written.keys() & upserts.keys())
+        logger.info(
+            "Applied ticket events: %s tickets created, %s stocks updated", created, len(written) - created, extra=SAMPLED
+        )
+
+    async def lag(self) -> int:
+        """
+        :return: Messages ready in the TICKETS queue plus the ones received but not applied yet.
+        """
+        # Declaring an existing queue again returns its current message count
+        declared = await self._queue.declare()
+        return declared.message_count + self._messages.qsize()
+
+    async def report_lag(self, interval: float = TICKETS_LAG_INTERVAL):
+        """
+        Update the consumer lag metric every ``interval`` seconds.
+        """
+        while True:
+            try:
+                TICKETS_CONSUMER_LAG.set(await self.lag())
+            except Exception as e:
+                logger.error("Failed to measure the TICKETS queue lag: %s", e)
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        while not self._stopped:
+            batch = await self.next_batch()
+            if batch:
+                await self.process_batch(batch)
@@ -0,0 +1,153 @@
+"""
+Optional OpenTelemetry tracing.
+
+Disabled unless TRACING_ENABLED is true, in which case the ``tracing`` extra
+(opentelemetry-sdk and the OTLP exporter) must be installed. While disabled,
+nothing from OpenTelemetry is imported and every span is a shared no-op
+context manager.
+
+TRACING_EXPORTER selects where spans go:
+  otlp - an OTLP/HTTP collector, configured by the standard OTEL_EXPORTER_OTLP_* variables
+  file - one JSON span per line appended to TRACING_FILE, e.g. for local testing
+"""
+import contextlib
+import functools
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "otlp")
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+
+_NO_SPAN = contextlib.nullcontext()
+_tracer = None
+_provider = None
+
+
+def setup_tracing(service_name: str, exporter=None) -> bool:
+    """
+    Start exporting spans, when tracing is enabled or an ``exporter`` is given.
+
+    :param service_name: service.name of the spans, unless OTEL_SERVICE_NAME is set.
+    :param exporter: SpanExporter to use instead of the one of TRACING_EXPORTER.
+    :return: True if tracing was started.
+    """
+    global _tracer, _provider
+    if not TRACING_ENABLED and exporter is None:
+        return False
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    if exporter is None:
+        exporter = _configured_exporter()
+    resource = Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", service_name)})
+    _provider = TracerProvider(resource=resource)
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = _provider.get_tracer("payments")
+    logger.info("Tracing enabled, exporting spans to %s", type(exporter).__name__)
+    return True
+
+
+def shutdown_tracing():
+    """
+    Export the spans still buffered and stop tracing.
+    """
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer = None
+    _provider = None
+
+
+def _configured_exporter():
+    if TRACING_EXPORTER == "file":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+        return ConsoleSpanExporter(
+            out=open(TRACING_FILE, "a"),
+            formatter=lambda span: span.to_json(indent=None) + os.linesep,
+        )
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import \
+        OTLPSpanExporter
+
+    return OTLPSpanExporter()
+
+
+def span(name: str, parent: Optional[dict] = None, kind: str = "internal", **attributes):
+    """
+    Context manager tracing a block as a span.
+
+    :param parent: Trace context headers to continue, e.g. stored with a message, instead of the current span.
+    :param kind: internal, server, client, producer or consumer.
+    """
+    if _tracer is None:
+        return _NO_SPAN
+    from opentelemetry.propagate import extract
+    from opentelemetry.trace import SpanKind
+
+    context = extract(parent) if parent else None
+    return _tracer.start_as_current_span(
+        name, context=context, kind=SpanKind[kind.upper()], attributes=attributes or None
+    )
+
+
+def traced(name: str):
+    """
+    Decorator tracing every call of a coroutine function as a span.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return await function(*args, **kwargs)
+            with _tracer.start_as_current_span(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def trace_headers() -> Optional[dict]:
+    """
+    :return: W3C trace context headers of the current span, None when tracing is disabled.
+    """
+    if _tracer is None:
+        return None
+    from opentelemetry.propagate import inject
+
+    headers = {}
+    inject(headers)
+    return headers or None
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware tracing every request as a server span, continuing the caller's trace context.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _tracer is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        with span(scope["method"], parent=headers, kind="server") as request_span:
+            request_span.set_attribute("http.request.method", scope["method"])
+            request_span.set_attribute("url.path", scope["path"])
+
+            async def send_traced(message):
+                if message["type"] == "http.response.start":
+                    request_span.set_attribute("http.response.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                route = scope.get("route")
+                if route is not None:
+                    request_span.update_name(f"{scope['method']} {route.path}")
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock
+
+import pytest
+
+from auth.jwks import JWKSLoader
+from auth.JWTBearer import JWKS, JWTBearer
+
+jwks_v1 = {"keys": [{"kid": "kid_1", "kty": "RSA", "alg": "RS256", "n": "sXch", "e": "AQAB"}]}
+jwks_v2 = {"keys": jwks_v1["keys"] + [{"kid": "kid_2", "kty": "RSA", "alg": "RS256", "n": "ofgW", "e": "AQAB"}]}
+
+
+class FakeCognitoHandler(BaseHTTPRequestHandler):
+    """
+    Serves the JWKS set on the server, counting requests.
+    """
+
+    def do_GET(self):
+        self.server.requests += 1
+        payload = json.dumps(self.server.jwks).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_cognito():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCognitoHandler)
+    server.jwks = jwks_v1
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def url(server) -> str:
+    return f"http://127.0.0.1:{server.server_port}/.well-known/jwks.json"
+
+
+def test_load_local_file(tmp_path):
+    jwks_file = tmp_path / "jwks.json"
+    jwks_file.write_text(json.dumps(jwks_v1))
+
+    loader = JWKSLoader(url="http://unused", file=str(jwks_file), cache_file=None)
+
+    assert [key["kid"] for key in loader.load_local().keys] == ["kid_1"]
+
+
+def test_load_local_without_files(tmp_path):
+    loader = JWKSLoader(url="http://unused", file=None, cache_file=str(tmp_path / "missing.json"))
+
+    assert loader.load_local().keys == []
+
+
+@pytest.mark.asyncio
+async def test_fetch_writes_cache_file(fake_cognito, tmp_path):
+    cache_file = tmp_path / "cache.json"
+    loader = JWKSLoader(url=url(fake_cognito), file=None, cache_file=str(cache_file))
+
+    await loader.start()
+
+    assert json.loads(cache_file.read_text()) == jwks_v1
+    # A cold start reads the keys back without the network
+    cold_loader = JWKSLoader(url="http://unused", file=None, cache_file=str(cache_file))
+    assert [key["kid"] for key in cold_loader.load_local().keys] == ["kid_1"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_refreshes_share_one_request(fake_cognito, tmp_path):
+    loader = JWKSLoader(url=url(fake_cognito), file=None, cache_file=None)
+
+    await asyncio.gather(*(loader.refresh() for _ in range(10)))
+
+    assert fake_cognito.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_unknown_kid_refetches_keys(fake_cognito, tmp_path):
+    loader = JWKSLoader(url=url(fake_cognito), file=None, cache_file=None, min_refresh_interval=60)
+    bearer = JWTBearer(loader.load_local(), jwks_loader=loader)
+    await loader.refresh()
+    assert set(bearer.kid_to_key) == {"kid_1"}
+
+    # Key rotation
+    fake_cognito.jwks = jwks_v2
+    assert await loader.refresh_for_unknown_kid("kid_2") is False  # refreshed too recently
+    loader._refreshed_at -= 60
+    assert await loader.refresh_for_unknown_kid("kid_2") is True
+
+    assert set(bearer.kid_to_key) == {"kid_1", "kid_2"}
+    assert fake_cognito.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_refetch_is_rate_limited(tmp_path):
+    loader = JWKSLoader(url="http://unused", file=None, cache_file=None, min_refresh_interval=60)
+    loader.fetch = AsyncMock(side_effect=Exception("Cognito is down"))
+
+    assert await loader.refresh_for_unknown_kid("kid_1") is False
+    assert await loader.refresh_for_unknown_kid("kid_1") is False
+
+    loader.fetch.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_local_file_is_never_refreshed(fake_cognito, tmp_path):
+    jwks_file = tmp_path / "jwks.json"
+    jwks_file.write_text(json.dumps(jwks_v1))
+    loader = JWKSLoader(url=url(fake_cognito), file=str(jwks_file), cache_file=None)
+    loader.load_local()
+
+    await loader.start()
+    await loader.refresh()
+
+    assert fake_cognito.requests == 0
@@ -0,0 +1,191 @@
+import time
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jose import jwk, jwt
+from starlette.requests import Request
+
+from auth.JWTBearer import JWKS, JWTAuthorizationCredentials, JWTBearer
+
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+private_pem = private_key.private_bytes(
+    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+).decode()
+public_pem = private_key.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+).decode()
+jwks = JWKS(keys=[{**jwk.construct(public_pem, "RS256").to_dict(), "kid": "some_kid"}])
+
+
+def make_token(exp: float = None, kid: str = "some_kid") -> str:
+    exp = time.time() + 3600 if exp is None else exp
+    return jwt.encode({"sub": "user_id", "exp": int(exp)}, private_pem, algorithm="RS256", headers={"kid": kid})
+
+
+def make_request(token: str) -> Request:
+    return Request({"type": "http", "headers": [(b"authorization", f"Bearer {token}".encode())]})
+
+
+def make_credentials(token: str = "header.payload.signature", exp: float = None) -> JWTAuthorizationCredentials:
+    exp = time.time() + 3600 if exp is None else exp
+    return JWTAuthorizationCredentials(
+        jwt_token=token,
+        header={"kid": "some_kid"},
+        claims={"sub": "user_id", "exp": str(int(exp))},
+        signature="signature",
+        message="message",
+    )
+
+
+revoked_error = ClientError({"Error": {"Code": "NotAuthorizedException", "Message": "revoked"}}, "GetUser")
+
+
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_cached_policy_calls_cognito_once(user_info_with_token_mock):
+    bearer = JWTBearer(JWKS(keys=[]), revocation_check="cached")
+    credentials = make_credentials()
+
+    for _ in range(3):
+        await bearer.check_token_revoked(credentials)
+
+    user_info_with_token_mock.assert_called_once_with(credentials.jwt_token)
+
+
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_always_policy_calls_cognito_every_time(user_info_with_token_mock):
+    bearer = JWTBearer(JWKS(keys=[]), revocation_check="always")
+    credentials = make_credentials()
+
+    for _ in range(3):
+        await bearer.check_token_revoked(credentials)
+
+    assert user_info_with_token_mock.call_count == 3
+
+
+@patch("auth.JWTBearer.random.random", side_effect=[0.05, 0.5])
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_sampled_policy_rechecks_some_cache_hits(user_info_with_token_mock, random_mock):
+    bearer = JWTBearer(JWKS(keys=[]), revocation_check="sampled", revocation_sample_rate=0.1)
+    credentials = make_credentials()
+
+    for _ in range(3):
+        await bearer.check_token_revoked(credentials)
+
+    # First call is a miss, then one sampled re-check and one cache hit
+    assert user_info_with_token_mock.call_count == 2
+
+
+@patch("auth.JWTBearer.user_info_with_token", side_effect=revoked_error)
+@pytest.mark.asyncio
+async def test_revoked_token_is_cached(user_info_with_token_mock):
+    bearer = JWTBearer(JWKS(keys=[]), revocation_check="cached")
+    credentials = make_credentials()
+
+    for _ in range(2):
+        with pytest.raises(HTTPException) as exc_info:
+            await bearer.check_token_revoked(credentials)
+        assert exc_info.value.status_code == 403
+
+    user_info_with_token_mock.assert_called_once()
+
+
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_cache_never_outlives_token(user_info_with_token_mock):
+    bearer = JWTBearer(JWKS(keys=[]), revocation_check="cached")
+    credentials = make_credentials(exp=time.time() - 1)
+
+    await bearer.check_token_revoked(credentials)
+    await bearer.check_token_revoked(credentials)
+
+    assert user_info_with_token_mock.call_count == 2
+
+
+@patch("auth.JWTBearer.user_info_with_token", side_effect=Exception("Cognito is down"))
+@pytest.mark.asyncio
+async def test_failed_check_is_not_cached(user_info_with_token_mock):
+    bearer = JWTBearer(JWKS(keys=[]), revocation_check="cached")
+    credentials = make_credentials()
+
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            await bearer.check_token_revoked(credentials)
+
+    assert user_info_with_token_mock.call_count == 2
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        JWTBearer(JWKS(keys=[]), revocation_check="never")
+
+
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_verified_token_skips_signature_check(user_info_with_token_mock):
+    bearer = JWTBearer(jwks)
+    token = make_token()
+
+    with patch.object(bearer, "verify_jwk_token", wraps=bearer.verify_jwk_token) as verify_jwk_token_mock:
+        for _ in range(3):
+            credentials = await bearer(make_request(token))
+            assert credentials.claims["sub"] == "user_id"
+
+    verify_jwk_token_mock.assert_called_once()
+
+
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_expired_token_is_verified_again(user_info_with_token_mock):
+    bearer = JWTBearer(jwks)
+    token = make_token(exp=time.time() - 1)
+
+    with patch.object(bearer, "verify_jwk_token", wraps=bearer.verify_jwk_token) as verify_jwk_token_mock:
+        await bearer(make_request(token))
+        await bearer(make_request(token))
+
+    assert verify_jwk_token_mock.call_count == 2
+
+
+@patch("auth.JWTBearer.user_info_with_token")
+@pytest.mark.asyncio
+async def test_invalid_signature_never_reaches_cognito(user_info_with_token_mock):
+    bearer = JWTBearer(jwks)
+    header, payload, _ = make_token().split(".")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await bearer(make_request(f"{header}.{payload}.c2lnbmF0dXJl"))
+
+    assert exc_info.value.detail == "JWK invalid"
+    user_info_with_token_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_unknown_kid():
+    bearer = JWTBearer(jwks)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await bearer(make_request(make_token(kid="other_kid")))
+
+    assert exc_info.value.detail == "JWK public key not found"
+
+
+@pytest.mark.asyncio
+async def test_bearer_without_keys():
+    # Cold start with no JWKS file, no cache file and Cognito unreachable
+    bearer = JWTBearer(JWKS(keys=[]))
+
+    with pytest.raises(HTTPException) as exc_info:
+        await bearer(make_request(make_token()))
+
+    assert exc_info.value.status_code == 403
+    assert exc_info.value.detail == "JWK public key not found"
+
+    bearer.set_jwks(jwks)
+    assert bearer.verify_jwt(make_token()).claims["sub"] == "user_id"
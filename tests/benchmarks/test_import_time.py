@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Cumulative time to import main, as reported by python -X importtime
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "2000"))
+# Loaded on first use or in the lifespan, never while importing the app
+LAZY_MODULES = ("stripe", "boto3", "aio_pika", "requests", "httpx", "opentelemetry")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="module")
+def import_times() -> dict[str, int]:
+    """
+    Cumulative import time in microseconds of every module imported by main, in a fresh interpreter.
+    """
+    env = {
+        "EXPIRE_TIME": "1800",
+        "DOMAIN": "http://localhost",
+        "MYSQL_URL": "sqlite://",
+        **os.environ,
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_heavy_modules_are_not_imported(import_times):
+    assert [module for module in LAZY_MODULES if module in import_times] == []
+
+
+@pytest.mark.benchmark
+def test_import_time_budget(import_times):
+    import_time_ms = import_times["main"] / 1000
+    assert import_time_ms <= IMPORT_TIME_BUDGET_MS, (
+        f"Importing main took {import_time_ms:.0f}ms, over the {IMPORT_TIME_BUDGET_MS:.0f}ms budget"
+    )
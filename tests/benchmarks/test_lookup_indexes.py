@@ -0,0 +1,128 @@
+import logging
+import os
+import random
+import statistics
+import time
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, select
+
+from models.models import TicketStock, UserMapping, user_mapping_uuid
+
+logger = logging.getLogger(__name__)
+
+# Rows of the database the query plans are checked on
+LOOKUP_PLAN_USERS = 1000
+LOOKUP_PLAN_TICKETS = 100
+LOOKUP_BENCHMARK_USERS = int(os.getenv("LOOKUP_BENCHMARK_USERS", "1000000"))
+LOOKUP_BENCHMARK_TICKETS = int(os.getenv("LOOKUP_BENCHMARK_TICKETS", "10000"))
+LOOKUP_BENCHMARK_QUERIES = int(os.getenv("LOOKUP_BENCHMARK_QUERIES", "2000"))
+# A full scan of user_mapping at 1M rows takes tens of milliseconds; slower lookups are logged, not failed
+LOOKUP_P99_BUDGET_MS = float(os.getenv("LOOKUP_P99_BUDGET_MS", "5"))
+
+ALEMBIC_INI = os.path.join(os.path.dirname(__file__), "..", "..", "alembic.ini")
+
+
+def user_id(i: int) -> str:
+    return f"cognito-sub-{i:08d}"
+
+
+def price_id(i: int) -> str:
+    return f"price_{i:08d}"
+
+
+def migrated_database(users: int, tickets: int):
+    """
+    SQLite database migrated to head, with ``users`` user mappings and ``tickets`` ticket stocks.
+    """
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        config = Config(ALEMBIC_INI)
+        config.attributes["connection"] = conn
+        config.attributes["configure_logger"] = False
+        command.upgrade(config, "head")
+
+        chunk = 100_000
+        for start in range(0, users, chunk):
+            conn.exec_driver_sql(
+                "INSERT INTO user_mapping (uuid, user_id) VALUES (?, ?)",
+                [(user_mapping_uuid(user_id(i)), user_id(i)) for i in range(start, min(start + chunk, users))],
+            )
+        conn.exec_driver_sql(
+            "INSERT INTO ticket_stock (ticket_id, stripe_price_id, stock) VALUES (?, ?, ?)",
+            [(i, price_id(i), 100) for i in range(tickets)],
+        )
+        conn.exec_driver_sql("ANALYZE")
+        yield conn
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def conn():
+    yield from migrated_database(LOOKUP_PLAN_USERS, LOOKUP_PLAN_TICKETS)
+
+
+@pytest.fixture(scope="module")
+def benchmark_conn():
+    yield from migrated_database(LOOKUP_BENCHMARK_USERS, LOOKUP_BENCHMARK_TICKETS)
+
+
+def query_plan(conn, statement) -> str:
+    compiled = statement.compile(conn)
+    rows = conn.exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {compiled.string}",
+        tuple(compiled.params[name] for name in compiled.positiontup),
+    ).all()
+    return " | ".join(row[-1] for row in rows)
+
+
+def measure(conn, statements: list) -> tuple[float, float]:
+    """
+    :return: p50 and p99 latency of executing ``statements``, in milliseconds.
+    """
+    latencies = []
+    for statement in statements:
+        start = time.perf_counter()
+        conn.execute(statement).all()
+        latencies.append((time.perf_counter() - start) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100)
+    return percentiles[49], percentiles[98]
+
+
+LOOKUPS = [
+    # get_user_mapping_by_uuid
+    ("user_mapping by uuid", lambda i: select(UserMapping.user_id).where(UserMapping.uuid == user_mapping_uuid(user_id(i))),
+     "USING INDEX sqlite_autoindex_user_mapping_1"),
+    # Mapping of a Cognito user, e.g. from a checkout_session row
+    ("user_mapping by user_id", lambda i: select(UserMapping.uuid).where(UserMapping.user_id == user_id(i)),
+     "USING INDEX ix_user_mapping_user_id"),
+    # get_stock_ticket_id_by_price_id, the webhooks
+    ("ticket_id by price_id",
+     lambda i: select(TicketStock.ticket_id).where(TicketStock.stripe_price_id == price_id(i % LOOKUP_BENCHMARK_TICKETS)),
+     "USING COVERING INDEX sqlite_autoindex_ticket_stock_1"),
+    # get_stock_by_price_id, the unique index lookup then one primary key read
+    ("ticket_id and stock by price_id",
+     lambda i: select(TicketStock.ticket_id, TicketStock.stock).where(
+         TicketStock.stripe_price_id == price_id(i % LOOKUP_BENCHMARK_TICKETS)
+     ),
+     "USING INDEX sqlite_autoindex_ticket_stock_1"),
+]
+
+
+@pytest.mark.parametrize("name,lookup,expected_plan", LOOKUPS)
+def test_lookup_uses_index(conn, name, lookup, expected_plan):
+    plan = query_plan(conn, lookup(0))
+    logger.info(f"{name}: {plan}")
+    assert expected_plan in plan
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("name,lookup", [(name, lookup) for name, lookup, _ in LOOKUPS])
+def test_lookup_latency(benchmark_conn, name, lookup):
+    keys = random.Random(0).sample(range(LOOKUP_BENCHMARK_USERS), LOOKUP_BENCHMARK_QUERIES)
+    p50, p99 = measure(benchmark_conn, [lookup(i) for i in keys])
+    logger.info(f"{name} over {LOOKUP_BENCHMARK_USERS} user mappings: p50 {p50:.3f}ms, p99 {p99:.3f}ms")
+    if p99 > LOOKUP_P99_BUDGET_MS:
+        logger.warning(f"{name}: p99 {p99:.3f}ms is over the {LOOKUP_P99_BUDGET_MS}ms budget")
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import pytest
+
+from models.models import OutboxMessage
+from services.publisher import OutboxPublisher, aio_pika
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_BENCHMARK_MESSAGES = int(os.getenv("PUBLISH_BENCHMARK_MESSAGES", "500"))
+# Round trip of a publish to its confirm on a local broker
+BROKER_CONFIRM_LATENCY = float(os.getenv("BROKER_CONFIRM_LATENCY", "0.002"))  # in seconds
+
+
+class FakeBroker:
+    """
+    Stands in for a RabbitMQ exchange with publisher confirms, confirming every
+    publish after a fixed latency, however many are in flight.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.published = 0
+        self.in_flight = 0
+        # Number of times publishes started while none were waiting for a confirm
+        self.round_trips = 0
+        self.max_in_flight = 0
+
+    async def publish(self, message, routing_key):
+        if not self.in_flight:
+            self.round_trips += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        self.published += 1
+
+
+def payload(i: int) -> str:
+    return json.dumps({"event": "checkout.session.completed", "ticket_id": i, "quantity": 1})
+
+
+async def outbox_publisher(session_factory, broker: FakeBroker, count: int) -> OutboxPublisher:
+    """
+    Publisher to ``broker`` with ``count`` messages committed to the outbox and handed over.
+    """
+    async with session_factory() as db:
+        messages = [OutboxMessage(routing_key="payments.messages", body=payload(i)) for i in range(count)]
+        db.add_all(messages)
+        await db.commit()
+    publisher = OutboxPublisher(session_factory, linger=0)
+    publisher.attach(broker)
+    publisher.enqueue([(message.id, message.routing_key, message.body, None) for message in messages])
+    return publisher
+
+
+@pytest.mark.asyncio
+async def test_batched_publishing_waits_once_per_batch(session_factory):
+    count = PUBLISH_BENCHMARK_MESSAGES
+    broker = FakeBroker(0)
+    publisher = await outbox_publisher(session_factory, broker, count)
+
+    await publisher.drain()
+
+    assert broker.published == count
+    # Every publish of a batch is in flight together, batches wait for the previous confirms
+    assert broker.max_in_flight == min(count, publisher.batch_size)
+    assert broker.round_trips == -(-count // publisher.batch_size)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_batched_publishing_throughput(session_factory):
+    count = PUBLISH_BENCHMARK_MESSAGES
+
+    # Previous behaviour: one publish per message, each awaiting its confirm
+    broker = FakeBroker(BROKER_CONFIRM_LATENCY)
+    start = time.perf_counter()
+    for i in range(count):
+        await broker.publish(aio_pika.Message(body=payload(i).encode()), routing_key="payments.messages")
+    sequential = time.perf_counter() - start
+
+    broker = FakeBroker(BROKER_CONFIRM_LATENCY)
+    publisher = await outbox_publisher(session_factory, broker, count)
+    start = time.perf_counter()
+    await publisher.drain()
+    batched = time.perf_counter() - start
+
+    assert broker.published == count
+    logger.info(
+        f"Published {count} messages: {count / sequential:.0f}/s one by one, "
+        f"{count / batched:.0f}/s in batches of {publisher.batch_size} including outbox deletes, "
+        f"{sequential / batched:.1f}x faster"
+    )
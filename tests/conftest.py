@@ -0,0 +1,29 @@
+import os
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from db.database import Base
+
+# Timing measurements are slow and depend on the machine, so they only run on demand
+RUN_BENCHMARKS = os.getenv("RUN_BENCHMARKS", "false").lower() == "true"
+
+
+def pytest_collection_modifyitems(config, items):
+    if RUN_BENCHMARKS:
+        return
+    skip = pytest.mark.skip(reason="timing benchmark, set RUN_BENCHMARKS=true to run it")
+    for item in items:
+        if item.get_closest_marker("benchmark") is not None:
+            item.add_marker(skip)
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    # Empty in-memory database with every table, shared by the tests of each module
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    await engine.dispose()
@@ -0,0 +1,199 @@
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud.async_crud import (add_outbox_messages, apply_ticket_stock_changes,
+                             claim_event, complete_checkout_session,
+                             create_checkout_session_items, decrement_stocks,
+                             expire_checkout_sessions,
+                             get_checkout_session_items,
+                             get_or_create_user_mapping, get_stock_by_price_id,
+                             get_stock_by_ticket_id,
+                             get_stock_ticket_id_by_price_id,
+                             get_user_mapping_by_uuid, increment_stocks)
+from models.models import (CheckoutSession, OutboxMessage, TicketStock,
+                           UserMapping, user_mapping_uuid)
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_user_mapping_new_user():
+    mock_db = AsyncMock(spec=AsyncSession)
+    mock_db.get.return_value = None
+    user_id = "user_123"
+
+    result = await get_or_create_user_mapping(mock_db, user_id)
+
+    mock_db.get.assert_awaited_once_with(UserMapping, user_mapping_uuid(user_id))
+    mock_db.add.assert_called_once()
+    mock_db.commit.assert_awaited_once()
+
+    assert isinstance(result, UserMapping)
+    assert result.uuid == user_mapping_uuid(user_id)
+    assert result.user_id == user_id
+
+@pytest.mark.asyncio
+async def test_get_or_create_user_mapping_existing_user():
+    mock_db = AsyncMock(spec=AsyncSession)
+    user_id = "user_123"
+    existing = UserMapping(uuid=user_mapping_uuid(user_id), user_id=user_id)
+    mock_db.get.return_value = existing
+
+    result = await get_or_create_user_mapping(mock_db, user_id)
+
+    mock_db.add.assert_not_called()
+    mock_db.commit.assert_not_awaited()
+    assert result is existing
+
+@pytest.mark.asyncio
+async def test_get_or_create_user_mapping_concurrent_insert():
+    mock_db = AsyncMock(spec=AsyncSession)
+    mock_db.get.return_value = None
+    mock_db.commit.side_effect = IntegrityError("INSERT", {}, Exception("Duplicate entry"))
+
+    result = await get_or_create_user_mapping(mock_db, "user_123")
+
+    mock_db.rollback.assert_awaited_once()
+    assert result.uuid == user_mapping_uuid("user_123")
+
+@pytest.mark.asyncio
+async def test_get_stock_by_price_id():
+    mock_db = AsyncMock(spec=AsyncSession)
+    mock_db.execute.return_value = MagicMock(**{"scalar_one_or_none.return_value": 100})
+
+    result = await get_stock_by_price_id(mock_db, "price_123")
+
+    assert result == {"stock": 100}
+
+@pytest.mark.asyncio
+async def test_create_checkout_session_items():
+    mock_db = AsyncMock(spec=AsyncSession)
+    expires_at = datetime(2025, 1, 1, 12, 30)
+
+    result = await create_checkout_session_items(
+        mock_db, "cs_123", "user_123",
+        [{"price_id": "price_123", "quantity": 2, "unit_amount": 1500}, {"price_id": "price_456", "quantity": 1}],
+        expires_at,
+    )
+
+    mock_db.add_all.assert_called_once_with(result)
+    mock_db.commit.assert_awaited_once()
+    assert [(item.price_id, item.quantity, item.unit_amount) for item in result] == [
+        ("price_123", 2, 1500), ("price_456", 1, None),
+    ]
+    assert all(isinstance(item, CheckoutSession) for item in result)
+    assert all(item.session_id == "cs_123" and item.expires_at == expires_at for item in result)
+
+@pytest.mark.asyncio
+async def test_decrement_stocks():
+    mock_db = AsyncMock(spec=AsyncSession)
+    mock_db.execute.return_value = MagicMock(rowcount=1)
+
+    await decrement_stocks(mock_db, {"price_456": 1, "price_123": 2})
+
+    assert mock_db.execute.await_count == 2
+    mock_db.commit.assert_awaited_once()
+    mock_db.rollback.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_decrement_stocks_is_all_or_nothing():
+    mock_db = AsyncMock(spec=AsyncSession)
+    mock_db.execute.side_effect = [
+        MagicMock(rowcount=1),  # price_123
+        MagicMock(rowcount=0),  # price_456, not enough stock
+        MagicMock(**{"first.return_value": ("ticket_456",)}),
+    ]
+
+    with pytest.raises(HTTPException) as exc_info:
+        await decrement_stocks(mock_db, {"price_456": 5, "price_123": 2})
+
+    assert exc_info.value.status_code == 400
+    mock_db.rollback.assert_awaited_once()
+    mock_db.commit.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_increment_stocks():
+    mock_db = AsyncMock(spec=AsyncSession)
+
+    await increment_stocks(mock_db, {"price_456": 1, "price_123": 2})
+
+    assert mock_db.execute.await_count == 2
+    mock_db.commit.assert_awaited_once()
+
+
+@pytest_asyncio.fixture
+async def sqlite_db(session_factory):
+    async with session_factory() as db:
+        yield db
+
+@pytest.mark.asyncio
+async def test_get_user_mapping_by_uuid(sqlite_db):
+    mapping = await get_or_create_user_mapping(sqlite_db, "user_123")
+
+    assert (await get_user_mapping_by_uuid(sqlite_db, mapping.uuid)).user_id == "user_123"
+    with pytest.raises(HTTPException) as exc_info:
+        await get_user_mapping_by_uuid(sqlite_db, "unknown")
+    assert exc_info.value.status_code == 404
+
+@pytest.mark.asyncio
+async def test_apply_ticket_stock_changes(sqlite_db):
+    def created(stock: int, version: int) -> dict:
+        return {"ticket_id": 1, "stripe_price_id": "price_123", "stock": stock, "version": version}
+
+    assert await apply_ticket_stock_changes(sqlite_db, [created(100, 1)], {}) == {1: "price_123"}
+    # Redelivered older event
+    assert await apply_ticket_stock_changes(sqlite_db, [created(90, 0)], {}) == {}
+
+    assert await apply_ticket_stock_changes(sqlite_db, [], {1: {"stock": 50, "version": 2}}) == {1: "price_123"}
+    assert await apply_ticket_stock_changes(
+        sqlite_db, [], {1: {"stock": 70, "version": 1}, 2: {"stock": 50, "version": 0}}
+    ) == {}
+    assert await get_stock_by_ticket_id(sqlite_db, 1) == {"stock": 50}
+    assert await get_stock_ticket_id_by_price_id(sqlite_db, "price_123") == 1
+
+@pytest.mark.asyncio
+async def test_complete_checkout_session(sqlite_db):
+    sqlite_db.add(TicketStock(ticket_id=1, stripe_price_id="price_123", stock=7))
+    await create_checkout_session_items(
+        sqlite_db, "cs_open", "user_123", [{"price_id": "price_123", "quantity": 1}], datetime(2025, 1, 1)
+    )
+    await create_checkout_session_items(
+        sqlite_db, "cs_swept", "user_123", [{"price_id": "price_123", "quantity": 3}], datetime(2025, 1, 1)
+    )
+    await expire_checkout_sessions(sqlite_db, ["cs_swept"])
+
+    assert await complete_checkout_session(sqlite_db, "cs_open") == {}
+    assert await complete_checkout_session(sqlite_db, "cs_swept") == {"price_123": 3}
+    assert await complete_checkout_session(sqlite_db, "cs_swept") == {}
+
+    assert await get_stock_by_price_id(sqlite_db, "price_123") == {"stock": 7}
+    items = await get_checkout_session_items(sqlite_db, "cs_open") + await get_checkout_session_items(sqlite_db, "cs_swept")
+    assert {item.status for item in items} == {CheckoutSession.COMPLETE}
+
+@pytest.mark.asyncio
+async def test_claim_event(session_factory):
+    async with session_factory() as db:
+        assert await claim_event(db, "evt_123", "checkout.session.completed") is True
+        # Left to the caller's transaction
+        await db.rollback()
+    async with session_factory() as db:
+        assert await claim_event(db, "evt_123", "checkout.session.completed") is True
+        await db.commit()
+    async with session_factory() as db:
+        assert await claim_event(db, "evt_123", "checkout.session.completed") is False
+
+@pytest.mark.asyncio
+async def test_add_outbox_messages(sqlite_db):
+    entries = await add_outbox_messages(sqlite_db, "payments.messages", ['{"n": 1}'])
+
+    [(message_id, routing_key, body, headers)] = entries
+    assert headers is None
+    assert (routing_key, body) == ("payments.messages", '{"n": 1}')
+    assert (await sqlite_db.get(OutboxMessage, message_id)).body == '{"n": 1}'
+    # Left to the caller's transaction
+    await sqlite_db.rollback()
+    assert await sqlite_db.get(OutboxMessage, message_id) is None
@@ -1,123 +1,28 @@
 from unittest.mock import MagicMock
 
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import Session
 
-from crud.crud import (create_ticket_stock, create_user_mapping,
-                       decrement_stock, get_stock_by_price_id,
-                       get_stock_by_ticket_id, get_stock_ticket_id_by_price_id,
-                       get_user_mapping_by_uuid, increment_stock,
-                       update_ticket_stock)
-from models.models import TicketStock, UserMapping
+from crud.crud import apply_stock_deltas, ticket_stock_upsert
+from models.models import user_mapping_uuid
 
 
-def test_create_user_mapping():
-    mock_db = MagicMock(spec=Session)
-    user_id = "user_123"
-
-    result = create_user_mapping(mock_db, user_id)
-
-    mock_db.add.assert_called_once()
-    mock_db.commit.assert_called_once()
-    mock_db.refresh.assert_called_once()
-
-    assert isinstance(result, UserMapping)
-    assert result.user_id == user_id
+def test_user_mapping_uuid_is_deterministic():
+    assert user_mapping_uuid("user_123") == user_mapping_uuid("user_123")
+    assert user_mapping_uuid("user_123") != user_mapping_uuid("user_456")
 
-def test_get_user_mapping_by_uuid():
-    mock_db = MagicMock(spec=Session)
-    uuid = "uuid_123"
-    mock_db.query().filter().first.return_value = UserMapping(uuid=uuid, user_id="user_123")
+def test_ticket_stock_upsert_mysql_writes_version_last():
+    stmt = ticket_stock_upsert("mysql", [{"ticket_id": 1, "stripe_price_id": "price_123", "stock": 100, "version": 1}])
 
-    result = get_user_mapping_by_uuid(mock_db, uuid)
+    sql = str(stmt.compile(dialect=mysql.dialect()))
 
-    assert isinstance(result, UserMapping)
-    assert result.uuid == uuid
+    assert "ON DUPLICATE KEY UPDATE" in sql
+    assert sql.rstrip().endswith("version = if(VALUES(version) >= ticket_stock.version, VALUES(version), ticket_stock.version)")
 
-def test_create_ticket_stock():
+def test_apply_stock_deltas():
     mock_db = MagicMock(spec=Session)
-    ticket_id = 1
-    stripe_price_id = "price_123"
-    stock = 100
 
-    result = create_ticket_stock(mock_db, ticket_id, stripe_price_id, stock)
+    apply_stock_deltas(mock_db, {"price_456": 2, "price_123": -3})
 
-    mock_db.add.assert_called_once()
+    assert mock_db.query().filter().update.call_count == 2
     mock_db.commit.assert_called_once()
-    mock_db.refresh.assert_called_once()
-
-    assert isinstance(result, TicketStock)
-    assert result.ticket_id == ticket_id
-    assert result.stripe_price_id == stripe_price_id
-    assert result.stock == stock
-
-def test_update_ticket_stock():
-    mock_db = MagicMock(spec=Session)
-    ticket_id = 1
-    stock = 50
-    mock_db.query().filter().first.return_value = TicketStock(ticket_id=ticket_id, stripe_price_id="price_123", stock=100)
-
-    result = update_ticket_stock(mock_db, ticket_id, stock)
-
-    mock_db.commit.assert_called_once()
-    mock_db.refresh.assert_called_once()
-
-    assert isinstance(result, TicketStock)
-    assert result.ticket_id == ticket_id
-    assert result.stock == stock
-
-def test_decrement_stock():
-    mock_db = MagicMock(spec=Session)
-    price_id = "price_123"
-    quantity = 10
-    mock_db.query().filter().first.return_value = TicketStock(ticket_id=1, stripe_price_id=price_id, stock=100)
-
-    result = decrement_stock(mock_db, price_id, quantity)
-
-    mock_db.commit.assert_called_once()
-    mock_db.refresh.assert_called_once()
-
-    assert isinstance(result, TicketStock)
-    assert result.stock == 90
-
-def test_increment_stock():
-    mock_db = MagicMock(spec=Session)
-    price_id = "price_123"
-    quantity = 10
-    mock_db.query().filter().first.return_value = TicketStock(ticket_id=1, stripe_price_id=price_id, stock=100)
-
-    result = increment_stock(mock_db, price_id, quantity)
-
-    mock_db.commit.assert_called_once()
-    mock_db.refresh.assert_called_once()
-
-    assert isinstance(result, TicketStock)
-    assert result.stock == 110
-
-def test_get_stock_by_ticket_id():
-    mock_db = MagicMock(spec=Session)
-    ticket_id = 1
-    mock_db.query().filter().first.return_value = TicketStock(ticket_id=ticket_id, stripe_price_id="price_123", stock=100)
-
-    result = get_stock_by_ticket_id(mock_db, ticket_id)
-
-    assert isinstance(result, dict)
-    assert result["stock"] == 100
-
-def test_get_stock_by_price_id():
-    mock_db = MagicMock(spec=Session)
-    price_id = "price_123"
-    mock_db.query().filter().first.return_value = TicketStock(ticket_id=1, stripe_price_id=price_id, stock=100)
-
-    result = get_stock_by_price_id(mock_db, price_id)
-
-    assert isinstance(result, dict)
-    assert result["stock"] == 100
-
-def test_get_stock_ticket_id_by_price_id():
-    mock_db = MagicMock(spec=Session)
-    price_id = "price_123"
-    mock_db.query().filter().first.return_value = TicketStock(ticket_id=1, stripe_price_id=price_id, stock=100)
-
-    result = get_stock_ticket_id_by_price_id(mock_db, price_id)
-
-    assert result == 1
\ No newline at end of file
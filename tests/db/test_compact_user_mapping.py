@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from db.compact_user_mapping import compact_user_mappings
+from db.database import Base
+from models.models import UserMapping, user_mapping_uuid
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def test_compact_user_mappings(db):
+    db.add_all([
+        UserMapping(uuid="legacy-1", user_id="user_123"),
+        UserMapping(uuid="legacy-2", user_id="user_123"),
+        UserMapping(uuid=user_mapping_uuid("user_456"), user_id="user_456"),
+        UserMapping(uuid="legacy-3", user_id="user_456"),
+    ])
+    db.commit()
+
+    deleted = compact_user_mappings(db, batch_size=1)
+
+    assert deleted == 3
+    rows = db.execute(select(UserMapping.uuid, UserMapping.user_id).order_by(UserMapping.user_id)).all()
+    assert rows == [
+        (user_mapping_uuid("user_123"), "user_123"),
+        (user_mapping_uuid("user_456"), "user_456"),
+    ]
+
+
+def test_compact_user_mappings_is_idempotent(db):
+    db.add(UserMapping(uuid="legacy-1", user_id="user_123"))
+    db.commit()
+
+    compact_user_mappings(db)
+
+    assert compact_user_mappings(db) == 0
+    assert db.scalar(select(func.count()).select_from(UserMapping)) == 1
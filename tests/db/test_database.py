@@ -0,0 +1,15 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.database import DB_POOL_SIZE, get_db, pool_options
+
+
+def test_pool_options():
+    assert pool_options("mysql+aiomysql://user:password@db/payments")["pool_size"] == DB_POOL_SIZE
+    assert pool_options("sqlite+aiosqlite://") == {}
+
+
+@pytest.mark.asyncio
+async def test_get_db_yields_async_session():
+    async for db in get_db():
+        assert isinstance(db, AsyncSession)
@@ -0,0 +1,58 @@
+import os
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, inspect, text
+
+import models.models  # noqa: F401
+from db.database import Base
+
+ALEMBIC_INI = os.path.join(os.path.dirname(__file__), "..", "..", "alembic.ini")
+
+
+def alembic_config(conn) -> Config:
+    config = Config(ALEMBIC_INI)
+    config.attributes["connection"] = conn
+    config.attributes["configure_logger"] = False
+    return config
+
+
+def schema_diff(conn) -> list:
+    return compare_metadata(MigrationContext.configure(conn), Base.metadata)
+
+
+def test_upgrade_fresh_database_matches_models():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        command.upgrade(alembic_config(conn), "head")
+
+        assert schema_diff(conn) == []
+        assert MigrationContext.configure(conn).get_current_revision() == "0002"
+
+
+def test_upgrade_adopts_create_all_database():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        # A database created by create_tables before ticket_stock.version and user_mapping.user_id's index
+        Base.metadata.create_all(conn)
+        conn.execute(text("DROP INDEX ix_user_mapping_user_id"))
+        conn.execute(text("ALTER TABLE ticket_stock DROP COLUMN version"))
+        conn.execute(text("ALTER TABLE outbox_message DROP COLUMN headers"))
+        conn.execute(text("INSERT INTO ticket_stock (ticket_id, stripe_price_id, stock) VALUES (1, 'price_1', 10)"))
+
+        command.upgrade(alembic_config(conn), "head")
+
+        assert conn.execute(text("SELECT stock, version FROM ticket_stock")).all() == [(10, 0)]
+        assert {index["name"] for index in inspect(conn).get_indexes("user_mapping")} == {"ix_user_mapping_user_id"}
+        assert schema_diff(conn) == []
+
+
+def test_downgrade_to_base():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        command.upgrade(alembic_config(conn), "head")
+        command.downgrade(alembic_config(conn), "base")
+
+        assert inspect(conn).get_table_names() == ["alembic_version"]
@@ -0,0 +1,61 @@
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from db.migrate import migrate
+from db.schema import SchemaVersionError, check_schema_version, head_revision
+
+
+@pytest.fixture
+def database(tmp_path):
+    return f"sqlite:///{tmp_path / 'payments.db'}"
+
+
+def async_url(url: str) -> str:
+    return url.replace("sqlite://", "sqlite+aiosqlite://")
+
+
+def test_migrate_creates_the_schema(database):
+    migrate(url=database)
+
+    assert "ticket_stock" in inspect(create_engine(database)).get_table_names()
+
+
+@pytest.mark.asyncio
+async def test_check_caches_the_migrated_revision(database, tmp_path):
+    migrate(url=database)
+    engine = create_async_engine(async_url(database))
+    cache_file = str(tmp_path / "schema_version.json")
+
+    assert await check_schema_version(engine, cache_file) == head_revision()
+    await engine.dispose()
+
+    # Served from the cache file, without connecting
+    cached = MagicMock(url=engine.url, connect=MagicMock(side_effect=AssertionError))
+    assert await check_schema_version(cached, cache_file) == head_revision()
+    with pytest.raises(AssertionError):
+        await check_schema_version(cached, cache_file, ttl=-1)
+
+
+@pytest.mark.asyncio
+async def test_check_rejects_unmigrated_database(database, tmp_path):
+    engine = create_async_engine(async_url(database))
+    cache_file = tmp_path / "schema_version.json"
+
+    with pytest.raises(SchemaVersionError):
+        await check_schema_version(engine, str(cache_file))
+    assert not cache_file.exists()
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_check_accepts_newer_revision(database):
+    migrate(url=database)
+    with create_engine(database).begin() as conn:
+        conn.execute(text("UPDATE alembic_version SET version_num = 'ffffffffffff'"))
+    engine = create_async_engine(async_url(database))
+
+    assert await check_schema_version(engine, None) == "ffffffffffff"
+    await engine.dispose()
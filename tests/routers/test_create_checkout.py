@@ -1,20 +1,24 @@
 import json
 import logging
 import time
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
 import pytest
 import stripe
 from dotenv import load_dotenv
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.auth import get_current_user, get_current_user_id, jwks
 from auth.JWTBearer import JWTAuthorizationCredentials, JWTBearer
 from db.database import get_db
 from main import app
 from models.models import TicketStock, UserMapping
-from routers.checkout import DOMAIN, auth, expire_time, process_message
+from routers.checkout import (DOMAIN, auth, expire_time, known_user_mappings,
+                              lifespan)
+from services.price_cache import price_cache
+from services.reservations import MemoryStockStore, StockReservationEngine
 
 load_dotenv()
 client = TestClient(app)
@@ -35,22 +39,28 @@ def override_auth():
     yield
     app.dependency_overrides.pop(auth, None)  # Cleanup after each test
 
+@pytest.fixture(autouse=True)
+def clear_user_mapping_cache():
+    known_user_mappings.clear()
+    yield
+
+
 @pytest.fixture(scope="module", autouse=True)
-def mock_db():
-    db = MagicMock(spec=Session)
+def mock_async_db():
+    db = AsyncMock(spec=AsyncSession)
     app.dependency_overrides[get_db] = lambda: db
     yield db
 
 
 @pytest.fixture(scope="module", autouse=True)
 def mock_auth():
-    auth = MagicMock()
-    app.dependency_overrides[get_current_user_id] = lambda: auth
-    yield auth
+    user_id = "user_id"
+    app.dependency_overrides[get_current_user_id] = lambda: user_id
+    yield user_id
 
 
-@patch("routers.checkout.stripe.checkout.Session.create")
-def test_create_checkout_session_with_invalid_price_id(stripe_checkout_session_mock, mock_db):
+@patch("routers.checkout.stripe.checkout.Session.create_async")
+def test_create_checkout_session_with_invalid_price_id(stripe_checkout_session_mock, mock_async_db):
     app.dependency_overrides[auth] = lambda: JWTAuthorizationCredentials(
         jwt_token="token",
         header={"kid": "some_kid"},
@@ -62,9 +72,7 @@ def test_create_checkout_session_with_invalid_price_id(stripe_checkout_session_m
     invalid_price_id = "pr_123"
     valid_quantity = "1"
 
-    db_ticket_stock = MagicMock(spec=TicketStock)
-    db_ticket_stock.stock = 100
-    mock_db.query.return_value.filter.return_value.first.return_value = db_ticket_stock
+    mock_async_db.execute.return_value = MagicMock(rowcount=1)
 
     response = client.post(
         f"/create-checkout-session?price_id={invalid_price_id}&quantity={valid_quantity}",
@@ -75,7 +83,7 @@ def test_create_checkout_session_with_invalid_price_id(stripe_checkout_session_m
     assert stripe_checkout_session_mock.call_count == 0
 
 
-@patch("routers.checkout.stripe.checkout.Session.create")
+@patch("routers.checkout.stripe.checkout.Session.create_async")
 def test_create_checkout_session_with_invalid_quantity(stripe_checkout_session_mock):
     app.dependency_overrides[auth] = lambda: JWTAuthorizationCredentials(
         jwt_token="token",
@@ -95,11 +103,11 @@ def test_create_checkout_session_with_invalid_quantity(stripe_checkout_session_m
     assert stripe_checkout_session_mock.call_count == 0
 
 
-@patch("routers.checkout.crud.create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
 @patch("routers.checkout.time.time", return_value=time.time())
-@patch("routers.checkout.stripe.checkout.Session.create", wraps=stripe.checkout.Session.create)
+@patch("routers.checkout.stripe.checkout.Session.create_async", wraps=stripe.checkout.Session.create_async)
 def test_create_checkout_session_with_valid_price_id_and_quantity(stripe_checkout_session, time_mock,
-                                                                  user_mapping_mock, mock_db):
+                                                                  user_mapping_mock, mock_async_db, mock_auth):
     app.dependency_overrides[auth] = lambda: JWTAuthorizationCredentials(
         jwt_token="token",
         header={"kid": "some_kid"},
@@ -111,16 +119,14 @@ def test_create_checkout_session_with_valid_price_id_and_quantity(stripe_checkou
     valid_price_id = "price_1QBvVfJo4ha2Zj4nO3F0YLFr"
     valid_quantity = "2"
 
-    db_ticket_stock = MagicMock(spec=TicketStock)
-    db_ticket_stock.stock = 100
-    mock_db.query.return_value.filter.return_value.first.return_value = db_ticket_stock
+    mock_async_db.execute.return_value = MagicMock(rowcount=1)
 
     response = client.post(
         f"/create-checkout-session?price_id={valid_price_id}&quantity={valid_quantity}",
         allow_redirects=False, headers=headers
     )
     assert response.status_code == 200
-    stripe_checkout_session.assert_called_once_with(
+    stripe_checkout_session.assert_awaited_once_with(
         line_items=[
             {
                 'price': valid_price_id,
@@ -132,11 +138,17 @@ def test_create_checkout_session_with_valid_price_id_and_quantity(stripe_checkou
         cancel_url=DOMAIN + '/checkout-canceled',
         expires_at=int(time_mock.return_value + expire_time),
         client_reference_id=user_mapping.uuid,
+        metadata=ANY,
+        expand=['line_items'],
     )
+    metadata = stripe_checkout_session.call_args.kwargs["metadata"]
+    assert metadata["user_id"] == mock_auth
+    assert json.loads(metadata["items"])[0]["price_id"] == valid_price_id
+    assert json.loads(metadata["items"])[0]["quantity"] == int(valid_quantity)
     assert response.json()["checkout_url"].startswith("https://checkout.stripe.com/c/pay/cs_test_")
 
 
-@patch("routers.checkout.stripe.checkout.Session.create", side_effect=Exception("Stripe error"))
+@patch("routers.checkout.stripe.checkout.Session.create_async", side_effect=Exception("Stripe error"))
 def test_create_checkout_session_with_exception(stripe_checkout_session_mock):
     app.dependency_overrides[auth] = lambda: JWTAuthorizationCredentials(
         jwt_token="token",
@@ -157,47 +169,166 @@ def test_create_checkout_session_with_exception(stripe_checkout_session_mock):
     assert response.status_code == 500
     assert stripe_checkout_session_mock.call_count == 1
 
-@patch("routers.checkout.create_ticket_stock")
-@patch("routers.checkout.get_db")
-@pytest.mark.asyncio
-async def test_process_message_ticket_created(get_db_mock, create_ticket_stock_mock, mock_db):
-    get_db_mock.return_value = iter([mock_db])
-    message = {
-        "event": "ticket_created",
-        "ticket_id": 1,
-        "stripe_price_id": "price_123",
-        "stock": 100
-    }
-    body = json.dumps(message)
-    
-    await process_message(body)
-    
-    create_ticket_stock_mock.assert_called_once_with(mock_db, 1, "price_123", 100)
-
-@patch("routers.checkout.update_ticket_stock")
-@patch("routers.checkout.get_db")
-@pytest.mark.asyncio
-async def test_process_message_ticket_stock_updated(get_db_mock, update_ticket_stock_mock, mock_db):
-    get_db_mock.return_value = iter([mock_db])
-    message = {
-        "event": "ticket_stock_updated",
-        "ticket_id": 1,
-        "stock": 50
-    }
-    body = json.dumps(message)
-    
-    await process_message(body)
-    
-    update_ticket_stock_mock.assert_called_once_with(mock_db, 1, 50)
-
-@patch("routers.checkout.logger.info")
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.stripe.Price.retrieve_async")
+@patch("routers.checkout.stripe.checkout.Session.create_async",
+       return_value=MagicMock(url="https://checkout.stripe.com/c/pay/cs_test_123"))
+def test_create_checkout_session_with_cached_price_id(stripe_checkout_session_mock, price_retrieve_mock,
+                                                      user_mapping_mock, mock_async_db):
+    cached_price_id = "price_cached"
+    price_cache.put(cached_price_id, ticket_id=1)
+    mock_async_db.execute.return_value = MagicMock(rowcount=1)
+
+    response = client.post(
+        f"/create-checkout-session?price_id={cached_price_id}&quantity=1",
+        headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 200
+    assert response.json()["checkout_url"] == "https://checkout.stripe.com/c/pay/cs_test_123"
+    price_retrieve_mock.assert_not_called()
+    assert stripe_checkout_session_mock.call_args.kwargs["line_items"] == [
+        {'price': cached_price_id, 'quantity': 1},
+    ]
+
+
+@patch("routers.checkout.async_crud.create_checkout_session_items")
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.validate_price")
+@patch("routers.checkout.stripe.checkout.Session.create_async")
+def test_create_checkout_session_records_ledger(stripe_checkout_session_mock, validate_price_mock,
+                                                user_mapping_mock, create_checkout_session_items_mock,
+                                                mock_async_db, mock_auth):
+    stripe_checkout_session_mock.return_value = stripe.checkout.Session.construct_from({
+        "id": "cs_test_123",
+        "url": "https://checkout.stripe.com/c/pay/cs_test_123",
+        "line_items": {"data": [{"price": {"id": "price_123", "unit_amount": 1500}, "quantity": 2}]},
+    }, "sk_test")
+    mock_async_db.execute.return_value = MagicMock(rowcount=1)
+
+    response = client.post(
+        "/create-checkout-session?price_id=price_123&quantity=2",
+        headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 200
+    args = create_checkout_session_items_mock.call_args.args
+    assert args[1:4] == (
+        "cs_test_123", mock_auth, [{"price_id": "price_123", "quantity": 2, "unit_amount": 1500}],
+    )
+    assert price_cache.get("price_123").unit_amount == 1500
+
+
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.validate_price")
+@patch("routers.checkout.stripe.checkout.Session.create_async",
+       return_value=MagicMock(url="https://checkout.stripe.com/c/pay/cs_test_123"))
+def test_create_checkout_session_reuses_user_mapping(stripe_checkout_session_mock, validate_price_mock,
+                                                     user_mapping_mock, mock_async_db):
+    mock_async_db.execute.return_value = MagicMock(rowcount=1)
+
+    for _ in range(2):
+        response = client.post(
+            "/create-checkout-session?price_id=price_123&quantity=1",
+            headers={"Authorization": "Bearer token"}
+        )
+        assert response.status_code == 200
+        assert stripe_checkout_session_mock.call_args.kwargs["client_reference_id"] == user_mapping.uuid
+
+    user_mapping_mock.assert_awaited_once()
+
+
+@patch("routers.checkout.async_crud.get_or_create_user_mapping")
+@patch("routers.checkout.stripe.checkout.Session.create_async")
+def test_create_checkout_session_with_known_invalid_price_id(stripe_checkout_session_mock, user_mapping_mock):
+    price_cache.mark_missing("price_missing")
+
+    response = client.post(
+        "/create-checkout-session?price_id=price_missing&quantity=1",
+        headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 404
+    assert response.text == "Price id not found"
+    user_mapping_mock.assert_not_called()
+    stripe_checkout_session_mock.assert_not_called()
+
+@patch("routers.checkout.record_checkout_session")
+@patch("routers.checkout.async_crud.decrement_stocks")
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.validate_price")
+@patch("routers.checkout.stripe.checkout.Session.create_async")
+def test_create_batch_checkout_session(stripe_checkout_session_mock, validate_price_mock, user_mapping_mock,
+                                       decrement_stocks_mock, record_checkout_session_mock, mock_async_db):
+    stripe_checkout_session_mock.return_value = MagicMock(url="https://checkout.stripe.com/c/pay/cs_test_123")
+
+    response = client.post(
+        "/create-checkout-session/batch",
+        json={"items": [
+            {"price_id": "price_match_2", "quantity": 1},
+            {"price_id": "price_match_1", "quantity": 2},
+            {"price_id": "price_match_2", "quantity": 3},
+        ]},
+        headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"checkout_url": "https://checkout.stripe.com/c/pay/cs_test_123"}
+    decrement_stocks_mock.assert_awaited_once_with(mock_async_db, {"price_match_2": 4, "price_match_1": 2})
+    assert stripe_checkout_session_mock.call_args.kwargs["line_items"] == [
+        {'price': "price_match_2", 'quantity': 4},
+        {'price': "price_match_1", 'quantity': 2},
+    ]
+    assert json.loads(stripe_checkout_session_mock.call_args.kwargs["metadata"]["items"]) == [
+        {"price_id": "price_match_2", "quantity": 4},
+        {"price_id": "price_match_1", "quantity": 2},
+    ]
+
+
+@patch("routers.checkout.async_crud.decrement_stocks", side_effect=HTTPException(status_code=400, detail="Not enough stock"))
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.stripe.checkout.Session.create_async")
+def test_create_batch_checkout_session_not_enough_stock(stripe_checkout_session_mock, user_mapping_mock,
+                                                        decrement_stocks_mock):
+    response = client.post(
+        "/create-checkout-session/batch",
+        json={"items": [{"price_id": "price_123", "quantity": 2}, {"price_id": "price_456", "quantity": 1}]},
+        headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 400
+    stripe_checkout_session_mock.assert_not_called()
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.async_crud.decrement_stocks")
+@patch("routers.checkout.async_crud.get_or_create_user_mapping", return_value=user_mapping)
+@patch("routers.checkout.validate_price")
+@patch("routers.checkout.stripe.checkout.Session.create_async", side_effect=Exception("Stripe is down"))
+def test_create_batch_checkout_session_stripe_error_releases_stock(
+        stripe_checkout_session_mock, validate_price_mock, user_mapping_mock, decrement_stocks_mock,
+        increment_stocks_mock, mock_async_db
+):
+    response = client.post(
+        "/create-checkout-session/batch",
+        json={"items": [{"price_id": "price_123", "quantity": 2}, {"price_id": "price_456", "quantity": 1}]},
+        headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 500
+    increment_stocks_mock.assert_awaited_once_with(mock_async_db, {"price_123": 2, "price_456": 1})
+
+
+@pytest.mark.parametrize("body", [
+    {"items": []},
+    {"items": [{"price_id": "price_123", "quantity": 0}]},
+])
+def test_create_batch_checkout_session_invalid_body(body):
+    response = client.post("/create-checkout-session/batch", json=body, headers={"Authorization": "Bearer token"})
+    assert response.status_code == 422
+
+
+@patch("routers.checkout.aio_pika")
+@patch("routers.checkout.TICKETS_CONSUMER_IN_API", False)
+@patch("routers.checkout.reservation_engine", StockReservationEngine(MemoryStockStore()))
 @pytest.mark.asyncio
-async def test_process_message_unhandled_event(logger_info_mock):
-    message = {
-        "event": "unhandled_event",
-    }
-    body = json.dumps(message)
-    
-    await process_message(body)
-    
-    logger_info_mock.assert_called_with("Unhandled event: unhandled_event")
+async def test_memory_engine_requires_tickets_consumer_in_api(aio_pika_mock):
+    with pytest.raises(RuntimeError):
+        async with lifespan(app):
+            pass
+
+    aio_pika_mock.connect_robust.assert_not_called()
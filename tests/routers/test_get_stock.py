@@ -1,17 +1,13 @@
 import logging
-import time
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, patch
 
 import pytest
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
+from prometheus_client import REGISTRY
 
-from auth.auth import get_current_user_id
-from db.database import get_db
 from main import app
-from models.models import TicketStock, UserMapping
-from routers.checkout import DOMAIN, expire_time
+from services.stock_cache import stock_cache
 
 load_dotenv()
 client = TestClient(app)
@@ -19,27 +15,55 @@ client = TestClient(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-@pytest.fixture(scope="module", autouse=True)
-def mock_db():
-    db = MagicMock(spec=Session)
-    app.dependency_overrides[get_db] = lambda: db
-    yield db
+@pytest.fixture(autouse=True)
+def clear_stock_cache():
+    stock_cache.clear()
+    yield
+    stock_cache.clear()
 
-@patch("routers.checkout.get_stock_by_ticket_id")
-def test_get_stock_success(get_stock_by_ticket_id_mock, mock_db):
+@patch("routers.checkout.load_stock", new_callable=AsyncMock, return_value=10)
+def test_get_stock_success(load_stock_mock):
     ticket_id = 1
-    stock_value = {"stock": 10}
-    get_stock_by_ticket_id_mock.return_value = stock_value
 
     response = client.get(f"/stock/{ticket_id}")
     assert response.status_code == 200
-    assert response.json() == stock_value
-    get_stock_by_ticket_id_mock.assert_called_once_with(mock_db, ticket_id)
+    assert response.json() == {"stock": 10}
+    assert response.headers["ETag"] == '"1-10"'
+    assert response.headers["Cache-Control"].startswith("public, max-age=")
+    load_stock_mock.assert_awaited_once_with(ticket_id)
 
-@patch("routers.checkout.get_stock_by_ticket_id", side_effect=Exception("Database error"))
-def test_get_stock_failure(get_stock_by_ticket_id_mock, mock_db):
+@patch("routers.checkout.load_stock", new_callable=AsyncMock, return_value=10)
+def test_get_stock_is_cached(load_stock_mock):
+    hits = REGISTRY.get_sample_value("payments_stock_cache_lookups_total", {"result": "hit"}) or 0.0
+    for _ in range(3):
+        assert client.get("/stock/1").json() == {"stock": 10}
+
+    load_stock_mock.assert_awaited_once()
+    assert REGISTRY.get_sample_value("payments_stock_cache_lookups_total", {"result": "hit"}) == hits + 2
+
+@patch("routers.checkout.load_stock", new_callable=AsyncMock, return_value=10)
+def test_get_stock_not_modified(load_stock_mock):
+    response = client.get("/stock/1", headers={"If-None-Match": '"1-10"'})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == '"1-10"'
+
+    response = client.get("/stock/1", headers={"If-None-Match": '"1-11"'})
+    assert response.status_code == 200
+
+@patch("routers.checkout.load_stock", new_callable=AsyncMock, side_effect=Exception("Database error"))
+def test_get_stock_failure(load_stock_mock):
     ticket_id = 1
 
-    response = client.get(f"/stock/{ticket_id}")
-    assert response.status_code == 500
-    get_stock_by_ticket_id_mock.assert_called_once_with(mock_db, ticket_id)
\ No newline at end of file
+    for _ in range(2):
+        response = client.get(f"/stock/{ticket_id}")
+        assert response.status_code == 500
+    # Failures aren't cached
+    assert load_stock_mock.await_count == 2
+
+@patch("routers.checkout.load_stock", new_callable=AsyncMock, return_value=10)
+def test_metrics_time_get_stock(load_stock_mock):
+    client.get("/stock/1")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'payments_handler_duration_seconds_count{handler="get_stock"}' in response.text
@@ -5,16 +5,22 @@ from collections import namedtuple
 from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock, call, patch
 
+import httpx
 import pytest
+import pytest_asyncio
 from aio_pika import Message
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
-from sqlalchemy import orm
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from crud.crud import get_stock_ticket_id_by_price_id
+from crud import async_crud
 from db.database import get_db
 from main import app
-from routers.checkout import webhook_secret
+from models.models import (CheckoutSession, OutboxMessage, ProcessedEvent,
+                           TicketStock)
+from routers.checkout import processed_events, webhook_secret
 
 load_dotenv()
 client = TestClient(app)
@@ -22,34 +28,53 @@ client = TestClient(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-StripeEventDataObject = namedtuple('StripeEventDataObject', ['id'])
+StripeEventDataObject = namedtuple('StripeEventDataObject', ['id', 'client_reference_id', 'metadata', 'amount_subtotal'])
 StripeEventData = namedtuple('StripeEventData', ['object'])
-StripeEvent = namedtuple('StripeEvent', ['type', 'data'])
+StripeEvent = namedtuple('StripeEvent', ['id', 'type', 'data'])
 UserMapping = namedtuple('UserMapping', ['uuid', 'user_id'])
 Price = namedtuple('Price', ['id', 'product', 'unit_amount'])
 LineItem = namedtuple('LineItem', ['price', 'quantity'])
 LineItems = namedtuple('LineItems', ['data'])
-Session = namedtuple('Session', ['line_items', 'client_reference_id'])
+Session = namedtuple('Session', ['line_items', 'client_reference_id', 'metadata'])
 
-event_data_object = StripeEventDataObject(id="evt_123")
-event_data = StripeEventData(object=event_data_object)
-checkout_session_completed = StripeEvent(type="checkout.session.completed", data=event_data)
-checkout_session_expired = StripeEvent(type="checkout.session.expired", data=event_data)
 user_mapping = UserMapping(uuid="uuid_789", user_id="user_123")
 price = Price(id="price_456", product="product_789", unit_amount=1)
 line_item = LineItem(price=price, quantity=1)
 line_items = LineItems(data=[line_item])
-session = Session(line_items=line_items, client_reference_id=user_mapping.uuid)
+session = Session(line_items=line_items, client_reference_id=user_mapping.uuid, metadata={})
+
+# Sessions created before line items were written to the metadata
+event_data_object = StripeEventDataObject(id="cs_123", client_reference_id=user_mapping.uuid, metadata={},
+                                          amount_subtotal=1)
+event_data = StripeEventData(object=event_data_object)
+checkout_session_completed = StripeEvent(id="evt_completed", type="checkout.session.completed", data=event_data)
+checkout_session_expired = StripeEvent(id="evt_expired", type="checkout.session.expired", data=event_data)
 
+event_data_object_with_metadata = event_data_object._replace(metadata={
+    "user_id": user_mapping.user_id,
+    "items": json.dumps([{"price_id": price.id, "quantity": 2}]),
+})
+event_data_with_metadata = StripeEventData(object=event_data_object_with_metadata._replace(amount_subtotal=2))
+checkout_session_completed_with_metadata = StripeEvent(id="evt_completed_metadata", type="checkout.session.completed", data=event_data_with_metadata)
+checkout_session_expired_with_metadata = StripeEvent(id="evt_expired_metadata", type="checkout.session.expired", data=event_data_with_metadata)
 
 
 @pytest.fixture(scope="module", autouse=True)
 def mock_db():
-    db = MagicMock(spec=orm.Session)
+    db = AsyncMock(spec=AsyncSession)
+    # Sessions missing from the checkout_session ledger unless a test says otherwise
+    db.execute.return_value = MagicMock()
     app.dependency_overrides[get_db] = lambda: db
     yield db
 
 
+@pytest.fixture(autouse=True)
+def clear_processed_events():
+    processed_events.clear()
+    yield
+    processed_events.clear()
+
+
 def test_call_webhook_with_no_signature():
     response = client.post("/webhooks/checkout")
     assert response.status_code == 400
@@ -67,20 +92,20 @@ def test_webhook_checkout_with_value_error(webhook_construct_event_mock):
     webhook_construct_event_mock.assert_called_once_with(b"", "valid", webhook_secret)
     assert response.text == ""
 
-@patch("routers.checkout.stripe.checkout.Session.retrieve", return_value=session)
+@patch("routers.checkout.stripe.checkout.Session.retrieve_async", return_value=session)
 @patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired)
 def test_webhook_checkout_expired_with_valid_signature(webhook_construct_event_mock, session_retrieve_mock):
     response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
     assert response.status_code == 200
     webhook_construct_event_mock.assert_called_once_with(b"", "valid", webhook_secret)
-    session_retrieve_mock.assert_called_once_with(checkout_session_expired.data.object.id, expand=['line_items'])
+    session_retrieve_mock.assert_awaited_once_with(checkout_session_expired.data.object.id, expand=['line_items'])
     assert response.text == ""
 
 
-@patch("routers.checkout.crud.get_user_mapping_by_uuid", return_value=user_mapping)
-@patch("routers.checkout.stripe.checkout.Session.retrieve", return_value=session)
+@patch("routers.checkout.async_crud.get_user_mapping_by_uuid", return_value=user_mapping)
+@patch("routers.checkout.stripe.checkout.Session.retrieve_async", return_value=session)
 @patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_completed)
-@patch("routers.checkout.get_stock_ticket_id_by_price_id", return_value="ticket_123")
+@patch("routers.checkout.async_crud.get_stock_ticket_id_by_price_id", return_value="ticket_123")
 @patch("routers.checkout.datetime")
 def test_webhook_checkout_completed_with_valid_signature(
         datetime_mock, get_stock_ticket_id_by_price_id_mock, webhook_construct_event_mock, session_retrieve_mock, get_user_mapping_by_uuid_mock, mock_db
@@ -88,26 +113,282 @@ def test_webhook_checkout_completed_with_valid_signature(
     fixed_datetime = datetime(2025, 1, 9, 17, 0, 0)
     datetime_mock.now.return_value = fixed_datetime
 
-    with patch("routers.checkout.exchange", MagicMock()) as exchange_mock:
-        publish_mock = AsyncMock(return_value=None)
-        exchange_mock.publish = publish_mock
+    with patch("routers.checkout.async_crud.add_outbox_messages", return_value=[]) as add_outbox_messages_mock, \
+            patch("routers.checkout.payments_publisher") as payments_publisher_mock:
         response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
         assert response.status_code == 200
         assert response.text == ""
         webhook_construct_event_mock.assert_called_once_with(b"", "valid", webhook_secret)
-        session_retrieve_mock.assert_called_once_with(checkout_session_completed.data.object.id, expand=['line_items'])
-        get_user_mapping_by_uuid_mock.assert_called_once_with(mock_db, user_mapping.uuid)
-        get_stock_ticket_id_by_price_id_mock.assert_called_once_with(mock_db, session.line_items.data[0].price.id)
-        assert publish_mock.call_count == 1
-        _, kwargs = publish_mock.call_args
-        assert kwargs.get('routing_key') == "payments.messages"
-        assert kwargs.get('message').body == json.dumps({
+        session_retrieve_mock.assert_awaited_once_with(checkout_session_completed.data.object.id, expand=['line_items'])
+        get_user_mapping_by_uuid_mock.assert_awaited_once_with(mock_db, user_mapping.uuid)
+        get_stock_ticket_id_by_price_id_mock.assert_awaited_once_with(mock_db, session.line_items.data[0].price.id)
+        add_outbox_messages_mock.assert_awaited_once_with(mock_db, "payments.messages", [json.dumps({
             "event": checkout_session_completed.type,
             "user_id": user_mapping.user_id,
             "ticket_id": "ticket_123",
             "quantity": session.line_items.data[0].quantity,
             "unit_amount": session.line_items.data[0].price.unit_amount / 100,
             "created_at": str(fixed_datetime),
-        }).encode()
+        })], None)
+        payments_publisher_mock.enqueue.assert_called_once_with([])
+
+
+
+@patch("routers.checkout.async_crud.get_user_mapping_by_uuid")
+@patch("routers.checkout.stripe.checkout.Session.retrieve_async")
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_completed_with_metadata)
+@patch("routers.checkout.async_crud.get_stock_ticket_id_by_price_id", return_value="ticket_123")
+def test_webhook_checkout_completed_reads_session_metadata(
+        get_stock_ticket_id_by_price_id_mock, webhook_construct_event_mock, session_retrieve_mock, get_user_mapping_by_uuid_mock
+):
+    with patch("routers.checkout.async_crud.add_outbox_messages", return_value=[]) as add_outbox_messages_mock:
+        response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+        assert response.status_code == 200
+        session_retrieve_mock.assert_not_called()
+        get_user_mapping_by_uuid_mock.assert_not_called()
+        [body] = map(json.loads, add_outbox_messages_mock.call_args.args[2])
+        assert body["user_id"] == user_mapping.user_id
+        assert body["quantity"] == 2
+        assert body["unit_amount"] == 0.01
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.stripe.checkout.Session.retrieve_async")
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_expired_reads_session_metadata(
+        webhook_construct_event_mock, session_retrieve_mock, increment_stocks_mock, mock_db
+):
+    response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    assert response.status_code == 200
+    session_retrieve_mock.assert_not_called()
+    increment_stocks_mock.assert_awaited_once_with(mock_db, {price.id: 2}, commit=False)
+
+
+ledger_items = [
+    CheckoutSession(session_id="cs_123", user_id="user_ledger", price_id="price_ledger", quantity=3,
+                    unit_amount=500, status=CheckoutSession.OPEN),
+]
+
+
+@patch("routers.checkout.async_crud.complete_checkout_session", return_value={})
+@patch("routers.checkout.async_crud.get_checkout_session_items", return_value=ledger_items)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_completed_with_metadata)
+@patch("routers.checkout.async_crud.get_stock_ticket_id_by_price_id", return_value="ticket_123")
+def test_webhook_checkout_completed_reads_ledger(
+        get_stock_ticket_id_by_price_id_mock, webhook_construct_event_mock, get_checkout_session_items_mock,
+        complete_checkout_session_mock, mock_db
+):
+    with patch("routers.checkout.async_crud.add_outbox_messages", return_value=[]) as add_outbox_messages_mock:
+        response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+        assert response.status_code == 200
+        get_checkout_session_items_mock.assert_awaited_once_with(mock_db, "cs_123")
+        complete_checkout_session_mock.assert_awaited_once_with(mock_db, "cs_123", apply_stock=True, commit=False)
+        get_stock_ticket_id_by_price_id_mock.assert_awaited_once_with(mock_db, "price_ledger")
+        [body] = map(json.loads, add_outbox_messages_mock.call_args.args[2])
+        assert body["user_id"] == "user_ledger"
+        assert body["quantity"] == 3
+        assert body["unit_amount"] == 5
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.async_crud.expire_checkout_sessions", return_value={"price_ledger": 3})
+@patch("routers.checkout.async_crud.get_checkout_session_items", return_value=ledger_items)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_expired_reads_ledger(
+        webhook_construct_event_mock, get_checkout_session_items_mock, expire_checkout_sessions_mock,
+        increment_stocks_mock, mock_db
+):
+    response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    assert response.status_code == 200
+    expire_checkout_sessions_mock.assert_awaited_once_with(mock_db, ["cs_123"], apply_stock=True, commit=False)
+    increment_stocks_mock.assert_not_called()
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.async_crud.expire_checkout_sessions", return_value={})
+@patch("routers.checkout.async_crud.get_checkout_session_items", return_value=ledger_items)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_expired_for_closed_session(
+        webhook_construct_event_mock, get_checkout_session_items_mock, expire_checkout_sessions_mock,
+        increment_stocks_mock
+):
+    response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    assert response.status_code == 200
+    increment_stocks_mock.assert_not_called()
+
+
+@patch("routers.checkout.reservation_engine")
+@patch("routers.checkout.async_crud.expire_checkout_sessions", return_value={"price_ledger": 3})
+@patch("routers.checkout.async_crud.get_checkout_session_items", return_value=ledger_items)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_expired_releases_reservation_counters_once_committed(
+        webhook_construct_event_mock, get_checkout_session_items_mock, expire_checkout_sessions_mock,
+        reservation_engine_mock, mock_db
+):
+    failing_client = TestClient(app, raise_server_exceptions=False)
+    mock_db.commit.side_effect = RuntimeError("database is down")
+    try:
+        response = failing_client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    finally:
+        mock_db.commit.side_effect = None
+    assert response.status_code == 500
+    reservation_engine_mock.release.assert_not_called()
+
+    response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    assert response.status_code == 200
+    expire_checkout_sessions_mock.assert_awaited_with(mock_db, ["cs_123"], apply_stock=False, commit=False)
+    reservation_engine_mock.release.assert_called_once_with("price_ledger", 3)
+
+
+@pytest_asyncio.fixture
+async def ledger_db(session_factory):
+    """
+    Real database holding session cs_123, with 3 of its ticket's 10 tickets reserved.
+    """
+    async with session_factory() as db:
+        db.add_all([
+            TicketStock(ticket_id=1, stripe_price_id="price_ledger", stock=7),
+            CheckoutSession(session_id="cs_123", user_id="user_ledger", price_id="price_ledger", quantity=3,
+                            unit_amount=500, expires_at=datetime(2025, 1, 1)),
+        ])
+        await db.commit()
+
+    async def get_ledger_db():
+        async with session_factory() as db:
+            yield db
+
+    mocked_get_db = app.dependency_overrides[get_db]
+    app.dependency_overrides[get_db] = get_ledger_db
+    yield session_factory
+    app.dependency_overrides[get_db] = mocked_get_db
+
+
+def fail_once(session_factory, statement: str):
+    """
+    Make the first execution of a statement starting with ``statement`` fail.
+    """
+    failed = []
+
+    @event.listens_for(session_factory.kw["bind"].sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, sql, parameters, context, executemany):
+        if not failed and sql.startswith(statement):
+            failed.append(sql)
+            raise OperationalError(sql, parameters, Exception("Lost connection to MySQL server"))
+
+
+async def post_webhook() -> int:
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as async_client:
+        response = await async_client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    return response.status_code
+
+
+async def get_ledger_state(session_factory) -> tuple[int, str]:
+    async with session_factory() as db:
+        stock = (await db.execute(select(TicketStock.stock))).scalar_one()
+        status = (await db.execute(select(CheckoutSession.status))).scalar_one()
+    return stock, status
+
+
+async def get_processed_events(session_factory) -> list[str]:
+    async with session_factory() as db:
+        return list((await db.execute(select(ProcessedEvent.event_id))).scalars())
+
+
+async def get_outbox_ids(session_factory) -> list[int]:
+    async with session_factory() as db:
+        return list((await db.execute(select(OutboxMessage.id))).scalars())
+
+
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+@pytest.mark.asyncio
+async def test_webhook_checkout_expired_retry_after_failed_stock_release(webhook_construct_event_mock, ledger_db):
+    fail_once(ledger_db, "UPDATE ticket_stock")
+
+    assert await post_webhook() == 500
+    assert await get_ledger_state(ledger_db) == (7, CheckoutSession.OPEN)
+    assert await get_processed_events(ledger_db) == []
+
+    # Stripe's retry
+    assert await post_webhook() == 200
+    assert await get_ledger_state(ledger_db) == (10, CheckoutSession.EXPIRED)
+    assert await get_processed_events(ledger_db) == ["evt_expired_metadata"]
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.async_crud.claim_event", return_value=True)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_replay_hits_processed_events_cache(
+        webhook_construct_event_mock, claim_event_mock, increment_stocks_mock, mock_db
+):
+    for _ in range(3):
+        response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+        assert response.status_code == 200
+    claim_event_mock.assert_awaited_once_with(mock_db, "evt_expired_metadata", "checkout.session.expired")
+    increment_stocks_mock.assert_awaited_once_with(mock_db, {price.id: 2}, commit=False)
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.async_crud.claim_event", return_value=False)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_event_already_claimed(webhook_construct_event_mock, claim_event_mock, increment_stocks_mock):
+    response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    assert response.status_code == 200
+    increment_stocks_mock.assert_not_called()
+    assert "evt_expired_metadata" in processed_events
+
+
+@patch("routers.checkout.async_crud.claim_event", return_value=True)
+@patch("routers.checkout.async_crud.increment_stocks", side_effect=RuntimeError("database is down"))
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_failure_rolls_back_claim(
+        webhook_construct_event_mock, increment_stocks_mock, claim_event_mock, mock_db
+):
+    mock_db.reset_mock()
+    failing_client = TestClient(app, raise_server_exceptions=False)
+    response = failing_client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    assert response.status_code == 500
+    mock_db.rollback.assert_awaited_once()
+    mock_db.commit.assert_not_awaited()
+    assert "evt_expired_metadata" not in processed_events
+
+
+@patch("routers.checkout.async_crud.increment_stocks")
+@patch("routers.checkout.async_crud.claim_event", return_value=True)
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_expired_with_metadata)
+def test_webhook_checkout_concurrent_claim_is_a_replay(
+        webhook_construct_event_mock, claim_event_mock, increment_stocks_mock, mock_db
+):
+    mock_db.reset_mock()
+    mock_db.commit.side_effect = IntegrityError("INSERT", {}, Exception("Duplicate entry"))
+    try:
+        response = client.post("/webhooks/checkout", headers={"Stripe-Signature": "valid"})
+    finally:
+        mock_db.commit.side_effect = None
+    assert response.status_code == 200
+    mock_db.rollback.assert_awaited_once()
+    assert "evt_expired_metadata" in processed_events
+
+
+@patch("routers.checkout.payments_publisher")
+@patch("routers.checkout.stripe.Webhook.construct_event", return_value=checkout_session_completed_with_metadata)
+@pytest.mark.asyncio
+async def test_webhook_checkout_completed_after_sweep_retry_after_failed_stock_retake(
+        webhook_construct_event_mock, payments_publisher_mock, ledger_db
+):
+    async with ledger_db() as db:
+        # Swept before the payment landed
+        await async_crud.expire_checkout_sessions(db, ["cs_123"])
+    fail_once(ledger_db, "UPDATE ticket_stock")
 
+    assert await post_webhook() == 500
+    assert await get_ledger_state(ledger_db) == (10, CheckoutSession.EXPIRED)
+    assert await get_outbox_ids(ledger_db) == []
+    payments_publisher_mock.enqueue.assert_not_called()
 
+    # Stripe's retry
+    assert await post_webhook() == 200
+    assert await get_ledger_state(ledger_db) == (7, CheckoutSession.COMPLETE)
+    [message_id] = await get_outbox_ids(ledger_db)
+    [(entries,)] = [call_args.args for call_args in payments_publisher_mock.enqueue.call_args_list]
+    assert [entry[0] for entry in entries] == [message_id]
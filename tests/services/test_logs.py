@@ -0,0 +1,74 @@
+import io
+import json
+import logging
+import queue
+
+from services.logs import (JsonFormatter, NonBlockingQueueHandler,
+                           SamplingFilter, payload_summary, setup_logging,
+                           stop_logging)
+
+
+class CountingArg:
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "arg"
+
+
+def make_record(msg: str = "Stock decremented by %s", args=(2,), **extra) -> logging.LogRecord:
+    record = logging.LogRecord("payments", logging.INFO, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter():
+    line = json.loads(JsonFormatter().format(make_record(price_id="price_1", sample_rate=0.1)))
+
+    assert line["message"] == "Stock decremented by 2"
+    assert (line["level"], line["logger"], line["price_id"]) == ("INFO", "payments", "price_1")
+    assert "sample_rate" not in line
+
+
+def test_sampling_filter():
+    sampling = SamplingFilter()
+
+    assert sampling.filter(make_record())
+    assert sampling.filter(make_record(sample_rate=1))
+    assert not sampling.filter(make_record(sample_rate=0))
+
+
+def test_queue_handler_defers_formatting_and_never_blocks():
+    log_queue = queue.Queue(maxsize=1)
+    handler = NonBlockingQueueHandler(log_queue)
+    arg = CountingArg()
+
+    handler.handle(make_record("Loaded %s", (arg,)))
+    handler.handle(make_record())
+
+    assert arg.formatted == 0
+    assert log_queue.get_nowait().args == (arg,)
+    assert handler.dropped == 1
+
+
+def test_setup_logging_writes_json_lines():
+    # Importing main already set it up
+    stop_logging()
+    stream = io.StringIO()
+    setup_logging(level="INFO", stream=stream)
+    try:
+        logging.getLogger("payments.test").info("Sending %s messages", 3)
+        logging.getLogger("payments.test").debug("Not written")
+    finally:
+        stop_logging()
+
+    [line] = stream.getvalue().splitlines()
+    assert json.loads(line)["message"] == "Sending 3 messages"
+
+
+def test_payload_summary_hides_the_content():
+    summary = payload_summary(b'{"customer_email": "jane@example.com"}')
+
+    assert summary.startswith("38 bytes, sha256 ")
+    assert "jane" not in summary
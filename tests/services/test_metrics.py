@@ -0,0 +1,64 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+
+from services.metrics import (MetricsMiddleware, instrument_engine,
+                              metrics_payload, record_reservation,
+                              record_reservation_failure)
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_middleware_times_requests_by_endpoint():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    def read_item(item_id: int):
+        return {"item_id": item_id}
+
+    client = TestClient(app)
+    before = sample("payments_handler_duration_seconds_count", handler="read_item")
+
+    client.get("/items/1")
+    client.get("/items/2")
+    # Unmatched routes aren't timed
+    client.get("/missing")
+
+    assert sample("payments_handler_duration_seconds_count", handler="read_item") == before + 2
+
+
+def test_instrument_engine_times_queries_by_verb():
+    engine = create_engine("sqlite://")
+    instrument_engine(engine)
+    before = sample("payments_dependency_duration_seconds_count", dependency="db", operation="select")
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+    assert sample("payments_dependency_duration_seconds_count", dependency="db", operation="select") == before + 1
+
+
+def test_record_reservation():
+    before = sample("payments_stock_reservations_total", price_id="price_metrics", result="success")
+    before_unknown = sample("payments_stock_reservations_total", price_id="unknown", result="not_found")
+
+    record_reservation("price_metrics", "success")
+    record_reservation_failure("price_metrics", 400)
+    # Unknown price ids don't get their own series
+    record_reservation_failure("price_forged", 404)
+
+    assert sample("payments_stock_reservations_total", price_id="price_metrics", result="success") == before + 1
+    assert sample("payments_stock_reservations_total", price_id="price_metrics", result="out_of_stock") >= 1
+    assert sample("payments_stock_reservations_total", price_id="unknown", result="not_found") == before_unknown + 1
+    assert sample("payments_stock_reservations_total", price_id="price_forged", result="not_found") == 0
+
+
+def test_metrics_payload():
+    payload, content_type = metrics_payload()
+
+    assert content_type.startswith("text/plain")
+    assert b"payments_handler_duration_seconds" in payload
@@ -0,0 +1,42 @@
+from services.price_cache import PriceCache, PriceInfo
+
+
+def test_warm_from_ticket_stock():
+    cache = PriceCache()
+
+    count = cache.warm([(1, "price_123"), (2, "price_456")])
+
+    assert count == 2
+    assert cache.get("price_123") == PriceInfo("price_123", ticket_id=1)
+    assert cache.get("price_789") is None
+
+
+def test_put_keeps_known_fields():
+    cache = PriceCache()
+    cache.put("price_123", ticket_id=1)
+
+    price = cache.put("price_123", unit_amount=1000, currency="eur")
+
+    assert price == PriceInfo("price_123", ticket_id=1, unit_amount=1000, currency="eur")
+
+
+def test_missing_prices():
+    cache = PriceCache()
+    cache.put("price_123", ticket_id=1)
+
+    cache.mark_missing("price_123")
+
+    assert cache.is_missing("price_123")
+    assert cache.get("price_123") is None
+
+    cache.put("price_123", ticket_id=1)
+
+    assert not cache.is_missing("price_123")
+
+
+def test_missing_prices_expire():
+    cache = PriceCache(negative_ttl=0)
+
+    cache.mark_missing("price_123")
+
+    assert not cache.is_missing("price_123")
@@ -0,0 +1,103 @@
+import asyncio
+from datetime import timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy import select
+
+from models.models import OutboxMessage, utcnow
+from services.publisher import OutboxPublisher
+
+
+async def add_messages(session_factory, count: int, age: float = 0) -> list[tuple]:
+    async with session_factory() as db:
+        messages = [
+            OutboxMessage(routing_key="payments.messages", body=f'{{"n": {i}}}',
+                          created_at=utcnow() - timedelta(seconds=age))
+            for i in range(count)
+        ]
+        db.add_all(messages)
+        await db.commit()
+        return [(message.id, message.routing_key, message.body, None) for message in messages]
+
+
+async def outbox_ids(session_factory) -> list[int]:
+    async with session_factory() as db:
+        return list((await db.execute(select(OutboxMessage.id).order_by(OutboxMessage.id))).scalars())
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_deletes_confirmed_messages(session_factory):
+    publisher = OutboxPublisher(session_factory)
+    exchange = MagicMock(publish=AsyncMock())
+    publisher.attach(exchange)
+    entries = await add_messages(session_factory, 3)
+    publisher.enqueue(entries)
+
+    assert await publisher.publish_batch(await publisher.next_batch()) == [entry[0] for entry in entries]
+
+    assert exchange.publish.await_count == 3
+    message = exchange.publish.await_args_list[0].args[0]
+    assert message.body == b'{"n": 0}'
+    assert message.message_id == str(entries[0][0])
+    assert exchange.publish.await_args_list[0].kwargs["routing_key"] == "payments.messages"
+    assert await outbox_ids(session_factory) == []
+
+
+@pytest.mark.asyncio
+async def test_unconfirmed_message_stays_in_the_outbox(session_factory):
+    publisher = OutboxPublisher(session_factory, retry_delay=0)
+    entries = await add_messages(session_factory, 2)
+    publisher.attach(MagicMock(publish=AsyncMock(side_effect=[None, RuntimeError("nack")])))
+
+    assert await publisher.publish_batch(entries) == [entries[0][0]]
+    assert await outbox_ids(session_factory) == [entries[1][0]]
+
+    # Polled back and published again
+    publisher.attach(MagicMock(publish=AsyncMock()))
+    assert await publisher.poll() == 1
+    await publisher.publish_batch(await publisher.next_batch())
+    assert await outbox_ids(session_factory) == []
+
+
+@pytest.mark.asyncio
+async def test_full_buffer_leaves_messages_to_the_poll(session_factory):
+    publisher = OutboxPublisher(session_factory, buffer_size=2)
+    entries = await add_messages(session_factory, 3, age=60)
+
+    assert publisher.enqueue(entries) == 2
+    # Queued messages aren't queued twice by a poll
+    assert await publisher.poll() == 0
+    await publisher.next_batch()
+    assert await publisher.poll() == 1
+
+
+@pytest.mark.asyncio
+async def test_poll_skips_recent_messages(session_factory):
+    publisher = OutboxPublisher(session_factory, retry_delay=30)
+    await add_messages(session_factory, 1, age=60)
+    await add_messages(session_factory, 1)
+
+    assert await publisher.poll() == 1
+    assert await publisher.poll(min_age=0) == 1
+
+
+@pytest.mark.asyncio
+async def test_next_batch_stops_at_batch_size_or_linger(session_factory):
+    publisher = OutboxPublisher(session_factory, batch_size=2, linger=0.01)
+    publisher.enqueue([(i, "payments.messages", "{}", None) for i in range(3)])
+
+    assert [entry[0] for entry in await publisher.next_batch()] == [0, 1]
+    assert [entry[0] for entry in await publisher.next_batch()] == [2]
+    assert await publisher.next_batch(timeout=0.01) == []
+
+
+@pytest.mark.asyncio
+async def test_drain_publishes_buffered_messages(session_factory):
+    publisher = OutboxPublisher(session_factory, batch_size=2)
+    publisher.attach(MagicMock(publish=AsyncMock()))
+    publisher.enqueue(await add_messages(session_factory, 5))
+
+    await asyncio.wait_for(publisher.drain(), 1)
+
+    assert await outbox_ids(session_factory) == []
@@ -0,0 +1,160 @@
+import threading
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from services.reservations import (MemoryStockStore, SQLiteStockStore,
+                                   StockReservationEngine,
+                                   create_engine_from_env)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStockStore()
+    return SQLiteStockStore(str(tmp_path / "stock.db"))
+
+
+@patch("services.reservations.async_crud.get_stock_by_price_id", new_callable=AsyncMock, return_value={"stock": 5})
+@pytest.mark.asyncio
+async def test_reserve_loads_counter_once(get_stock_by_price_id_mock, store):
+    mock_db = AsyncMock(spec=AsyncSession)
+    engine = StockReservationEngine(store)
+
+    await engine.reserve(mock_db, "price_123", 2)
+    await engine.reserve(mock_db, "price_123", 3)
+
+    get_stock_by_price_id_mock.assert_called_once_with(mock_db, "price_123")
+    assert store.get("price_123") == 0
+
+
+@patch("services.reservations.async_crud.get_stock_by_price_id", new_callable=AsyncMock, return_value={"stock": 1})
+@pytest.mark.asyncio
+async def test_reserve_not_enough_stock(get_stock_by_price_id_mock, store):
+    engine = StockReservationEngine(store)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await engine.reserve(AsyncMock(spec=AsyncSession), "price_123", 2)
+
+    assert exc_info.value.status_code == 400
+    assert store.get("price_123") == 1
+
+
+@patch("services.reservations.async_crud.get_stock_by_price_id", new_callable=AsyncMock,
+       side_effect=HTTPException(status_code=404, detail="Ticket not found"))
+@pytest.mark.asyncio
+async def test_reserve_unknown_price(get_stock_by_price_id_mock, store):
+    engine = StockReservationEngine(store)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await engine.reserve(AsyncMock(spec=AsyncSession), "price_unknown", 1)
+
+    assert exc_info.value.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_reserve_many_is_all_or_nothing(store):
+    engine = StockReservationEngine(store)
+    store.seed("price_123", 10)
+    store.seed("price_456", 1)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await engine.reserve_many(AsyncMock(spec=AsyncSession), {"price_456": 2, "price_123": 4})
+
+    assert exc_info.value.status_code == 400
+    assert store.get("price_123") == 10
+    assert store.get("price_456") == 1
+    assert store.take_pending() == {}
+
+
+@patch("services.reservations.crud.apply_stock_deltas")
+@pytest.mark.asyncio
+async def test_flush_writes_net_deltas(apply_stock_deltas_mock, store):
+    mock_db = MagicMock(spec=Session)
+    engine = StockReservationEngine(store)
+    store.seed("price_123", 10)
+    store.seed("price_456", 10)
+
+    await engine.reserve(AsyncMock(spec=AsyncSession), "price_123", 4)
+    engine.release("price_123", 1)
+    await engine.reserve(AsyncMock(spec=AsyncSession), "price_456", 2)
+    engine.release("price_456", 2)
+
+    assert engine.flush(mock_db) == {"price_123": -3}
+    apply_stock_deltas_mock.assert_called_once_with(mock_db, {"price_123": -3})
+    assert engine.flush(mock_db) == {}
+
+
+@patch("services.reservations.crud.apply_stock_deltas", side_effect=Exception("Database error"))
+@pytest.mark.asyncio
+async def test_flush_failure_keeps_deltas(apply_stock_deltas_mock, store):
+    mock_db = MagicMock(spec=Session)
+    engine = StockReservationEngine(store)
+    store.seed("price_123", 10)
+    await engine.reserve(AsyncMock(spec=AsyncSession), "price_123", 4)
+
+    with pytest.raises(Exception):
+        engine.flush(mock_db)
+
+    assert store.take_pending() == {"price_123": -4}
+
+
+@pytest.mark.asyncio
+async def test_flush_between_stock_read_and_seed(store):
+    engine = StockReservationEngine(store)
+    db_stock = {"price_123": 10}
+    # A swept session paid for late, taken back before the counter is loaded
+    engine.release("price_123", -3)
+
+    def apply_stock_deltas(db, deltas):
+        for price_id, delta in deltas.items():
+            db_stock[price_id] += delta
+
+    flusher = threading.Thread(target=engine.flush, args=(MagicMock(spec=Session),))
+
+    async def get_stock_by_price_id(db, price_id):
+        stock = db_stock[price_id]
+        flusher.start()
+        # Blocked on the flush lock until the counter is seeded
+        flusher.join(0.1)
+        return {"stock": stock}
+
+    with patch("services.reservations.crud.apply_stock_deltas", side_effect=apply_stock_deltas), \
+            patch("services.reservations.async_crud.get_stock_by_price_id", side_effect=get_stock_by_price_id):
+        await engine.reserve(AsyncMock(spec=AsyncSession), "price_123", 2)
+        flusher.join()
+        engine.flush(MagicMock(spec=Session))
+
+    assert db_stock["price_123"] == 5
+    assert store.get("price_123") == 5
+
+
+@pytest.mark.asyncio
+async def test_reconcile_keeps_unflushed_deltas(store):
+    engine = StockReservationEngine(store)
+    store.seed("price_123", 10)
+    await engine.reserve(AsyncMock(spec=AsyncSession), "price_123", 4)
+
+    engine.reconcile("price_123", 20)
+
+    assert store.get("price_123") == 16
+
+
+def test_release_before_counter_is_loaded(store):
+    engine = StockReservationEngine(store)
+
+    engine.release("price_123", 3)
+    assert store.get("price_123") is None
+
+    store.seed("price_123", 10)
+    assert store.get("price_123") == 13
+    assert store.take_pending() == {"price_123": 3}
+
+
+def test_create_engine_from_env(tmp_path):
+    assert create_engine_from_env("") is None
+    assert isinstance(create_engine_from_env("memory").store, MemoryStockStore)
+    assert isinstance(create_engine_from_env(f"sqlite:///{tmp_path}/stock.db").store, SQLiteStockStore)
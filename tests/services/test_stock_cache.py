@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from services.price_cache import PriceCache
+from services.stock_cache import StockCache
+
+
+def lookups() -> dict:
+    return {
+        result: REGISTRY.get_sample_value("payments_stock_cache_lookups_total", {"result": result}) or 0.0
+        for result in ("hit", "miss", "coalesced")
+    }
+
+
+def counted_since(before: dict) -> dict:
+    return {result: count - before[result] for result, count in lookups().items()}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_load():
+    cache = StockCache()
+    before = lookups()
+    loads = []
+
+    async def loader(ticket_id):
+        loads.append(ticket_id)
+        await asyncio.sleep(0.01)
+        return 10
+
+    assert await asyncio.gather(*(cache.get(1, loader) for _ in range(5))) == [10] * 5
+    assert await cache.get(1, loader) == 10
+
+    assert loads == [1]
+    assert counted_since(before) == {"hit": 1, "miss": 1, "coalesced": 4}
+
+
+@pytest.mark.asyncio
+async def test_load_started_before_invalidation_is_not_cached():
+    cache = StockCache()
+    stocks = iter([10, 7])
+
+    async def loader(ticket_id):
+        stock = next(stocks)
+        cache.invalidate(ticket_id)  # a write lands while the SELECT runs
+        return stock
+
+    assert await cache.get(1, loader) == 10
+    assert await cache.get(1, loader) == 7
+
+
+@pytest.mark.asyncio
+async def test_invalidate_prices(monkeypatch):
+    prices = PriceCache()
+    prices.put("price_1", ticket_id=1)
+    monkeypatch.setattr("services.stock_cache.price_cache", prices)
+    cache = StockCache()
+
+    async def loader(ticket_id):
+        return ticket_id * 10
+
+    await cache.get(1, loader)
+    await cache.get(2, loader)
+    before = lookups()
+
+    cache.invalidate_prices(["price_1"])
+    await cache.get(2, loader)
+    await cache.get(1, loader)
+    assert counted_since(before) == {"hit": 1, "miss": 1, "coalesced": 0}
+
+    # Unknown price id, every ticket may be affected
+    cache.invalidate_prices(["price_unknown"])
+    await cache.get(2, loader)
+    assert counted_since(before) == {"hit": 1, "miss": 2, "coalesced": 0}
@@ -0,0 +1,77 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import stripe
+
+from services.stripe_client import close_stripe_client, open_stripe_client
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the two Stripe endpoints used by checkout.
+    """
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        price_id = self.path.rsplit("/", 1)[-1]
+        if price_id == "price_123":
+            self._send(200, {"id": price_id, "object": "price", "unit_amount": 1000, "currency": "eur"})
+        else:
+            self._send(404, {"error": {"type": "invalid_request_error", "message": "No such price"}})
+
+    def do_POST(self):
+        self._send(200, {
+            "id": "cs_test_123",
+            "object": "checkout.session",
+            "url": "https://checkout.stripe.com/c/pay/cs_test_123",
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeStripeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(stripe, "api_base", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(stripe, "api_key", "sk_test_123")
+    yield server
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_async_calls_share_pooled_client(fake_stripe):
+    client = open_stripe_client()
+    try:
+        price = await stripe.Price.retrieve_async("price_123")
+        session = await stripe.checkout.Session.create_async(
+            line_items=[{"price": price.id, "quantity": 1}], mode="payment"
+        )
+        assert stripe.default_http_client is client
+    finally:
+        await close_stripe_client()
+
+    assert price.unit_amount == 1000
+    assert session.url == "https://checkout.stripe.com/c/pay/cs_test_123"
+    assert stripe.default_http_client is None
+
+
+@pytest.mark.asyncio
+async def test_async_unknown_price_raises(fake_stripe):
+    open_stripe_client()
+    try:
+        with pytest.raises(stripe.error.InvalidRequestError):
+            await stripe.Price.retrieve_async("price_unknown")
+    finally:
+        await close_stripe_client()
@@ -0,0 +1,125 @@
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.models import CheckoutSession, TicketStock
+from services.sweeper import ReservationSweeper
+
+
+class FakeTimer:
+    def __init__(self, now: float = 1_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest_asyncio.fixture
+async def session_factory(session_factory):
+    async with session_factory() as db:
+        db.add_all([
+            TicketStock(ticket_id=1, stripe_price_id="price_123", stock=10),
+            TicketStock(ticket_id=2, stripe_price_id="price_456", stock=10),
+            CheckoutSession(session_id="cs_1", user_id="user_1", price_id="price_123", quantity=2,
+                            expires_at=datetime(1970, 1, 1, 0, 16, 40)),
+            CheckoutSession(session_id="cs_1", user_id="user_1", price_id="price_456", quantity=1,
+                            expires_at=datetime(1970, 1, 1, 0, 16, 40)),
+            CheckoutSession(session_id="cs_2", user_id="user_2", price_id="price_123", quantity=3,
+                            expires_at=datetime(1970, 1, 1, 0, 16, 40)),
+        ])
+        await db.commit()
+    return session_factory
+
+
+async def get_stock(db: AsyncSession, price_id: str) -> int:
+    return (await db.execute(select(TicketStock.stock).where(TicketStock.stripe_price_id == price_id))).scalar_one()
+
+
+def test_pop_due_in_deadline_order():
+    timer = FakeTimer()
+    sweeper = ReservationSweeper(grace=10, batch_size=2, timer=timer)
+    sweeper.schedule("cs_late", 990)
+    sweeper.schedule("cs_early", 980)
+    sweeper.schedule("cs_grace", 995.5)
+    sweeper.schedule("cs_open", 2_000)
+
+    assert sweeper.pop_due() == ["cs_early", "cs_late"]
+    assert sweeper.pop_due() == []
+    timer.now = 1_006
+    assert sweeper.pop_due() == ["cs_grace"]
+    assert sweeper.next_deadline() == 2_010
+
+
+@pytest.mark.asyncio
+async def test_load_schedules_open_sessions(session_factory):
+    sweeper = ReservationSweeper(grace=0, timer=FakeTimer(1_000))
+
+    async with session_factory() as db:
+        assert await sweeper.load(db) == 2
+
+    assert sorted(sweeper.pop_due()) == ["cs_1", "cs_2"]
+
+
+@pytest.mark.asyncio
+async def test_sweep_releases_stock_once(session_factory):
+    sweeper = ReservationSweeper(grace=0, timer=FakeTimer(1_000))
+    sweeper.schedule("cs_1", 1_000)
+    sweeper.schedule("cs_2", 1_000)
+
+    async with session_factory() as db:
+        # cs_2 was already closed by its webhook
+        await db.execute(
+            CheckoutSession.__table__.update()
+            .where(CheckoutSession.session_id == "cs_2")
+            .values(status=CheckoutSession.COMPLETE)
+        )
+        await db.commit()
+
+        assert await sweeper.sweep(db) == {"price_123": 2, "price_456": 1}
+        assert await get_stock(db, "price_123") == 12
+        assert await get_stock(db, "price_456") == 11
+
+        # Swept again, e.g. by another worker after a restart
+        sweeper.schedule("cs_1", 1_000)
+        assert await sweeper.sweep(db) == {}
+        assert await get_stock(db, "price_123") == 12
+
+        statuses = (await db.execute(
+            select(CheckoutSession.session_id, CheckoutSession.status).order_by(CheckoutSession.id)
+        )).all()
+    assert statuses == [
+        ("cs_1", CheckoutSession.EXPIRED), ("cs_1", CheckoutSession.EXPIRED), ("cs_2", CheckoutSession.COMPLETE),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sweep_releases_through_reservation_engine(session_factory):
+    engine = MagicMock()
+    sweeper = ReservationSweeper(engine, grace=0, timer=FakeTimer(1_000))
+    sweeper.schedule("cs_2", 1_000)
+
+    async with session_factory() as db:
+        await sweeper.sweep(db)
+        # Written back by the engine's flush instead
+        assert await get_stock(db, "price_123") == 10
+
+    engine.release.assert_called_once_with("price_123", 3)
+
+
+@patch("services.sweeper.async_crud.expire_checkout_sessions", side_effect=RuntimeError("database is down"))
+@pytest.mark.asyncio
+async def test_sweep_failure_retries_later(expire_checkout_sessions_mock):
+    timer = FakeTimer(1_000)
+    sweeper = ReservationSweeper(grace=0, retry_delay=30, timer=timer)
+    sweeper.schedule("cs_1", 1_000)
+
+    with pytest.raises(RuntimeError):
+        await sweeper.sweep(AsyncMock(spec=AsyncSession))
+
+    assert not sweeper.has_due()
+    timer.now = 1_030
+    assert sweeper.pop_due() == ["cs_1"]
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import threading
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from crud import async_crud
+
+from models.models import TicketStock
+from services.price_cache import price_cache
+from services.reservations import MemoryStockStore, StockReservationEngine
+from services.ticket_consumer import (TicketEventConsumer,
+                                      coalesce_ticket_events,
+                                      parse_ticket_event)
+
+
+def make_message(body: dict) -> MagicMock:
+    return MagicMock(body=json.dumps(body).encode(), ack=AsyncMock(), reject=AsyncMock())
+
+
+def created(ticket_id: int, price_id: str, stock: int, **fields) -> dict:
+    return {"event": "ticket_created", "ticket_id": ticket_id, "stripe_price_id": price_id, "stock": stock, **fields}
+
+
+def stock_updated(ticket_id: int, stock: int, **fields) -> dict:
+    return {"event": "ticket_stock_updated", "ticket_id": ticket_id, "stock": stock, **fields}
+
+
+@pytest_asyncio.fixture
+async def session_factory(session_factory):
+    async with session_factory() as db:
+        db.add(TicketStock(ticket_id=1, stripe_price_id="price_1", stock=10))
+        await db.commit()
+    return session_factory
+
+
+async def get_stocks(session_factory) -> list[tuple]:
+    async with session_factory() as db:
+        result = await db.execute(
+            select(TicketStock.ticket_id, TicketStock.stripe_price_id, TicketStock.stock).order_by(TicketStock.ticket_id)
+        )
+        return result.all()
+
+
+def test_parse_ticket_event():
+    assert parse_ticket_event(json.dumps(stock_updated(1, 5)).encode()) == stock_updated(1, 5)
+    assert parse_ticket_event(b"not json") is None
+    assert parse_ticket_event(json.dumps({"event": "ticket_created", "ticket_id": 1}).encode()) is None
+    assert parse_ticket_event(json.dumps({"event": "unhandled_event"}).encode()) is None
+
+
+def test_coalesce_ticket_events_keeps_last_state():
+    upserts, updates = coalesce_ticket_events([
+        stock_updated(1, 5),
+        created(2, "price_2", 100),
+        stock_updated(2, 90),
+        stock_updated(1, 4),
+    ])
+
+    assert {ticket_id: ticket["stock"] for ticket_id, ticket in upserts.items()} == {2: 90}
+    assert updates == {1: {"stock": 4, "version": 0}}
+
+
+def test_coalesce_ticket_events_keeps_newest_version():
+    upserts, updates = coalesce_ticket_events([
+        stock_updated(1, 5, version=3),
+        stock_updated(1, 9, version=2),
+        created(2, "price_2", 100, version=1),
+        stock_updated(2, 90, version=4),
+        created(2, "price_2", 100, version=1),
+    ])
+
+    assert updates == {1: {"stock": 5, "version": 3}}
+    assert (upserts[2]["stock"], upserts[2]["version"]) == (90, 4)
+
+
+@pytest.mark.asyncio
+async def test_process_batch_applies_and_acks_together(session_factory):
+    consumer = TicketEventConsumer(session_factory)
+    messages = [
+        make_message(created(2, "price_2", 100)),
+        make_message(stock_updated(1, 7)),
+        make_message(created(3, "price_3", 50)),
+        make_message(stock_updated(2, 99)),
+    ]
+
+    await consumer.process_batch(messages)
+
+    assert await get_stocks(session_factory) == [(1, "price_1", 7), (2, "price_2", 99), (3, "price_3", 50)]
+    messages[-1].ack.assert_awaited_once_with(multiple=True)
+    assert price_cache.get("price_3").ticket_id == 3
+
+
+@pytest.mark.asyncio
+async def test_redelivered_ticket_created_is_idempotent(session_factory):
+    consumer = TicketEventConsumer(session_factory)
+
+    await consumer.process_batch([make_message(created(1, "price_1", 20))])
+
+    assert await get_stocks(session_factory) == [(1, "price_1", 20)]
+
+
+@pytest.mark.asyncio
+async def test_out_of_order_redelivery_is_ignored(session_factory):
+    engine = MagicMock()
+    consumer = TicketEventConsumer(session_factory, engine)
+
+    await consumer.process_batch([make_message(stock_updated(1, 7, version=5))])
+    await consumer.process_batch([
+        make_message(stock_updated(1, 9, version=4)),
+        make_message(created(1, "price_1", 10, version=1)),
+    ])
+
+    assert await get_stocks(session_factory) == [(1, "price_1", 7)]
+    engine.reconcile.assert_called_once_with("price_1", 7)
+
+
+@pytest.mark.asyncio
+async def test_unknown_ticket_update_is_skipped(session_factory):
+    consumer = TicketEventConsumer(session_factory)
+    messages = [make_message(stock_updated(42, 5)), make_message(stock_updated(1, 3))]
+
+    await consumer.process_batch(messages)
+
+    assert await get_stocks(session_factory) == [(1, "price_1", 3)]
+    messages[-1].ack.assert_awaited_once_with(multiple=True)
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_rejects_only_the_bad_message(session_factory):
+    consumer = TicketEventConsumer(session_factory)
+    # Reuses the stripe_price_id of ticket 1, violating its unique constraint
+    bad = make_message(created(2, "price_1", 5))
+    good = make_message(created(3, "price_3", 5))
+
+    await consumer.process_batch([bad, good])
+
+    assert await get_stocks(session_factory) == [(1, "price_1", 10), (3, "price_3", 5)]
+    bad.reject.assert_awaited_once_with(requeue=False)
+    good.ack.assert_awaited_once_with()
+
+
+@pytest.mark.asyncio
+async def test_reconciles_reservation_engine(session_factory):
+    engine = MagicMock()
+    consumer = TicketEventConsumer(session_factory, engine)
+
+    await consumer.apply([json.dumps(created(2, "price_2", 100)).encode(), json.dumps(stock_updated(1, 8)).encode()])
+
+    engine.reconcile.assert_any_call("price_2", 100)
+    engine.reconcile.assert_any_call("price_1", 8)
+
+
+@pytest.mark.asyncio
+async def test_flush_between_stock_write_and_reconcile(session_factory):
+    engine = StockReservationEngine(MemoryStockStore())
+    engine.store.seed("price_1", 10)
+    await engine.reserve(AsyncMock(spec=AsyncSession), "price_1", 3)
+    consumer = TicketEventConsumer(session_factory, engine)
+    flushed = {}
+    flusher = threading.Thread(target=engine.flush, args=(MagicMock(spec=Session),))
+    apply_ticket_stock_changes = async_crud.apply_ticket_stock_changes
+
+    async def write_then_flush(*args):
+        written = await apply_ticket_stock_changes(*args)
+        flusher.start()
+        # Blocked on the flush lock until the counter is reconciled
+        flusher.join(0.1)
+        return written
+
+    with patch("services.reservations.crud.apply_stock_deltas", side_effect=lambda db, deltas: flushed.update(deltas)), \
+            patch("services.ticket_consumer.async_crud.apply_ticket_stock_changes", side_effect=write_then_flush):
+        await consumer.apply([json.dumps(stock_updated(1, 8)).encode()])
+        flusher.join()
+
+    # The reservation is taken off both the stored stock and the counter
+    assert flushed == {"price_1": -3}
+    assert await get_stocks(session_factory) == [(1, "price_1", 8)]
+    assert engine.store.get("price_1") == 5
+
+
+@pytest.mark.asyncio
+async def test_next_batch_stops_at_batch_size_or_linger():
+    consumer = TicketEventConsumer(MagicMock(), batch_size=2, linger=0.01)
+    for i in range(3):
+        await consumer._messages.put(i)
+
+    assert await consumer.next_batch() == [0, 1]
+    assert await consumer.next_batch() == [2]
+
+    waiter = asyncio.ensure_future(consumer.next_batch())
+    await asyncio.sleep(0)
+    await consumer._messages.put(3)
+    assert await waiter == [3]
+
+
+@pytest.mark.asyncio
+async def test_start_sets_prefetch():
+    consumer = TicketEventConsumer(MagicMock(), prefetch=50)
+    channel, queue = AsyncMock(), AsyncMock()
+
+    await consumer.start(channel, queue)
+
+    channel.set_qos.assert_awaited_once_with(prefetch_count=50)
+    queue.consume.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_stop_cancels_consumption_and_drains(session_factory):
+    consumer = TicketEventConsumer(session_factory, batch_size=10, linger=60)
+    channel, queue = AsyncMock(), AsyncMock()
+    queue.consume.return_value = "ctag"
+    await consumer.start(channel, queue)
+    messages = [make_message(stock_updated(1, 6)), make_message(stock_updated(1, 5))]
+    for message in messages:
+        await consumer._messages.put(message)
+
+    await consumer.stop()
+    # Returns without waiting for the linger of the last batch
+    await asyncio.wait_for(consumer.run(), 1)
+
+    queue.cancel.assert_awaited_once_with("ctag")
+    assert await get_stocks(session_factory) == [(1, "price_1", 5)]
+    messages[-1].ack.assert_awaited_once_with(multiple=True)
+
+
+@pytest.mark.asyncio
+async def test_lag_counts_queued_and_buffered_messages():
+    consumer = TicketEventConsumer(MagicMock())
+    queue = AsyncMock()
+    queue.declare.return_value = MagicMock(message_count=3)
+    await consumer.start(AsyncMock(), queue)
+    await consumer._messages.put(make_message(stock_updated(1, 5)))
+
+    assert await consumer.lag() == 4
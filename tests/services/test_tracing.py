@@ -0,0 +1,103 @@
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import \
+    InMemorySpanExporter
+
+from services import tracing
+from services.publisher import OutboxPublisher
+from services.tracing import (TracingMiddleware, setup_tracing,
+                              shutdown_tracing, span, trace_headers, traced)
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+TRACE_ID = int("0af7651916cd43dd8448eb211c80319c", 16)
+
+
+@pytest.fixture
+def exporter():
+    exporter = InMemorySpanExporter()
+    setup_tracing("payments-test", exporter)
+    yield exporter
+    shutdown_tracing()
+
+
+def finished_spans(exporter) -> dict:
+    shutdown_tracing()
+    return {finished.name: finished for finished in exporter.get_finished_spans()}
+
+
+@pytest.mark.asyncio
+async def test_disabled_tracing_is_a_no_op():
+    @traced("noop")
+    async def double(x):
+        return 2 * x
+
+    assert setup_tracing("payments-test") is False
+    with span("noop") as current:
+        assert current is None
+    assert trace_headers() is None
+    assert await double(2) == 4
+
+
+@pytest.mark.asyncio
+async def test_spans_nest_and_propagate(exporter):
+    @traced("child")
+    async def child():
+        return trace_headers()
+
+    with span("parent"):
+        headers = await child()
+    with span("continued", parent=headers):
+        pass
+
+    spans = finished_spans(exporter)
+    assert spans["child"].parent.span_id == spans["parent"].context.span_id
+    assert headers["traceparent"].split("-")[2] == format(spans["child"].context.span_id, "016x")
+    assert spans["continued"].parent.span_id == spans["child"].context.span_id
+
+
+@pytest.mark.asyncio
+async def test_publish_continues_the_trace_of_the_message(exporter):
+    publisher = OutboxPublisher(MagicMock())
+    exchange = MagicMock(publish=AsyncMock())
+    publisher.attach(exchange)
+
+    await publisher.publish((1, "payments.messages", "{}", {"traceparent": TRACEPARENT}))
+
+    spans = finished_spans(exporter)
+    publish_span = spans["rabbitmq.publish"]
+    assert publish_span.context.trace_id == TRACE_ID
+    message = exchange.publish.call_args.args[0]
+    assert message.headers["traceparent"].split("-")[2] == format(publish_span.context.span_id, "016x")
+
+
+def test_middleware_traces_requests_by_route(exporter):
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/items/{item_id}")
+    def read_item(item_id: int):
+        return {"item_id": item_id}
+
+    TestClient(app).get("/items/1", headers={"traceparent": TRACEPARENT})
+
+    request_span = finished_spans(exporter)["GET /items/{item_id}"]
+    assert request_span.context.trace_id == TRACE_ID
+    assert request_span.attributes["http.response.status_code"] == 200
+
+
+def test_file_exporter(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACING_ENABLED", True)
+    monkeypatch.setattr(tracing, "TRACING_EXPORTER", "file")
+    monkeypatch.setattr(tracing, "TRACING_FILE", str(tmp_path / "traces.jsonl"))
+
+    assert setup_tracing("payments-test") is True
+    with span("exported"):
+        pass
+    shutdown_tracing()
+
+    [line] = (tmp_path / "traces.jsonl").read_text().splitlines()
+    assert json.loads(line)["name"] == "exported"
@@ -0,0 +1,43 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from consumer import consume_until, main
+from services.reservations import MemoryStockStore, StockReservationEngine
+from services.ticket_consumer import TicketEventConsumer
+
+
+@pytest.mark.asyncio
+async def test_consume_until_stops_gracefully():
+    consumer = TicketEventConsumer(MagicMock())
+    consumer.process_batch = AsyncMock()
+    stop = asyncio.Event()
+    task = asyncio.create_task(consume_until(consumer, stop))
+    await consumer._messages.put("message")
+    await asyncio.sleep(0.1)
+
+    stop.set()
+    await asyncio.wait_for(task, 1)
+
+    consumer.process_batch.assert_awaited_once_with(["message"])
+
+
+@pytest.mark.asyncio
+async def test_consume_until_raises_consumer_errors():
+    consumer = TicketEventConsumer(MagicMock(), linger=0)
+    consumer.process_batch = AsyncMock(side_effect=RuntimeError("connection lost"))
+    await consumer._messages.put("message")
+
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(consume_until(consumer, asyncio.Event()), 1)
+
+
+@patch("consumer.aio_pika")
+@patch("consumer.reservation_engine", StockReservationEngine(MemoryStockStore()))
+@pytest.mark.asyncio
+async def test_refuses_to_start_with_memory_engine(aio_pika_mock):
+    with pytest.raises(RuntimeError):
+        await main()
+
+    aio_pika_mock.connect_robust.assert_not_called()